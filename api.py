@@ -2,11 +2,20 @@
 Server Requesthandler Class.
 """
 
-import json
-import os
-import shutil
-from os.path import join, normpath, realpath, isfile, isdir
+import time
+from os.path import join, basename, normpath
 from .templates import *
+from .registry import get_registry
+from .transfer import Transfer, Download, Upload
+from .dir_index import get_directory_index, drop_directory_index
+from .metrics import METRICS
+from .session_store import SESSIONS
+from .quota import get_usage, drop_usage
+from .blob_store import get_blob_store
+from .search_index import get_search_index, drop_search_index
+from .profiler import start_profile, stop_profile, KINDS, UNITS
+from .config import session_path, get_setting
+from .storage import get_storage
 
 class RequestHandler():
     """
@@ -21,6 +30,12 @@ class RequestHandler():
         login_flag : bool
             Is user logged in or not.
 
+        registry : Class(UserRegistry)
+            User registry shared by all handlers.
+
+        backend : Class(Storage)
+            Storage backend holding the files of every user.
+
         user_passwords : dict(user:password)
             Registered user passwords.
 
@@ -33,17 +48,41 @@ class RequestHandler():
         read_record : dict{path:index}
             Read file status till where it has already read.
 
+        read_char : int
+            Characters read_file shows at once, set by window.
+
+        token : str
+            Session token of the login, None when logged out.
+
     Methods:
     -----------------
         respond(statement):
+            Execute the statement and record its metrics.
+
+        execute(statement):
             Map the statement to valid commands.
 
-        register(username, password, privileges):
-            Register a new user.
+        respond_batch(statements):
+            Respond to commands in order.
+
+        register(username, password, privileges, max_bytes, max_inodes):
+            Register a new user, quotas only by admins.
+
+        quota(user, max_bytes, max_inodes):
+            Change the storage limits of a user.
+
+        usage():
+            Storage used against the quota.
+
+        storage():
+            Space saved by deduplication for admins.
 
         login(username, password):
             Login a user.
 
+        resume(token):
+            Take over the session of an earlier connection.
+
         list():
             List of all files in directory.
 
@@ -56,8 +95,23 @@ class RequestHandler():
         read_file(path):
             Read a specified file.
 
+        read_range(path, offset, length):
+            Read any byte range of a file.
+
+        window(size):
+            Set the characters read_file shows at once.
+
         write_file(path, data):
             Write file with data.
+
+        stats():
+            Server metrics for admins.
+
+        download(path):
+            Stream a whole file.
+
+        upload(path, size):
+            Stream a file in.
     """
     def __init__(self):
         """
@@ -65,39 +119,64 @@ class RequestHandler():
         """
         self.username = None
         self.login_flag = False
+        self.registry = get_registry()
+        self.backend = get_storage()
         self.user_passwords = self.load_passwords()
         self.user_privileges = self.load_privileges()
         self.present_directory = ""
         self.read_record = {}
-        self.read_char = 100
+        self.read_char = get_setting("page_size")
+        self.token = None
 
     def load_passwords(self):
         """
-        Load passwords form session
+        Load passwords form the shared registry
 
         Return : dict{user:password}
             Returns a dictionary of username and passwords.
 
         """
-        with open("server_session/server_data") as file:
-            data = json.load(file)
-        return data["passwords"][0]
+        self.registry.refresh()
+        return self.registry.passwords
 
     def load_privileges(self):
         """
-        Load privileges form session
+        Load privileges form the shared registry
 
         Return : dict{user:privileges}
             Returns a dictionary of username and privileges.
 
         """
-        with open("server_session/server_data") as file:
-            data = json.load(file)
-        return data["privileges"][0]
+        self.registry.refresh()
+        return self.registry.privileges
 
         
         
-     def respond(self, statement):
+    def respond(self, statement):
+        """
+        Respond to a command, recording its count, errors and latency.
+
+        Parameters:
+            statement : str
+
+        Return: str
+            Return the command output in string.
+        """
+        started = time.perf_counter()
+        command = statement.rstrip("\n").split(" ")[0]
+        try:
+            response = self.execute(statement)
+        except Exception:
+            METRICS.record_command(command, time.perf_counter() - started, error=True)
+            raise
+        if response == "Invalid command":
+            command = "invalid"
+        if self.token:
+            SESSIONS.touch(self.token)
+        METRICS.record_command(command, time.perf_counter() - started)
+        return response
+
+    def execute(self, statement):
         """
         Respont to execute all of the commands
 
@@ -113,15 +192,25 @@ class RequestHandler():
         if executer == "commands":
             return self.commands()
         if executer == "register":
-            if len(statement) == 4:
+            if len(statement) in (4, 6):
                 try:
                     username = statement[1]
                     password = statement[2]
                     privileges = statement[3]
                 except:
                     return "Wrong input"
-                return self.register(username, password, privileges)
+                return self.register(username, password, privileges, *statement[4:])
             return "Check your input again"
+        if executer == "quota":
+            if len(statement) == 4:
+                return self.quota(statement[1], statement[2], statement[3])
+            return "Check your input again"
+        if executer == "usage":
+            return self.usage()
+        if executer == "storage":
+            return self.storage()
+        if executer == "profile":
+            return self.profile(*statement[1:])
         if executer == "quit":
             return self.quit()
         if executer == "login":
@@ -133,22 +222,82 @@ class RequestHandler():
                     return "Wrong input"
                 return self.login(username, password)
             return "Check your input again"
+        if executer == "resume":
+            if len(statement) == 2:
+                return self.resume(statement[1])
+            return "Check your input again"
         if executer == "list":
+            if statement[1:] == ["-l"]:
+                return self.tree("1")
             return self.list()
+        if executer == "tree":
+            if len(statement) in (1, 2):
+                return self.tree(*statement[1:])
+            return "Check your input again"
         if executer == "change_folder":
-            return self.change_folder(statement[1])
+            if len(statement) == 2:
+                return self.change_folder(statement[1])
+            return "Check your input again"
         if executer == "read_file":
-            return self.read_file(statement[1])
+            if len(statement) == 2:
+                return self.read_file(statement[1])
+            return "Check your input again"
+        if executer == "read_range":
+            if len(statement) == 4:
+                return self.read_range(statement[1], statement[2], statement[3])
+            return "Check your input again"
+        if executer == "search":
+            if len(statement) > 1:
+                return self.search(" ".join(statement[1:]))
+            return "Check your input again"
+        if executer == "window":
+            if len(statement) == 2:
+                return self.window(statement[1])
+            return "Check your input again"
         if executer == "write_file":
-            return self.write_file(statement[1], " ".join(statement[2:]))
+            if len(statement) > 1:
+                return self.write_file(statement[1], " ".join(statement[2:]))
+            return "Check your input again"
         if executer == "create_folder":
-            return self.create_folder(statement[1])
+            if len(statement) == 2:
+                return self.create_folder(statement[1])
+            return "Check your input again"
         if executer == "delete":
-            return self.delete(statement[1], statement[2])
+            if len(statement) == 3:
+                return self.delete(statement[1], statement[2])
+            return "Check your input again"
+        if executer == "stats":
+            return self.stats()
+        if executer == "download":
+            if len(statement) == 2:
+                return self.download(statement[1])
+            return "Check your input again"
+        if executer == "upload":
+            if len(statement) == 3:
+                return self.upload(statement[1], statement[2])
+            return "Check your input again"
         return "Invalid command"
+
+    def respond_batch(self, statements):
+        """
+        Respond to a batch of commands in order.
+
+        Parameters:
+            statements : list(str)
+
+        Return: list([seq, str])
+            Command outputs tagged with their sequence number.
+        """
+        results = []
+        for seq, statement in enumerate(statements):
+            response = self.respond(statement)
+            if isinstance(response, Transfer):
+                response = TRANSFER_IN_BATCH
+            results.append([seq, response])
+        return results
     
     
-    def add_new_user(self, user, password, privileges):
+    def add_new_user(self, user, password, privileges, quota=None):
         """
         Add a new user and save the user to session.
 
@@ -156,20 +305,16 @@ class RequestHandler():
             user : str
             password : str
             privileges : str
+            quota : list(int)
+                max_bytes and max_inodes, None for no limit.
 
+        Return: bool
+            False if the username got taken meanwhile.
         """
-        self.user_passwords[user] = password
-        self.user_privileges[user] = privileges
-        with open("server_session/server_data", "w+") as file:
-            json.dump({"passwords":[self.user_passwords], "privileges":[self.user_privileges]}, file)
-        os.mkdir(join("server_session", user))
-
-    def rewrite_session(self):
-        """
-        Update the session.
-        """
-        with open("server_session/server_data", "w+") as file:
-            json.dump({"passwords":[self.user_passwords], "privileges":[self.user_privileges]}, file)
+        if not self.registry.add_user(user, password, privileges, quota):
+            return False
+        self.backend.mkdir(user)
+        return True
 
     def commands(self):
         """
@@ -236,7 +381,7 @@ class RequestHandler():
         return self.password_check(self.username, password)
 
         
-     def login(self, user, password):
+    def login(self, user, password):
         """
         Login command.
         Parameters:
@@ -252,10 +397,37 @@ class RequestHandler():
             return LOGIN_NO_USERNAME
         if self.password_check(user, password):
             return LOGIN_WRONG_PASSWORD
+        if not self.backend.exists(user):
+            # Backends other than the filesystem start without the folders of registered users.
+            self.backend.mkdir(user)
         self.login_flag = True
         self.username = user
         self.present_directory = ""
-        return LOGIN_TRUE
+        self.token = SESSIONS.create(self)
+        return LOGIN_TRUE + session_token(self.token)
+
+    def resume(self, token):
+        """
+        Resume command, takes over the user, folder and read cursors of a session.
+
+        Parameters:
+            token : str
+
+        Return: str
+            Resume response.
+        """
+        if not self.login_required():
+            return LOGIN_ALREADY
+        session = SESSIONS.attach(token, self)
+        if session is None or not session.login_flag:
+            return RESUME_INVALID
+        self.login_flag = True
+        self.username = session.username
+        self.present_directory = session.present_directory
+        self.read_record = session.read_record
+        self.read_char = session.read_char
+        self.token = token
+        return resume_success(self.username)
 
     def quit(self):
         """
@@ -264,13 +436,16 @@ class RequestHandler():
         Return: str
             Quit response
         """
+        if self.token:
+            SESSIONS.drop(self.token)
         self.present_directory = ""
         self.login_flag = False
         self.username = None
         self.read_record = {}
+        self.token = None
         return LOG_OUT_MSG
 
-    def register(self, user, password, privileges):
+    def register(self, user, password, privileges, max_bytes=None, max_inodes=None):
         """
         Register command
 
@@ -278,18 +453,127 @@ class RequestHandler():
             user : str
             password : str
             privileges : str
+            max_bytes, max_inodes : str
+                Storage limits, only admins may set them.
 
         Return: str
             Register response.
 
         """
+        quota = None
+        if max_bytes is not None:
+            if self.login_required():
+                return LOGIN_REQUIRED
+            if self.admin_required():
+                return ADMIN_REQUIRED
+            if not max_bytes.isdigit() or not max_inodes.isdigit():
+                return QUOTA_INVALID
+            quota = [int(max_bytes), int(max_inodes)]
         if user in list(self.user_passwords.keys()):
             return REGISTER_USERNAME_UNVAIL
-        if user == "" or password == "" or privileges == "":
+        if user == "" or password == "" or privileges == "" or user.startswith("."):
             return REGISTER_INVALID
-        self.add_new_user(user, password, privileges)
+        if not self.add_new_user(user, password, privileges, quota):
+            return REGISTER_USERNAME_UNVAIL
         return REGISTER_SUCCESS
 
+    def quota(self, user, max_bytes, max_inodes):
+        """
+        Quota command.
+
+        Parameters:
+            user : str
+            max_bytes, max_inodes : str
+                Storage limits, 0 for no limit.
+
+        Return: str
+            Quota response.
+        """
+        if self.login_required():
+            return LOGIN_REQUIRED
+        if self.admin_required():
+            return ADMIN_REQUIRED
+        if not max_bytes.isdigit() or not max_inodes.isdigit():
+            return QUOTA_INVALID
+        if not self.registry.set_quota(user, int(max_bytes), int(max_inodes)):
+            return no_user_found(user)
+        return quota_success(user, int(max_bytes), int(max_inodes))
+
+    def usage(self):
+        """
+        Usage command.
+
+        Return: str
+            Storage used and the quota of the user.
+        """
+        if self.login_required():
+            return LOGIN_REQUIRED
+        used_bytes, used_inodes = get_usage(self.username).report()
+        return usage_report(used_bytes, used_inodes, *self.registry.quota(self.username))
+
+    def storage(self):
+        """
+        Storage command, drops unreferenced blobs before reporting.
+
+        Return: str
+            Blob count and space saved by deduplication.
+        """
+        if self.login_required():
+            return LOGIN_REQUIRED
+        if self.admin_required():
+            return ADMIN_REQUIRED
+        store = get_blob_store()
+        if store is None:
+            return DEDUP_OFF
+        store.collect()
+        return storage_report(*store.report())
+
+    def profile(self, action=None, kind=None, unit=None, limit=None, command=None, *rest):
+        """
+        Profile command, starts or stops the request profiler of the process.
+
+        Parameters:
+            action : str
+                start or stop.
+            kind : str
+                cprofile or sample.
+            unit : str
+                seconds or requests.
+            limit : str
+                Seconds or requests to profile.
+            command : str
+                Only profile this command, every command when missing.
+
+        Return: str
+            Profile response.
+        """
+        if self.login_required():
+            return LOGIN_REQUIRED
+        if self.admin_required():
+            return ADMIN_REQUIRED
+        if action == "stop" and kind is None:
+            path = stop_profile()
+            return PROFILE_IDLE if path is None else profile_written(path)
+        if (action != "start" or kind not in KINDS or unit not in UNITS or rest
+                or limit is None or not limit.isdigit() or not int(limit)):
+            return PROFILE_INVALID
+        if start_profile(kind, unit, int(limit), command) is None:
+            return PROFILE_RUNNING
+        return profile_started(kind, unit, limit, command)
+
+    def reserve(self, size, inodes):
+        """
+        Count a change against the quota of the user before making it.
+
+        Parameters:
+            size : int
+            inodes : int
+
+        Return: bool
+            Change fits the quota.
+        """
+        return get_usage(self.username).reserve(size, inodes, self.registry.quota(self.username))
+
     def delete(self, user, password):
         """
         Delete command
@@ -310,13 +594,16 @@ class RequestHandler():
             return no_user_found(user)
         if self.self_password_check(password):
             return LOGIN_WRONG_PASSWORD
-        del self.user_passwords[user]
-        del self.user_privileges[user]
-        self.rewrite_session()
+        self.registry.remove_user(user)
+        SESSIONS.drop_user(user)
         if user == self.username:
             self.login_flag = False
-        user_path = join("server_session", user)
-        shutil.rmtree(user_path)
+        self.backend.rmtree(user)
+        drop_directory_index(user)
+        drop_usage(user)
+        drop_search_index(user)
+        if get_blob_store():
+            get_blob_store().collect()
         return delete_success(user)
     
     def check_folder_path(self, directory):
@@ -329,13 +616,16 @@ class RequestHandler():
         Return: bool
             Directory in available directories.
         """
-        total = []
-        for direc, files, sub in os.walk(join("server_session", self.username)):
-            total.append(normpath(realpath(direc)))
-        total_path = join("server_session", self.username, self.present_directory, directory)
-        real_path = realpath(total_path)
-        path_to_be_change = normpath(real_path)
-        return not path_to_be_change in total
+        return not self.directories().is_directory(self.present_directory, directory)
+
+    def directories(self):
+        """
+        Directory index of the user.
+
+        Return: Class(DirectoryIndex)
+            Directory index shared by the sessions of the user.
+        """
+        return get_directory_index(self.username)
 
     def change_folder(self, directory):
         """
@@ -352,7 +642,8 @@ class RequestHandler():
             return LOGIN_REQUIRED
         if self.check_folder_path(directory):
             return INCORRECT_DIRECTORY
-        self.present_directory = join(self.present_directory, directory)
+        present_directory = normpath(join(self.present_directory, directory))
+        self.present_directory = "" if present_directory == "." else present_directory
         return ch_dir_success(directory)
 
     def list(self):
@@ -364,11 +655,27 @@ class RequestHandler():
         """
         if self.login_required():
             return LOGIN_REQUIRED
-        total_files = []
-        for file in os.listdir(join("server_session", self.username, self.present_directory)):
-            total_files.append(file)
+        total_files = self.directories().listing(self.present_directory)[0]
         return list_folder(total_files)
 
+    def tree(self, depth=None):
+        """
+        Tree command, served from the cached metadata of the directory index.
+
+        Parameters:
+            depth : str
+                Levels to list, the whole subtree when missing.
+
+        Return: str
+            Tree response.
+        """
+        if self.login_required():
+            return LOGIN_REQUIRED
+        if depth is not None and (not depth.isdigit() or not int(depth)):
+            return TREE_INVALID
+        entries = self.directories().tree(self.present_directory, depth and int(depth))
+        return tree_listing(entries)
+
     def list_files(self):
         """
         Available files in folder.
@@ -376,11 +683,7 @@ class RequestHandler():
         Return: list
             List of files
         """
-        available_files = []
-        for file in os.listdir(join("server_session", self.username, self.present_directory)):
-            if isfile(join("server_session", self.username, self.present_directory, file)):
-                available_files.append(file)
-        return available_files
+        return self.directories().listing(self.present_directory)[1]
 
     def load_read_indexes(self, path):
         """
@@ -408,7 +711,19 @@ class RequestHandler():
         Return: str
             absolute path of the path parameter.
         """
-        return join("server_session", self.username, self.present_directory, path)
+        return session_path(self.username, self.present_directory, path)
+
+    def get_storage_path(self, path):
+        """
+        Path in the storage backend.
+
+        Parameters:
+            path : str
+
+        Return: str
+            Path of the path parameter from the session root.
+        """
+        return join(self.username, self.present_directory, path)
 
     def read_content(self, path):
         """
@@ -421,15 +736,50 @@ class RequestHandler():
             Data of file.
 
         """
-        path = self.get_total_path(path)
+        path = self.get_storage_path(path)
         self.load_read_indexes(path)
-        with open(path, "r") as file:
-            contents = file.read()
-        index = str(self.read_record[path]*self.read_char)
-        data = contents[self.read_record[path]*self.read_char:((self.read_record[path]*self.read_char)+1)*self.read_char]
-        self.read_record[path] += 1
-        self.read_record[path] %= len(contents)//self.read_char + 1
-        return read_file(index, data)
+        page, data, pages = self.backend.read_page(path, self.read_record[path], self.read_char)
+        self.read_record[path] = (page + 1) % pages
+        return read_file(str(page*self.read_char), data, self.read_char)
+
+    def leaves_user_directory(self, path):
+        """
+        Path resolves outside the directory of the user.
+
+        Parameters:
+            path : str
+
+        Return: bool
+            Outside or not.
+        """
+        return self.directories().split(self.present_directory, path) is None
+
+    def found_in_backend(self, path, directory=False):
+        """
+        Entry of the present folder the directory index missed, recorded if found.
+
+        Under prefork another worker may have created it after this process
+        scanned the folder. Only plain names inside the user directory are
+        looked up, so a path can never reach the files of another user.
+
+        Parameters:
+            path : str
+            directory : bool
+                Look for a folder instead of a file.
+
+        Return: bool
+            Entry found.
+        """
+        if path in ("", ".", "..") or path != basename(path) or self.leaves_user_directory(path):
+            return False
+        try:
+            is_directory = self.backend.stat(self.get_storage_path(path))[0]
+        except FileNotFoundError:
+            return False
+        if is_directory != directory:
+            return False
+        self.directories().add(self.present_directory, path, directory=directory, scanned=not directory)
+        return True
 
     def check_file_path_to_read(self, path):
         """
@@ -441,8 +791,7 @@ class RequestHandler():
         Return: bool
             File to be read in path or not.
         """
-        total_files = self.list_files()
-        return not path in total_files
+        return path not in self.list_files() and not self.found_in_backend(path)
 
     def read_file(self, path):
         """
@@ -460,6 +809,171 @@ class RequestHandler():
             return READ_WRONG_PATH
         return self.read_content(path)
 
+    def read_range(self, path, offset, length):
+        """
+        Read range command, only the range is read from the storage backend.
+
+        Parameters:
+            path : str
+            offset : str
+                First byte.
+            length : str
+                Bytes to read, at most MAX_WINDOW.
+
+        Return: str
+            Read range response.
+        """
+        if self.login_required():
+            return LOGIN_REQUIRED
+        if self.check_file_path_to_read(path):
+            return READ_WRONG_PATH
+        if not offset.isdigit() or not length.isdigit() or not 0 < int(length) <= MAX_WINDOW:
+            return READ_RANGE_INVALID
+        data, size = self.backend.read_range(self.get_storage_path(path), int(offset), int(length))
+        return read_range(int(offset), len(data), size, str(data, "utf-8", "replace"))
+
+    def search(self, term):
+        """
+        Search command, looks the words up in the index of the user.
+
+        Parameters:
+            term : str
+
+        Return: str
+            Search response, paths from the user folder with byte offsets.
+        """
+        if self.login_required():
+            return LOGIN_REQUIRED
+        results = get_search_index(self.username).search(term)
+        if not results:
+            return SEARCH_EMPTY
+        return search_results(results)
+
+    def window(self, size):
+        """
+        Window command, keeps the read positions of read_file.
+
+        Parameters:
+            size : str
+                Characters per read_file page, at most MAX_WINDOW.
+
+        Return: str
+            Window response.
+        """
+        if self.login_required():
+            return LOGIN_REQUIRED
+        if not size.isdigit() or not 0 < int(size) <= MAX_WINDOW:
+            return WINDOW_INVALID
+        for path, page in self.read_record.items():
+            self.read_record[path] = page * self.read_char // int(size)
+        self.read_char = int(size)
+        return window_success(self.read_char)
+
+    def stats(self):
+        """
+        Stats command.
+
+        Return: str
+            Metrics of the server.
+        """
+        if self.login_required():
+            return LOGIN_REQUIRED
+        if self.admin_required():
+            return ADMIN_REQUIRED
+        return server_stats(METRICS.render())
+
+    def download(self, path):
+        """
+        Download command.
+
+        Parameters:
+            path : str
+
+        Return: str or Class(Download)
+            Error response, or the file for the socket engine to stream.
+        """
+        if self.login_required():
+            return LOGIN_REQUIRED
+        if self.check_file_path_to_read(path):
+            return READ_WRONG_PATH
+        if self.backend.local_path("") is None:
+            return TRANSFER_LOCAL_ONLY
+        return Download(self.get_total_path(path))
+
+    def upload(self, path, size):
+        """
+        Upload command.
+
+        Parameters:
+            path : str
+            size : str
+                Total bytes of the file.
+
+        Return: str or Class(Upload)
+            Error response, or the upload for the socket engine to receive.
+        """
+        if self.login_required():
+            return LOGIN_REQUIRED
+        if not size.isdigit() or path in ("", ".", "..") or path != basename(path):
+            return UPLOAD_INVALID
+        if self.check_subdirectories(path):
+            return UPLOAD_INVALID
+        if self.backend.local_path("") is None:
+            return TRANSFER_LOCAL_ONLY
+        usage = get_usage(self.username)
+        return Upload(self.get_total_path(path), int(size), self.upload_done(path, usage),
+                      usage.release, self.upload_start(path, usage))
+
+    def upload_start(self, path, usage):
+        """
+        Callback reserving the quota of an upload and recording its part file.
+
+        Batches and raw mode drop the upload without running it, so nothing
+        is counted until the socket engine starts the transfer.
+
+        Parameters:
+            path : str
+            usage : Class(StorageUsage)
+
+        Return: callable
+            Callback for Upload.
+        """
+        present_directory = self.present_directory
+        directories = self.directories()
+        registry = self.registry
+        username = self.username
+        def start(size, inodes):
+            if not usage.reserve(size, inodes, registry.quota(username)):
+                return QUOTA_EXCEEDED
+            directories.add(present_directory, path + ".part")
+            return None
+        return start
+
+    def upload_done(self, path, usage):
+        """
+        Callback recording a finished upload in the directory index and the usage.
+
+        Parameters:
+            path : str
+            usage : Class(StorageUsage)
+
+        Return: callable
+            Callback for Upload.
+        """
+        present_directory = self.present_directory
+        directories = self.directories()
+        total_path = self.get_total_path(path)
+        index = get_search_index(self.username)
+        def done(replaced, checksum):
+            if get_blob_store():
+                get_blob_store().intern(total_path, checksum)
+            directories.remove(present_directory, path + ".part")
+            directories.add(present_directory, path)
+            if replaced is not None:
+                usage.release(replaced, 1)
+            index.update(join(present_directory, path))
+        return done
+
     def check_file_path_to_write(self, path):
         """
         Check file in folder or not.
@@ -470,8 +984,7 @@ class RequestHandler():
         Return: bool
             File in directory or not.
         """
-        total_files = self.list_files()
-        return not path in total_files
+        return path not in self.list_files() and not self.found_in_backend(path)
 
     def write(self, path, data, method):
         """
@@ -483,13 +996,15 @@ class RequestHandler():
             method : str
                 Write or append method.
         """
-        path = self.get_total_path(path)
+        storage_path = self.get_storage_path(path)
         if method == "w":
-            with open(path, "w+") as file:
-                file.write(data)
-                return
-        with open(path, "a+") as file:
-            file.write("\n" + data)
+            self.backend.write(storage_path, data.encode("utf-8"))
+            self.directories().add(self.present_directory, path)
+            get_search_index(self.username).update(join(self.present_directory, path))
+            return
+        self.backend.append(storage_path, ("\n" + data).encode("utf-8"))
+        self.directories().touch(self.present_directory, path)
+        get_search_index(self.username).update(join(self.present_directory, path), appended=True)
 
     def write_file(self, path, data):
         """
@@ -504,9 +1019,15 @@ class RequestHandler():
         """
         if self.login_required():
             return LOGIN_REQUIRED
+        if self.leaves_user_directory(path):
+            return READ_WRONG_PATH
         if self.check_file_path_to_write(path):
+            if not self.reserve(len(data.encode("utf-8")), 1):
+                return QUOTA_EXCEEDED
             self.write(path, data, "w")
             return WRITE_NEW_PATH
+        if not self.reserve(len(data.encode("utf-8")) + 1, 0):
+            return QUOTA_EXCEEDED
         self.write(path, data, "a")
         return WRITE_EXISTING
 
@@ -520,12 +1041,9 @@ class RequestHandler():
         Return: bool
             Path in available directories.
         """
-        present_directory = join("server_session", self.username, self.present_directory)
-        directories = []
-        for sub in os.listdir(present_directory):
-            if isdir(join(present_directory, sub)):
-                directories.append(sub)
-        return path in directories
+        if path in ("", ".", ".."):
+            return True
+        return self.directories().is_directory(self.present_directory, path)
 
     def create_folder(self, path):
         """
@@ -541,5 +1059,12 @@ class RequestHandler():
             return LOGIN_REQUIRED
         if self.check_subdirectories(path):
             return DIRECTORY_PRESENT
-        os.mkdir(self.get_total_path(path))
+        if self.leaves_user_directory(path):
+            return INCORRECT_DIRECTORY
+        if self.found_in_backend(path, directory=True):
+            return DIRECTORY_PRESENT
+        if not self.reserve(0, 1):
+            return QUOTA_EXCEEDED
+        self.backend.mkdir(self.get_storage_path(path))
+        self.directories().add(self.present_directory, path, directory=True)
         return DIRECTORY_SUCCESS
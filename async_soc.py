@@ -0,0 +1,157 @@
+"""
+Asyncio socket engine, a coroutine per connection instead of a thread per request.
+"""
+
+import asyncio
+import socket
+import time
+
+from .soc import SocketAttach, record_transfer, record_compression
+from .metrics import METRICS
+from .api import RequestHandler
+from .templates import SERVER_BUSY, SERVER_FULL, TRANSFER_FRAMED_ONLY
+from .transfer import Transfer
+from .protocol import handshake, negotiate, features, read_message, write_message, HEADER, MAX_REQUEST
+
+class AsyncSocketAttach(SocketAttach):
+    """
+    Asyncio socket attach module
+
+    Binds the socket exactly like SocketAttach but serves every connection
+    from a coroutine on one event loop, so an idle server sleeps in the
+    selector instead of spinning over the connection list. Handlers still
+    run on the SocketAttach scheduler, and the SocketAttach connection cap
+    and timeouts apply: idle_timeout to waiting for a request, read_timeout
+    to the rest of a started request and to writes.
+
+    Attributes:
+    -----------------
+        connection_api : dict{ip:RequestHandler}
+            Attach a request handler to ip
+
+    Methods:
+    -----------------
+        run_session():
+            Run the event loop.
+
+        serve():
+            Serve connections until cancelled.
+
+        handle_connection(reader, writer):
+            Read, respond and write for one connection.
+
+        read_request(reader, protocol):
+            Read one request in the protocol of the connection.
+    """
+
+    def run_session(self):
+        """
+        Start the event loop and accept connections.
+        """
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """
+        Serve connections on the bound socket forever.
+        """
+        server = await asyncio.start_server(self.handle_connection, sock=self.socket_object)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        """
+        Respond to the client until it disconnects.
+
+        Parameters:
+            reader : asyncio.StreamReader
+            writer : asyncio.StreamWriter
+        """
+        address = writer.get_extra_info("peername")
+        if len(self.connection_api) >= self.max_connections:
+            writer.write(str.encode(SERVER_FULL))
+            writer.close()
+            return
+        # asyncio turns TCP_NODELAY on for every transport, apply the setting instead.
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                                   int(self.tcp_nodelay))
+        self.connection_api[address] = RequestHandler()
+        METRICS.connection_opened()
+        print("Connection established from ip :" + address[0])
+        protocol = None
+        compress = False
+        try:
+            while True:
+                flags, client_res = await self.read_request(reader, protocol)
+                if client_res is None:
+                    break
+                if protocol is None:
+                    protocol = negotiate(client_res)
+                    if protocol:
+                        accepted = features(client_res)
+                        compress = "zlib" in accepted
+                        write_message(writer, handshake(protocol, accepted))
+                        await writer.drain()
+                        continue
+                client_res = str(client_res, "utf-8")
+                response = self.throttle(address, flags, client_res)
+                if response is not None:
+                    flags = 0
+                else:
+                    # Handlers touch the disk, keep them off the event loop.
+                    future = self.scheduler.submit(self.dispatch, address, flags, client_res,
+                                                   key=self.tenant(address))
+                    if future is None:
+                        flags, response = 0, str.encode(SERVER_BUSY)
+                    else:
+                        response = await asyncio.wrap_future(future)
+                started = time.perf_counter()
+                if isinstance(response, Transfer):
+                    if protocol:
+                        await response.run_async(reader, writer, self.read_timeout)
+                        record_transfer(response, time.perf_counter() - started)
+                        continue
+                    response = str.encode(TRANSFER_FRAMED_ONLY)
+                if protocol:
+                    sent = write_message(writer, response, flags, compress)
+                    record_compression(response, sent, compress)
+                else:
+                    writer.write(response)
+                    sent = len(response)
+                await asyncio.wait_for(writer.drain(), self.read_timeout)
+                METRICS.record_io("write", time.perf_counter() - started, sent)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as exps:
+            print(exps)
+        finally:
+            del self.connection_api[address]
+            if self.rate_limiter is not None:
+                self.rate_limiter.forget(address)
+            METRICS.connection_closed()
+            writer.close()
+            print("Connection closed from ip :" + address[0])
+
+    async def read_request(self, reader, protocol):
+        """
+        Read one request.
+
+        Parameters:
+            reader : asyncio.StreamReader
+            protocol : int
+                Protocol version, 0 for raw mode, None before the first message.
+
+        Return: tuple(flags, bytes or None)
+            Message flags and request, None when the client disconnected.
+        """
+        if protocol:
+            header = await asyncio.wait_for(reader.readexactly(HEADER.size), self.idle_timeout)
+            started = time.perf_counter()
+            flags, client_res = await asyncio.wait_for(read_message(reader, header, MAX_REQUEST),
+                                                       self.read_timeout)
+            METRICS.record_io("read", time.perf_counter() - started, len(client_res))
+            return flags, client_res
+        client_res = await asyncio.wait_for(reader.read(self.recv_size), self.idle_timeout)
+        if not client_res:
+            return 0, None
+        METRICS.record_io("read", 0.0, len(client_res))
+        return 0, client_res
@@ -0,0 +1,433 @@
+"""
+Load generator and benchmark for the server.
+
+Starts a server on a scratch session directory, drives it with simulated
+clients running a weighted command mix and saves throughput, latency
+percentiles and server CPU/RSS as JSON. The server runs without rate limits
+so it is measured rather than its throttling, throttled, busy and error
+replies count as errors and not as served operations.
+
+    python -m KVN.bench --engine asyncio --clients 50 --duration 20 --output asyncio.json
+    python -m KVN.bench --engine thread --baseline asyncio.json
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from .protocol import handshake, negotiate, send_message, recv_message
+from .templates import (LOGIN_TRUE, LOGIN_REQUIRED, SERVER_BUSY, SERVER_FULL, RATE_LIMITED,
+                        QUOTA_EXCEEDED, READ_WRONG_PATH, INCORRECT_DIRECTORY)
+
+PACKAGE = __package__
+USER = "bench"
+PASSWORD = "bench"
+TREE_DEPTH = 12
+DEFAULT_MIX = "login=1,list=4,read=4,write=2,cd=1"
+ERROR_REPLIES = (RATE_LIMITED, SERVER_BUSY, SERVER_FULL, LOGIN_REQUIRED, QUOTA_EXCEEDED,
+                 READ_WRONG_PATH, INCORRECT_DIRECTORY, "Invalid command")
+
+class ReplyError(Exception):
+    """
+    Server answered an operation with an error, busy or throttled reply.
+    """
+
+class BenchClient():
+    """
+    Simulated client module
+
+    Attributes:
+    -----------------
+        number : int
+            Client number, names its write_file target.
+
+        port : int
+            Server port.
+
+        conn : Socket class
+            Logged in framed connection.
+
+        latencies : dict{op:list(float)}
+            Seconds per request of every operation.
+
+        errors : int
+            Failed operations, error and throttled replies included.
+
+    Methods:
+    -----------------
+        connect():
+            Open a framed connection and log in.
+
+        request(command):
+            One round trip.
+
+        run(mix, deadline):
+            Run operations until the deadline.
+    """
+
+    def __init__(self, number, port):
+        """
+        Initialize the attributes.
+        """
+        self.number = number
+        self.port = port
+        self.conn = None
+        self.latencies = {}
+        self.errors = 0
+
+    def connect(self):
+        """
+        Open a framed connection and log in.
+
+        Return: Class(Socket)
+            Connection.
+        """
+        conn = socket.create_connection(("127.0.0.1", self.port))
+        conn.send(handshake())
+        if not negotiate(recv_message(conn)[1]):
+            raise ConnectionError("Server refused the framed protocol")
+        send_message(conn, str.encode("login " + USER + " " + PASSWORD))
+        response = str(recv_message(conn)[1], "utf-8")
+        if not response.startswith(LOGIN_TRUE):
+            conn.close()
+            raise ReplyError(response)
+        return conn
+
+    def request(self, command):
+        """
+        Send a command and wait for its response.
+
+        Parameters:
+            command : str
+
+        Return: str
+            Response, raises ReplyError for error replies.
+        """
+        send_message(self.conn, str.encode(command))
+        response = str(recv_message(self.conn)[1], "utf-8")
+        if response.startswith(ERROR_REPLIES):
+            raise ReplyError(response)
+        return response
+
+    def operation(self, name):
+        """
+        Run one operation of the mix.
+
+        Parameters:
+            name : str
+        """
+        if name == "login":
+            self.connect().close()
+        elif name == "list":
+            self.request("list")
+        elif name == "read":
+            self.request("read_file big.txt")
+        elif name == "write":
+            self.request("write_file client" + str(self.number) + ".txt benchmark payload line")
+        elif name == "cd":
+            self.request("change_folder " + "/".join("d" + str(depth) for depth in range(TREE_DEPTH)))
+            self.request("change_folder " + "/".join([".."] * TREE_DEPTH))
+
+    def run(self, mix, deadline):
+        """
+        Run weighted random operations until the deadline.
+
+        Parameters:
+            mix : dict{op:weight}
+            deadline : float
+                time.monotonic() to stop at.
+        """
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        try:
+            self.conn = self.connect()
+        except (OSError, ReplyError):
+            self.errors += 1
+            return
+        while time.monotonic() < deadline:
+            name = random.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                self.operation(name)
+            except ReplyError:
+                self.errors += 1
+                continue
+            except OSError:
+                self.errors += 1
+                try:
+                    self.conn = self.connect()
+                except (OSError, ReplyError):
+                    return
+                continue
+            self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        self.conn.close()
+
+
+def parse_mix(text):
+    """
+    Parse a command mix.
+
+    Parameters:
+        text : str
+            "op=weight,op=weight".
+
+    Return: dict{op:weight}
+        Weights per operation.
+    """
+    mix = {}
+    for item in text.split(","):
+        name, weight = item.split("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+def prepare_session(root, clients):
+    """
+    Create a session directory with the bench user, a deep tree and a large file.
+
+    Parameters:
+        root : str
+        clients : int
+    """
+    session = os.path.join(root, "server_session")
+    user_path = os.path.join(session, USER)
+    os.makedirs(os.path.join(user_path, *("d" + str(depth) for depth in range(TREE_DEPTH))))
+    with open(os.path.join(session, "server_data"), "w") as file:
+        json.dump({"passwords":[{USER:PASSWORD}], "privileges":[{USER:"admin"}]}, file)
+    with open(os.path.join(user_path, "big.txt"), "w") as file:
+        for line in range(200000):
+            file.write("benchmark line " + str(line) + "\n")
+    for number in range(clients):
+        with open(os.path.join(user_path, "client" + str(number) + ".txt"), "w") as file:
+            file.write("start")
+
+def free_port(count=1):
+    """
+    Local port free to listen on, with the count - 1 ports after it free too.
+
+    Parameters:
+        count : int
+            Ports needed in a row, one metrics port per pre-forked worker.
+
+    Return: int
+        First port.
+    """
+    while True:
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        if port + count > 65536:
+            continue
+        try:
+            for offset in range(count):
+                with socket.socket() as probe:
+                    probe.bind(("127.0.0.1", port + offset))
+        except OSError:
+            continue
+        return port
+
+def start_server(root, engine, port, processes=1):
+    """
+    Start the server in a subprocess on a port and wait until every worker
+    serves, the metrics port of a worker opens right before its session runs.
+
+    Parameters:
+        root : str
+        engine : str
+        port : int
+        processes : int
+            Pre-forked worker processes.
+
+    Return: subprocess.Popen
+        Server process.
+    """
+    env = dict(os.environ)
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = package_parent + os.pathsep + env.get("PYTHONPATH", "")
+    # Rate limits off, the benchmark measures the server, not its throttling.
+    metrics_port = free_port(processes)
+    server = subprocess.Popen([sys.executable, "-m", PACKAGE + ".run_server", engine, str(processes),
+                               "--port", str(port), "--metrics-port", str(metrics_port),
+                               "--connection-rate", "0", "--user-rate", "0"],
+                              cwd=root, env=env, stdout=subprocess.DEVNULL)
+    waiting = [port] + [metrics_port + slot for slot in range(processes)]
+    for _ in range(100):
+        # A server that died, say on a port in use, must not pass for another one listening there.
+        if server.poll() is not None:
+            raise RuntimeError("Server exited with code " + str(server.returncode))
+        try:
+            while waiting:
+                socket.create_connection(("127.0.0.1", waiting[0]), timeout=1).close()
+                waiting.pop(0)
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    server.wait()
+    raise RuntimeError("Server did not start")
+
+def process_usage(pid):
+    """
+    CPU seconds and peak RSS of a process and its pre-forked workers, read from /proc.
+
+    Parameters:
+        pid : int
+
+    Return: tuple(float, int) or None
+        CPU seconds and summed peak RSS in KiB, None off Linux.
+    """
+    try:
+        with open("/proc/" + str(pid) + "/task/" + str(pid) + "/children") as file:
+            pids = [pid] + [int(child) for child in file.read().split()]
+        cpu = 0.0
+        rss = 0
+        for process in pids:
+            with open("/proc/" + str(process) + "/stat") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+            with open("/proc/" + str(process) + "/status") as file:
+                rss += int([line for line in file if line.startswith("VmHWM")][0].split()[1])
+        return cpu, rss
+    except (OSError, IndexError, ValueError):
+        return None
+
+def percentiles(latencies):
+    """
+    Latency summary of one operation.
+
+    Parameters:
+        latencies : list(float)
+
+    Return: dict
+        Count and p50/p95/p99/max in milliseconds.
+    """
+    latencies = sorted(latencies)
+    def pick(fraction):
+        return round(latencies[min(int(fraction * len(latencies)), len(latencies) - 1)] * 1000, 3)
+    return {"count": len(latencies), "p50_ms": pick(0.5), "p95_ms": pick(0.95),
+            "p99_ms": pick(0.99), "max_ms": round(latencies[-1] * 1000, 3)}
+
+def run_benchmark(engine, clients, duration, mix, port=None, processes=1):
+    """
+    Run one benchmark.
+
+    Parameters:
+        engine : str
+        clients : int
+        duration : float
+        mix : dict{op:weight}
+        port : int
+            Server port, a free one when missing.
+        processes : int
+
+    Return: dict
+        Results.
+    """
+    port = port or free_port()
+    root = tempfile.mkdtemp(prefix="kvn-bench-")
+    try:
+        prepare_session(root, clients)
+        server = start_server(root, engine, port, processes)
+        try:
+            usage_before = process_usage(server.pid)
+            bench_clients = [BenchClient(number, port) for number in range(clients)]
+            deadline = time.monotonic() + duration
+            started = time.monotonic()
+            threads = [threading.Thread(target=client.run, args=(mix, deadline))
+                       for client in bench_clients]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - started
+            usage_after = process_usage(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    latencies = {}
+    for client in bench_clients:
+        for name, values in client.latencies.items():
+            latencies.setdefault(name, []).extend(values)
+    requests = sum(len(values) for values in latencies.values())
+    results = {
+        "engine": engine,
+        "processes": processes,
+        "clients": clients,
+        "duration_s": round(elapsed, 3),
+        "mix": mix,
+        "operations": requests,
+        "errors": sum(client.errors for client in bench_clients),
+        "ops_per_s": round(requests / elapsed, 1),
+        "latency": {name: percentiles(values) for name, values in latencies.items()},
+        "server": None,
+    }
+    if usage_before and usage_after:
+        cpu = usage_after[0] - usage_before[0]
+        results["server"] = {"cpu_s": round(cpu, 2), "cpu_percent": round(100 * cpu / elapsed, 1),
+                             "peak_rss_kib": usage_after[1]}
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Regressions of results against a baseline.
+
+    Parameters:
+        results : dict
+        baseline : dict
+        tolerance : float
+            Allowed relative slowdown, 0.1 for 10%.
+
+    Return: list(str)
+        Regressions found.
+    """
+    regressions = []
+    if results["ops_per_s"] < baseline["ops_per_s"] * (1 - tolerance):
+        regressions.append("ops_per_s " + str(baseline["ops_per_s"]) + " -> " + str(results["ops_per_s"]))
+    for name, latency in results["latency"].items():
+        before = baseline["latency"].get(name)
+        if before and latency["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            regressions.append(name + " p99_ms " + str(before["p99_ms"]) + " -> " + str(latency["p99_ms"]))
+    return regressions
+
+def main():
+    """
+    Run the benchmark from the command line.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the KVN server.")
+    parser.add_argument("--engine", default="thread", help="thread or asyncio")
+    parser.add_argument("--processes", type=int, default=1, help="pre-forked server processes")
+    parser.add_argument("--port", type=int, help="server port, a free one when missing")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="op=weight list of login, list, read, write, cd")
+    parser.add_argument("--output", help="save results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    results = run_benchmark(args.engine, args.clients, args.duration, parse_mix(args.mix),
+                            port=args.port, processes=args.processes)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Content addressed blob store deduplicating file bodies across users.
+
+In dedup mode every finished file is hashed and hard linked to its blob
+".blobs/<sha256[:2]>/<sha256>" of the session root, so identical files of any
+user share one body on disk. The link count of a blob is its reference
+count plus one, user paths stay ordinary files and every command reads
+them unchanged.
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from os.path import join
+
+from .protocol import FRAME_SIZE
+from .config import session_path
+
+STORE = None
+STORE_LOCK = threading.Lock()
+
+class BlobStore():
+    """
+    Blob store module
+
+    Attributes:
+    -----------------
+        root : str
+            Directory of the blobs.
+
+    Methods:
+    -----------------
+        blob_path(checksum):
+            Path of a blob.
+
+        intern(path, checksum):
+            Replace a file by a link to its blob.
+
+        detach(path):
+            Give a file its own body before it is changed in place.
+
+        collect():
+            Remove blobs nobody links to.
+
+        report():
+            Blob count and space saved.
+    """
+
+    def __init__(self, root=None):
+        """
+        Initialize the attributes, root defaults to .blobs in the session root.
+        """
+        self.root = root or session_path(".blobs")
+        os.makedirs(self.root, exist_ok=True)
+
+    def blob_path(self, checksum):
+        """
+        Path of a blob.
+
+        Parameters:
+            checksum : str
+                sha256 hex digest of the body.
+
+        Return: str
+            Blob path.
+        """
+        return join(self.root, checksum[:2], checksum)
+
+    def intern(self, path, checksum=None):
+        """
+        Replace a file by a link to the blob of its body, making the blob if it is new.
+
+        Parameters:
+            path : str
+            checksum : str
+                sha256 of the file when already known.
+
+        Return: int
+            Bytes saved, the size of the file if the blob existed.
+        """
+        if checksum is None:
+            digest = hashlib.sha256()
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(FRAME_SIZE), b""):
+                    digest.update(chunk)
+            checksum = digest.hexdigest()
+        blob = self.blob_path(checksum)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(path, blob)
+            return 0
+        except FileExistsError:
+            pass
+        if os.path.samefile(path, blob):
+            return 0
+        temp_path = path + "." + uuid.uuid4().hex + ".link"
+        os.link(blob, temp_path)
+        os.replace(temp_path, path)
+        return os.path.getsize(blob)
+
+    def detach(self, path):
+        """
+        Copy a shared file to a body of its own so it can be changed in place.
+
+        Parameters:
+            path : str
+        """
+        if os.stat(path).st_nlink < 2:
+            return
+        temp_path = path + "." + uuid.uuid4().hex + ".copy"
+        shutil.copyfile(path, temp_path)
+        os.replace(temp_path, path)
+
+    def collect(self):
+        """
+        Remove blobs no user file links to anymore.
+
+        Return: int
+            Blobs removed.
+        """
+        removed = 0
+        for folder, _, blobs in os.walk(self.root):
+            for name in blobs:
+                blob = join(folder, name)
+                try:
+                    if os.stat(blob).st_nlink == 1:
+                        os.remove(blob)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def report(self):
+        """
+        Blobs stored and the space deduplication saves.
+
+        Return: tuple(int, int, int)
+            Blob count, bytes on disk and bytes saved.
+        """
+        blobs = stored = saved = 0
+        for folder, _, names in os.walk(self.root):
+            for name in names:
+                try:
+                    stat = os.stat(join(folder, name))
+                except FileNotFoundError:
+                    continue
+                blobs += 1
+                stored += stat.st_size
+                saved += stat.st_size * max(stat.st_nlink - 2, 0)
+        return blobs, stored, saved
+
+
+def enable_blob_store(root=None):
+    """
+    Turn dedup mode on for the process.
+
+    Parameters:
+        root : str
+
+    Return: Class(BlobStore)
+        Blob store.
+    """
+    global STORE
+    with STORE_LOCK:
+        if STORE is None:
+            STORE = BlobStore(root)
+        return STORE
+
+def get_blob_store():
+    """
+    Blob store of the process.
+
+    Return: Class(BlobStore) or None
+        Blob store, None unless dedup mode is on.
+    """
+    return STORE
@@ -0,0 +1,182 @@
+"""
+Chunk index to page through files by seeking instead of reading them whole.
+"""
+
+import codecs
+import os
+import threading
+from array import array
+from collections import OrderedDict
+
+STRIDE = 64
+BLOCK_SIZE = 1 << 20
+MAX_INDEXES = 1024
+
+INDEXES = OrderedDict()
+INDEX_LOCK = threading.Lock()
+
+class ChunkIndex():
+    """
+    Chunk index module
+
+    Maps page numbers of a UTF-8 file to byte offsets. Only every STRIDE-th
+    page gets a checkpoint, so the index of a multi-GB file stays small and
+    a page read seeks to its checkpoint and decodes at most STRIDE pages.
+
+    Attributes:
+    -----------------
+        path : str
+            Indexed file.
+
+        page_size : int
+            Characters per page.
+
+        checkpoints : array('Q')
+            Byte offset of page k * STRIDE at position k.
+
+        chars : int
+            Characters in the file.
+
+        stamp : tuple(mtime_ns, size)
+            File state the index was built for.
+
+        appended : bool
+            File was only appended to since the index was built.
+
+        lock : threading.Lock
+            Guards the index.
+
+    Methods:
+    -----------------
+        refresh():
+            Rebuild or extend the index if the file changed.
+
+        scan(checkpoint):
+            Index the file from a checkpoint on.
+
+        pages():
+            Number of pages.
+
+        read(page):
+            Read a page.
+    """
+
+    def __init__(self, path, page_size):
+        """
+        Initialize the attributes.
+        """
+        self.path = path
+        self.page_size = page_size
+        self.checkpoints = array("Q", [0])
+        self.chars = 0
+        self.stamp = None
+        self.appended = False
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Bring the index up to date with the file.
+        """
+        with self.lock:
+            stat = os.stat(self.path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            if stamp == self.stamp:
+                return
+            if self.appended and self.stamp and stamp[1] >= self.stamp[1]:
+                self.scan(len(self.checkpoints) - 1)
+            else:
+                self.scan(0)
+            self.stamp = stamp
+            self.appended = False
+
+    def scan(self, checkpoint):
+        """
+        Index the file from a checkpoint to its end.
+
+        Parameters:
+            checkpoint : int
+        """
+        span = STRIDE * self.page_size
+        del self.checkpoints[checkpoint + 1:]
+        offset = self.checkpoints[checkpoint]
+        chars = checkpoint * span
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            while True:
+                block = file.read(BLOCK_SIZE)
+                text = decoder.decode(block, final=not block)
+                start = 0
+                next_checkpoint = len(self.checkpoints) * span
+                while next_checkpoint < chars + len(text):
+                    end = next_checkpoint - chars
+                    offset += len(text[start:end].encode("utf-8"))
+                    self.checkpoints.append(offset)
+                    start = end
+                    next_checkpoint += span
+                offset += len(text[start:].encode("utf-8"))
+                chars += len(text)
+                if not block:
+                    break
+        self.chars = chars
+
+    def pages(self):
+        """
+        Number of pages in the file.
+
+        Return: int
+            Pages, an empty file has one empty page.
+        """
+        return self.chars // self.page_size + 1
+
+    def read(self, page):
+        """
+        Read a page by seeking to its checkpoint.
+
+        Parameters:
+            page : int
+
+        Return: str
+            Characters of the page.
+        """
+        checkpoint, rest = divmod(page, STRIDE)
+        skip = rest * self.page_size
+        with open(self.path, "rb") as file:
+            file.seek(self.checkpoints[checkpoint])
+            data = file.read((skip + self.page_size) * 4)
+        text = codecs.getincrementaldecoder("utf-8")().decode(data)
+        return text[skip:skip + self.page_size]
+
+
+def get_index(path, page_size):
+    """
+    Up to date chunk index of a file, shared by every handler.
+
+    Parameters:
+        path : str
+        page_size : int
+
+    Return: Class(ChunkIndex)
+        Chunk index.
+    """
+    with INDEX_LOCK:
+        index = INDEXES.pop((path, page_size), None)
+        if index is None:
+            index = ChunkIndex(path, page_size)
+        INDEXES[(path, page_size)] = index
+        if len(INDEXES) > MAX_INDEXES:
+            INDEXES.popitem(last=False)
+    index.refresh()
+    return index
+
+def note_append(path):
+    """
+    Let the indexes of path extend instead of rebuilding after an append.
+
+    Parameters:
+        path : str
+    """
+    with INDEX_LOCK:
+        for (index_path, _), index in INDEXES.items():
+            if index_path == path:
+                index.appended = True
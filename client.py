@@ -0,0 +1,515 @@
+"""
+Client library with blocking and asyncio connection pools.
+
+A pool keeps logged in framed connections per user and hands them out
+for a request, so services pay the connect, handshake and login once per
+connection instead of once per operation:
+
+    pool = ClientPool("127.0.0.1")
+    pool.request("test", "123", "list")
+    pool.pipeline("test", "123", ["change_folder docs", "read_file a.txt"])
+
+    pool = AsyncClientPool("127.0.0.1")
+    await asyncio.gather(*(pool.request("test", "123", "list") for _ in range(100)))
+
+Connections ask for zlib compression of large responses.
+
+A request over the server's rate limits is not run, it comes back as a
+RATE_LIMITED response, and retry_after(response) tells when to send again.
+
+A pooled connection keeps its present directory and read cursors between
+checkouts, so change folders with paths relative to where they were left.
+
+A broken connection is reopened with exponential backoff, resuming its
+session token so the folder and read cursors survive, and the request is
+sent again. A request is therefore retried when the connection broke after
+the server ran it, keep retries=0 where running a command twice matters.
+"""
+
+import asyncio
+import socket
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+
+from .protocol import handshake, negotiate, send_message, recv_message
+from .protocol import read_message, write_message, FLAG_FILE, FEATURES
+from .templates import LOGIN_TRUE, RATE_LIMITED, session_token, resume_success
+
+MAX_BACKOFF = 5
+
+class LoginError(Exception):
+    """
+    Server refused the login of a pooled connection.
+    """
+
+
+def token_of(response):
+    """
+    Session token of a login response.
+
+    Parameters:
+        response : str
+
+    Return: str or None
+        Token, None if the login failed.
+    """
+    if not response.startswith(LOGIN_TRUE + session_token("")):
+        return None
+    return response[len(LOGIN_TRUE + session_token("")):].strip()
+
+def retry_after(response):
+    """
+    Delay asked for by a rate limited response.
+
+    Parameters:
+        response : str
+
+    Return: float or None
+        Seconds to wait, None if the request was not rate limited.
+    """
+    if not response.startswith(RATE_LIMITED):
+        return None
+    return float(response[len(RATE_LIMITED):].split(" ")[0])
+
+def backoff_delay(backoff, attempt):
+    """
+    Seconds to wait before a reconnect.
+
+    Parameters:
+        backoff : float
+        attempt : int
+
+    Return: float
+        Delay doubling per attempt, capped at MAX_BACKOFF.
+    """
+    return min(backoff * 2 ** attempt, MAX_BACKOFF)
+
+
+class Connection():
+    """
+    Connection module
+
+    One logged in framed connection.
+
+    Attributes:
+    -----------------
+        address : tuple(host, port)
+            Server address.
+
+        user, password : str
+            Credentials used to log in.
+
+        timeout : float
+            Seconds to wait on connect and on every response.
+
+        retries : int
+            Reconnects tried before a request fails.
+
+        backoff : float
+            Delay before the first reconnect, doubled for every next one.
+
+        conn : Socket class
+            Open socket, None when closed.
+
+        token : str
+            Session token, resumed after a reconnect.
+
+    Methods:
+    -----------------
+        open():
+            Connect and log in or resume.
+
+        request(command):
+            One round trip.
+
+        pipeline(commands):
+            Send commands back to back and read every response.
+
+        close():
+            Close the socket.
+    """
+
+    def __init__(self, host, port, user, password, timeout=10, retries=3, backoff=0.1):
+        """
+        Initialize the attributes.
+        """
+        self.address = (host, port)
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.conn = None
+        self.token = None
+
+    def open(self):
+        """
+        Connect, then resume the session or log in.
+        """
+        self.conn = socket.create_connection(self.address, timeout=self.timeout)
+        self.conn.send(handshake(features=FEATURES))
+        if not negotiate(recv_message(self.conn)[1]):
+            self.close()
+            raise ConnectionError("Server does not speak the framed protocol")
+        if self.token and self.exchange(["resume " + self.token])[0] == resume_success(self.user):
+            return
+        self.token = token_of(self.exchange(["login " + self.user + " " + self.password])[0])
+        if self.token is None:
+            self.close()
+            raise LoginError("Login refused for " + self.user)
+
+    def exchange(self, commands):
+        """
+        Send commands and read their responses on the open socket.
+
+        Parameters:
+            commands : list(str)
+
+        Return: list(str)
+            Responses in order.
+        """
+        for command in commands:
+            send_message(self.conn, str.encode(command))
+        responses = []
+        for _ in commands:
+            flags, response = recv_message(self.conn)
+            if flags & FLAG_FILE:
+                self.close()
+                raise ValueError("Transfers are not supported by the pooled client")
+            responses.append(str(response, "utf-8"))
+        return responses
+
+    def pipeline(self, commands):
+        """
+        Send commands back to back and read every response, reconnecting on failure.
+
+        Parameters:
+            commands : list(str)
+
+        Return: list(str)
+            Responses in order.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                if self.conn is None:
+                    self.open()
+                return self.exchange(commands)
+            except OSError:
+                self.close()
+                if attempt == self.retries:
+                    raise
+                time.sleep(backoff_delay(self.backoff, attempt))
+
+    def request(self, command):
+        """
+        One round trip.
+
+        Parameters:
+            command : str
+
+        Return: str
+            Response.
+        """
+        return self.pipeline([command])[0]
+
+    def close(self):
+        """
+        Close the socket, the session token is kept for the next open.
+        """
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class AsyncConnection(Connection):
+    """
+    Async connection module
+
+    Connection on asyncio streams, same attributes with reader and writer
+    in place of conn.
+    """
+
+    def __init__(self, host, port, user, password, timeout=10, retries=3, backoff=0.1):
+        """
+        Initialize the attributes.
+        """
+        super().__init__(host, port, user, password, timeout, retries, backoff)
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        """
+        Connect, then resume the session or log in.
+        """
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(*self.address), self.timeout)
+        self.conn = self.writer
+        self.writer.write(handshake(features=FEATURES))
+        if not negotiate((await asyncio.wait_for(read_message(self.reader), self.timeout))[1]):
+            self.close()
+            raise ConnectionError("Server does not speak the framed protocol")
+        if self.token and (await self.exchange(["resume " + self.token]))[0] == resume_success(self.user):
+            return
+        self.token = token_of((await self.exchange(["login " + self.user + " " + self.password]))[0])
+        if self.token is None:
+            self.close()
+            raise LoginError("Login refused for " + self.user)
+
+    async def exchange(self, commands):
+        """
+        Send commands and read their responses on the open stream.
+
+        Parameters:
+            commands : list(str)
+
+        Return: list(str)
+            Responses in order.
+        """
+        for command in commands:
+            write_message(self.writer, str.encode(command))
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+        responses = []
+        for _ in commands:
+            flags, response = await asyncio.wait_for(read_message(self.reader), self.timeout)
+            if flags & FLAG_FILE:
+                self.close()
+                raise ValueError("Transfers are not supported by the pooled client")
+            responses.append(str(response, "utf-8"))
+        return responses
+
+    async def pipeline(self, commands):
+        """
+        Send commands back to back and read every response, reconnecting on failure.
+
+        Parameters:
+            commands : list(str)
+
+        Return: list(str)
+            Responses in order.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                if self.conn is None:
+                    await self.open()
+                return await self.exchange(commands)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                self.close()
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(backoff_delay(self.backoff, attempt))
+
+    async def request(self, command):
+        """
+        One round trip.
+
+        Parameters:
+            command : str
+
+        Return: str
+            Response.
+        """
+        return (await self.pipeline([command]))[0]
+
+    def close(self):
+        """
+        Close the stream, the session token is kept for the next open.
+        """
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = self.reader = self.conn = None
+
+
+class ClientPool():
+    """
+    Client pool module
+
+    Attributes:
+    -----------------
+        host : str
+        port : int
+
+        size : int
+            Connections per user at most, checkouts beyond wait.
+
+        options : dict
+            timeout, retries and backoff of new connections.
+
+        idle : dict{(user, password):list(Connection)}
+            Connections ready for a checkout.
+
+        slots : dict{(user, password):Semaphore}
+            Connections left to hand out per user.
+
+        lock : threading.Lock
+            Guards idle and slots.
+
+    Methods:
+    -----------------
+        connection(user, password):
+            Check a logged in connection out.
+
+        request(user, password, command):
+            One command on a pooled connection.
+
+        pipeline(user, password, commands):
+            Commands pipelined on a pooled connection.
+
+        close():
+            Close idle connections.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8080, size=8, timeout=10, retries=3, backoff=0.1):
+        """
+        Initialize the attributes.
+        """
+        self.host = host
+        self.port = port
+        self.size = size
+        self.options = {"timeout": timeout, "retries": retries, "backoff": backoff}
+        self.idle = {}
+        self.slots = {}
+        self.lock = threading.Lock()
+
+    def slot(self, key):
+        """
+        Semaphore of a user, made on first use.
+        """
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.size)
+                self.idle[key] = []
+            return self.slots[key]
+
+    @contextmanager
+    def connection(self, user, password):
+        """
+        Check out a connection of the user, logged in on first use.
+
+        Parameters:
+            user : str
+            password : str
+
+        Return: Class(Connection)
+            Connection, returned to the pool afterwards unless it broke.
+        """
+        key = (user, password)
+        slot = self.slot(key)
+        slot.acquire()
+        with self.lock:
+            conn = self.idle[key].pop() if self.idle[key] else None
+        if conn is None:
+            conn = Connection(self.host, self.port, user, password, **self.options)
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        finally:
+            if conn.conn is not None:
+                with self.lock:
+                    self.idle[key].append(conn)
+            slot.release()
+
+    def request(self, user, password, command):
+        """
+        One command on a pooled connection.
+
+        Return: str
+            Response.
+        """
+        with self.connection(user, password) as conn:
+            return conn.request(command)
+
+    def pipeline(self, user, password, commands):
+        """
+        Commands pipelined on a pooled connection.
+
+        Return: list(str)
+            Responses in order.
+        """
+        with self.connection(user, password) as conn:
+            return conn.pipeline(commands)
+
+    def close(self):
+        """
+        Close every idle connection.
+        """
+        with self.lock:
+            for connections in self.idle.values():
+                for conn in connections:
+                    conn.close()
+                connections.clear()
+
+
+class AsyncClientPool(ClientPool):
+    """
+    Async client pool module
+
+    ClientPool for asyncio, slots are asyncio semaphores and connections
+    are AsyncConnection. Use it from one event loop.
+    """
+
+    def slot(self, key):
+        """
+        Semaphore of a user, made on first use.
+        """
+        if key not in self.slots:
+            self.slots[key] = asyncio.Semaphore(self.size)
+            self.idle[key] = []
+        return self.slots[key]
+
+    @asynccontextmanager
+    async def connection(self, user, password):
+        """
+        Check out a connection of the user, logged in on first use.
+
+        Parameters:
+            user : str
+            password : str
+
+        Return: Class(AsyncConnection)
+            Connection, returned to the pool afterwards unless it broke.
+        """
+        key = (user, password)
+        async with self.slot(key):
+            conn = self.idle[key].pop() if self.idle[key] else None
+            if conn is None:
+                conn = AsyncConnection(self.host, self.port, user, password, **self.options)
+            try:
+                yield conn
+            except BaseException:
+                conn.close()
+                raise
+            finally:
+                if conn.conn is not None:
+                    self.idle[key].append(conn)
+
+    async def request(self, user, password, command):
+        """
+        One command on a pooled connection.
+
+        Return: str
+            Response.
+        """
+        async with self.connection(user, password) as conn:
+            return await conn.request(command)
+
+    async def pipeline(self, user, password, commands):
+        """
+        Commands pipelined on a pooled connection.
+
+        Return: list(str)
+            Responses in order.
+        """
+        async with self.connection(user, password) as conn:
+            return await conn.pipeline(commands)
+
+    def close(self):
+        """
+        Close every idle connection.
+        """
+        for connections in self.idle.values():
+            for conn in connections:
+                conn.close()
+            connections.clear()
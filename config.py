@@ -0,0 +1,205 @@
+"""
+Server settings from defaults, a config file, the environment and the command line.
+
+Later sources win: a JSON config file ("kvn.json" in the working directory,
+or the path of --config or KVN_CONFIG), then KVN_<NAME> environment
+variables, then --<name> <value> options. The legacy positional arguments
+"engine processes dedup" of run_server still work.
+
+    python -m KVN.run_server --port 9000 --backlog 1024 --workers 32
+    KVN_SESSION_ROOT=/srv/kvn python -m KVN.run_server asyncio 4
+"""
+
+import json
+import os
+import threading
+from os.path import join
+
+CONFIG_FILE = "kvn.json"
+ENV_PREFIX = "KVN_"
+DEFAULTS = {
+    "host": "",
+    "port": 8080,
+    "backlog": 128,
+    "recv_size": 4096,
+    "send_buffer": 0,
+    "recv_buffer": 0,
+    "tcp_nodelay": False,
+    "engine": "thread",
+    "processes": 1,
+    "workers": 8,
+    "queue_size": 64,
+    "max_connections": 1024,
+    "idle_timeout": 300.0,
+    "read_timeout": 30.0,
+    "metrics_port": 9100,
+    "dedup": False,
+    "connection_rate": 50.0,
+    "connection_burst": 100.0,
+    "user_rate": 200.0,
+    "user_burst": 400.0,
+    "page_size": 100,
+    "session_root": "server_session",
+    "storage": "fs",
+    "storage_path": "",
+}
+POSITIONAL = ("engine", "processes", "dedup")
+# Keys of server.ENGINES and storage.BACKENDS, named here since both import this module.
+CHOICES = {"engine": ("thread", "asyncio"), "storage": ("fs", "memory", "sqlite")}
+TRUE_WORDS = ("1", "true", "yes", "on")
+FALSE_WORDS = ("0", "false", "no", "off")
+# Read through get_setting and session_path rather than passed to Server.
+PROCESS_SETTINGS = ("processes", "page_size", "session_root")
+
+SETTINGS = dict(DEFAULTS)
+SETTINGS_LOCK = threading.Lock()
+
+def coerce(name, value):
+    """
+    Convert a setting to the type of its default.
+
+    Parameters:
+        name : str
+        value : str, int, float or bool
+
+    Return: value of the type of DEFAULTS[name]
+    """
+    if name not in DEFAULTS:
+        raise ValueError("Unknown setting " + name)
+    kind = type(DEFAULTS[name])
+    if kind is bool and isinstance(value, str):
+        if value.lower() not in TRUE_WORDS + FALSE_WORDS:
+            raise ValueError("Setting " + name + " must be true or false, not " + value)
+        return value.lower() in TRUE_WORDS
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        raise ValueError("Setting " + name + " must be " + kind.__name__ + ", not " + str(value))
+
+def parse_arguments(argv):
+    """
+    Settings of command line arguments.
+
+    Parameters:
+        argv : list(str)
+            --name value, --name=value, --flag and --no-flag for booleans,
+            or the legacy positionals engine, processes, dedup. A boolean
+            flag takes a true or false word after it as its value.
+
+    Return: tuple(dict, str)
+        Settings and the --config path, None without one.
+    """
+    settings = {}
+    config_path = None
+    positional = list(POSITIONAL)
+    arguments = list(argv)
+    while arguments:
+        argument = arguments.pop(0)
+        if not argument.startswith("--"):
+            if not positional:
+                raise ValueError("Unexpected argument " + argument)
+            name = positional.pop(0)
+            # The old run_server took the word dedup, anything else meant off.
+            settings[name] = argument == "dedup" if name == "dedup" else coerce(name, argument)
+            continue
+        name, _, value = argument[2:].partition("=")
+        name = name.replace("-", "_")
+        if name.startswith("no_") and name[3:] in DEFAULTS and isinstance(DEFAULTS[name[3:]], bool):
+            settings[name[3:]] = False
+            continue
+        if name in DEFAULTS and isinstance(DEFAULTS[name], bool) and not value:
+            # Words only, a digit after the flag may be the processes positional.
+            if arguments and arguments[0].lower() in TRUE_WORDS[1:] + FALSE_WORDS[1:]:
+                value = arguments.pop(0)
+            else:
+                settings[name] = True
+                continue
+        if not value:
+            if not arguments:
+                raise ValueError("Missing value of --" + name)
+            value = arguments.pop(0)
+        if name == "config":
+            config_path = value
+            continue
+        settings[name] = coerce(name, value)
+    return settings, config_path
+
+def load_config(argv=(), environ=None):
+    """
+    Settings from defaults, config file, environment and command line.
+
+    Parameters:
+        argv : list(str)
+            Command line arguments after the program.
+        environ : dict
+            Environment, os.environ when missing.
+
+    Return: dict
+        Every setting of DEFAULTS.
+    """
+    environ = os.environ if environ is None else environ
+    arguments, config_path = parse_arguments(argv)
+    config_path = config_path or environ.get(ENV_PREFIX + "CONFIG")
+    settings = dict(DEFAULTS)
+    if config_path or os.path.isfile(CONFIG_FILE):
+        with open(config_path or CONFIG_FILE) as file:
+            for name, value in json.load(file).items():
+                settings[name] = coerce(name, value)
+    for name in DEFAULTS:
+        if ENV_PREFIX + name.upper() in environ:
+            settings[name] = coerce(name, environ[ENV_PREFIX + name.upper()])
+    settings.update(arguments)
+    for name in ("port", "backlog", "recv_size", "processes", "workers", "queue_size",
+                 "max_connections", "page_size"):
+        if settings[name] < 1:
+            raise ValueError("Setting " + name + " must be at least 1")
+    for name, choices in CHOICES.items():
+        if settings[name] not in choices:
+            raise ValueError("Setting " + name + " must be one of " + ", ".join(choices) + ", not " +
+                             settings[name])
+    return settings
+
+def configure(settings):
+    """
+    Make settings the ones of the process.
+
+    Parameters:
+        settings : dict
+    """
+    with SETTINGS_LOCK:
+        SETTINGS.update(settings)
+
+def server_options(settings):
+    """
+    Keyword arguments of Server out of settings.
+
+    Parameters:
+        settings : dict
+
+    Return: dict
+        Settings Server takes, the process wide ones left out.
+    """
+    return {name: value for name, value in settings.items() if name not in PROCESS_SETTINGS}
+
+def get_setting(name):
+    """
+    Setting of the process.
+
+    Parameters:
+        name : str
+
+    Return: value of the setting
+    """
+    return SETTINGS[name]
+
+def session_path(*parts):
+    """
+    Path inside the session storage root.
+
+    Parameters:
+        parts : str
+
+    Return: str
+        Joined path.
+    """
+    return join(SETTINGS["session_root"], *parts)
@@ -0,0 +1,332 @@
+"""
+Per user directory index so folder checks and listings skip rescanning the disk.
+"""
+
+import os
+import threading
+from os.path import join, normpath, isabs
+
+from .storage import get_storage
+
+INDEXES = {}
+INDEX_LOCK = threading.Lock()
+
+class DirectoryNode():
+    """
+    Directory node module
+
+    Attributes:
+    -----------------
+        children : dict{name:DirectoryNode or None}
+            Entries of the directory, None for files, in listing order.
+
+        stats : dict{name:tuple(size, mtime_ns)}
+            Cached metadata of the entries, missing until first needed or after a change.
+
+        scanned : bool
+            Children were read from disk.
+    """
+
+    def __init__(self):
+        """
+        Initialize the attributes.
+        """
+        self.children = {}
+        self.stats = {}
+        self.scanned = False
+
+
+class DirectoryIndex():
+    """
+    Directory index module
+
+    Mirrors the tree of one user. A directory is scanned once, the first
+    time it is looked at, after that create_folder, write_file, upload and
+    user deletion keep it current, so a lookup costs one dict access per
+    path component instead of a walk over the tree. Changes made behind the
+    server's back show up after drop_directory_index. Size and mtime of
+    entries are cached the same way for tree listings, a change drops the
+    cached stat of the entry and of its parent folder, so a repeated listing
+    only stats what was written since.
+
+    The index is per process, under prefork a worker does not see files and
+    folders the other workers created, so listings can lag behind. write_file
+    and create_folder ask the backend before creating anything the index
+    doesn't know, so a stale index never truncates another worker's file.
+
+    Attributes:
+    -----------------
+        root_path : str
+            Directory of the user in the storage backend.
+
+        storage : Class(Storage)
+            Backend holding the tree.
+
+        root : Class(DirectoryNode)
+            Node of the user directory.
+
+        lock : threading.Lock
+            Guards the tree.
+
+    Methods:
+    -----------------
+        split(present_directory, path):
+            Path components inside the user directory.
+
+        node(parts):
+            Node of a directory.
+
+        is_directory(present_directory, path):
+            Path is a directory of the user.
+
+        listing(present_directory):
+            Entries of a directory.
+
+        add(present_directory, path, directory):
+            Record a new file or directory.
+
+        remove(present_directory, path):
+            Forget a file or directory.
+
+        touch(present_directory, path):
+            Drop the cached metadata of a changed file.
+
+        tree(present_directory, depth):
+            Entries below a directory with their metadata.
+    """
+
+    def __init__(self, root_path, storage=None):
+        """
+        Initialize the attributes.
+        """
+        self.root_path = root_path
+        self.storage = storage or get_storage()
+        self.root = DirectoryNode()
+        self.lock = threading.Lock()
+
+    def split(self, present_directory, path):
+        """
+        Path components of a path relative to the present directory.
+
+        Parameters:
+            present_directory : str
+            path : str
+
+        Return: list(str) or None
+            Components from the user directory, None if it leaves the user directory.
+        """
+        total_path = normpath(join(present_directory, path))
+        if isabs(total_path) or total_path == ".." or total_path.startswith(".." + os.sep):
+            return None
+        if total_path == ".":
+            return []
+        return total_path.split(os.sep)
+
+    def node(self, parts, scan=True):
+        """
+        Node of a directory, scanning directories on the way when needed.
+
+        Parameters:
+            parts : list(str)
+            scan : bool
+                Read unscanned directories from disk.
+
+        Return: Class(DirectoryNode) or None
+            Node, None if it is not a known directory.
+        """
+        node = self.root
+        for depth in range(len(parts) + 1):
+            if not node.scanned:
+                if not scan:
+                    return None
+                self.scan(node, parts[:depth])
+            if depth == len(parts):
+                return node
+            node = node.children.get(parts[depth])
+            if node is None:
+                return None
+
+    def scan(self, node, parts):
+        """
+        Read the entries of a directory from the storage backend.
+
+        Parameters:
+            node : Class(DirectoryNode)
+            parts : list(str)
+        """
+        for name, directory in self.storage.listdir(join(self.root_path, *parts)):
+            node.children[name] = DirectoryNode() if directory else None
+        node.scanned = True
+
+    def is_directory(self, present_directory, path):
+        """
+        Path is a directory of the user.
+
+        Parameters:
+            present_directory : str
+            path : str
+
+        Return: bool
+            Directory available or not.
+        """
+        parts = self.split(present_directory, path)
+        if parts is None:
+            return False
+        with self.lock:
+            return self.node(parts) is not None
+
+    def listing(self, present_directory):
+        """
+        Entries of a directory.
+
+        Parameters:
+            present_directory : str
+
+        Return: tuple(list, list)
+            All entry names, names of files.
+        """
+        with self.lock:
+            node = self.node(self.split(present_directory, ""))
+            names = list(node.children)
+            files = [name for name, child in node.children.items() if child is None]
+        return names, files
+
+    def add(self, present_directory, path, directory=False, scanned=True):
+        """
+        Record a new file or directory.
+
+        Parameters:
+            present_directory : str
+            path : str
+            directory : bool
+            scanned : bool
+                A new directory is empty, one found on disk is scanned on first use.
+        """
+        parts = self.split(present_directory, path)
+        if not parts:
+            return
+        with self.lock:
+            self.invalidate(parts)
+            parent = self.node(parts[:-1], scan=False)
+            if parent is None or parts[-1] in parent.children:
+                return
+            child = None
+            if directory:
+                child = DirectoryNode()
+                child.scanned = scanned
+            parent.children[parts[-1]] = child
+
+    def remove(self, present_directory, path):
+        """
+        Forget a file or directory.
+
+        Parameters:
+            present_directory : str
+            path : str
+        """
+        parts = self.split(present_directory, path)
+        if not parts:
+            return
+        with self.lock:
+            parent = self.node(parts[:-1], scan=False)
+            if parent is not None:
+                parent.children.pop(parts[-1], None)
+            self.invalidate(parts)
+
+    def touch(self, present_directory, path):
+        """
+        Drop the cached metadata of a file changed in place.
+
+        Parameters:
+            present_directory : str
+            path : str
+        """
+        parts = self.split(present_directory, path)
+        if not parts:
+            return
+        with self.lock:
+            self.invalidate(parts)
+
+    def invalidate(self, parts):
+        """
+        Drop the cached stat of an entry and of its parent folder, the lock must be held.
+
+        Parameters:
+            parts : list(str)
+        """
+        for depth in (len(parts), len(parts) - 1):
+            if depth:
+                parent = self.node(parts[:depth - 1], scan=False)
+                if parent is not None:
+                    parent.stats.pop(parts[depth - 1], None)
+
+    def tree(self, present_directory, depth=None):
+        """
+        Entries below a directory, depth first, with their size and mtime.
+
+        Parameters:
+            present_directory : str
+            depth : int
+                Levels to descend, 1 for the directory alone, None for all.
+
+        Return: list(tuple(path, directory, size, mtime_ns))
+            Entries with paths relative to the directory.
+        """
+        parts = self.split(present_directory, "")
+        entries = []
+        with self.lock:
+            self.walk(self.node(parts), parts, [], depth, entries)
+        return entries
+
+    def walk(self, node, parts, prefix, depth, entries):
+        """
+        Collect the entries of a node and its subdirectories, the lock must be held.
+
+        Parameters:
+            node : Class(DirectoryNode)
+            parts : list(str)
+                Components of the node from the user directory.
+            prefix : list(str)
+                Components of the node from the listed directory.
+            depth : int
+            entries : list
+        """
+        if not node.scanned:
+            self.scan(node, parts)
+        for name, child in list(node.children.items()):
+            stat = node.stats.get(name)
+            if stat is None:
+                try:
+                    _, size, mtime_ns = self.storage.stat(join(self.root_path, *parts, name))
+                except FileNotFoundError:
+                    continue
+                stat = node.stats[name] = (size, mtime_ns)
+            entries.append((join(*prefix, name), child is not None, stat[0], stat[1]))
+            if child is not None and depth != 1:
+                self.walk(child, parts + [name], prefix + [name], depth and depth - 1, entries)
+
+
+def get_directory_index(user):
+    """
+    Directory index of a user, shared by every handler.
+
+    Parameters:
+        user : str
+
+    Return: Class(DirectoryIndex)
+        Directory index.
+    """
+    with INDEX_LOCK:
+        if user not in INDEXES:
+            INDEXES[user] = DirectoryIndex(user)
+        return INDEXES[user]
+
+def drop_directory_index(user):
+    """
+    Forget the directory index of a user.
+
+    Parameters:
+        user : str
+    """
+    with INDEX_LOCK:
+        INDEXES.pop(user, None)
@@ -0,0 +1,329 @@
+"""
+Process wide request metrics, dumped by the stats command and on a local port.
+"""
+
+import socket
+import threading
+from bisect import bisect_left
+
+BOUNDS = [0.00001 * 1.1 ** i for i in range(170)]
+QUANTILES = (0.5, 0.95, 0.99)
+
+class Histogram():
+    """
+    Latency histogram module
+
+    Buckets grow by 10% from 10 microseconds to about 100 seconds, so a
+    percentile is read off with at most 10% error in constant memory.
+
+    Attributes:
+    -----------------
+        counts : list(int)
+            Observations per bucket, the last one catches everything above.
+
+        total : int
+            Number of observations.
+
+        sum : float
+            Sum of observations in seconds.
+
+    Methods:
+    -----------------
+        observe(seconds):
+            Add an observation.
+
+        percentile(fraction):
+            Upper bound of the bucket holding a percentile.
+    """
+
+    def __init__(self):
+        """
+        Initialize the attributes.
+        """
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        """
+        Add an observation.
+
+        Parameters:
+            seconds : float
+        """
+        self.counts[bisect_left(BOUNDS, seconds)] += 1
+        self.total += 1
+        self.sum += seconds
+
+    def percentile(self, fraction):
+        """
+        Percentile of the observations.
+
+        Parameters:
+            fraction : float
+                0.5 for p50, 0.99 for p99.
+
+        Return: float
+            Seconds, 0 without observations.
+        """
+        rank = fraction * self.total
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return BOUNDS[min(bucket, len(BOUNDS) - 1)]
+        return 0.0
+
+
+class Metrics():
+    """
+    Metrics module
+
+    Attributes:
+    -----------------
+        lock : threading.Lock
+            Guards the metrics.
+
+        commands : dict{command:[count, errors, Histogram]}
+            Per command counters and latency.
+
+        io : dict{read/write:Histogram}
+            Socket read and write latency.
+
+        queue_wait : Class(Histogram)
+            Time requests waited for a worker.
+
+        bytes_in, bytes_out : int
+            Bytes received and sent.
+
+        active_connections, total_connections : int
+            Connections open now and since start.
+
+        compressed_raw, compressed_wire : int
+            Bytes of compressed responses before and after compression.
+
+        throttled : int
+            Requests refused by the rate limits.
+
+        scheduler : Class(RequestScheduler)
+            Worker pool whose queue depth and counters are dumped, None before a server starts.
+
+    Methods:
+    -----------------
+        record_command(command, seconds, error):
+            Count a command.
+
+        record_io(kind, seconds, size):
+            Count a socket read or write.
+
+        record_queue_wait(seconds):
+            Count a queued request.
+
+        connection_opened(), connection_closed():
+            Track connections.
+
+        record_compression(raw, wire):
+            Count a compressed response.
+
+        record_throttled():
+            Count a rate limited request.
+
+        watch_scheduler(scheduler):
+            Dump the queue of a worker pool.
+
+        render():
+            Plaintext dump of all metrics.
+    """
+
+    def __init__(self):
+        """
+        Initialize the attributes.
+        """
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.io = {"read": Histogram(), "write": Histogram()}
+        self.queue_wait = Histogram()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.active_connections = 0
+        self.total_connections = 0
+        self.compressed_raw = 0
+        self.compressed_wire = 0
+        self.throttled = 0
+        self.scheduler = None
+
+    def record_command(self, command, seconds, error=False):
+        """
+        Count a command and its latency.
+
+        Parameters:
+            command : str
+            seconds : float
+            error : bool
+        """
+        with self.lock:
+            if command not in self.commands:
+                self.commands[command] = [0, 0, Histogram()]
+            stats = self.commands[command]
+            stats[0] += 1
+            stats[1] += error
+            stats[2].observe(seconds)
+
+    def record_io(self, kind, seconds, size):
+        """
+        Count a socket read or write.
+
+        Parameters:
+            kind : str
+                "read" or "write".
+            seconds : float
+            size : int
+                Bytes moved.
+        """
+        with self.lock:
+            self.io[kind].observe(seconds)
+            if kind == "read":
+                self.bytes_in += size
+            else:
+                self.bytes_out += size
+
+    def record_queue_wait(self, seconds):
+        """
+        Count the time a request waited for a worker.
+
+        Parameters:
+            seconds : float
+        """
+        with self.lock:
+            self.queue_wait.observe(seconds)
+
+    def connection_opened(self):
+        """
+        Count a new connection.
+        """
+        with self.lock:
+            self.active_connections += 1
+            self.total_connections += 1
+
+    def connection_closed(self):
+        """
+        Count a closed connection.
+        """
+        with self.lock:
+            self.active_connections -= 1
+
+    def record_compression(self, raw, wire):
+        """
+        Count a compressed response.
+
+        Parameters:
+            raw : int
+                Bytes of the response.
+            wire : int
+                Bytes sent for it, frame headers included.
+        """
+        with self.lock:
+            self.compressed_raw += raw
+            self.compressed_wire += wire
+
+    def record_throttled(self):
+        """
+        Count a request refused by the rate limits.
+        """
+        with self.lock:
+            self.throttled += 1
+
+    def watch_scheduler(self, scheduler):
+        """
+        Dump the queue depth and counters of a worker pool.
+
+        Parameters:
+            scheduler : Class(RequestScheduler)
+        """
+        with self.lock:
+            self.scheduler = scheduler
+
+    def render(self):
+        """
+        Plaintext dump, one metric per line.
+
+        Return: str
+            All metrics.
+        """
+        lines = []
+        scheduler = self.scheduler
+        if scheduler is not None:
+            stats = scheduler.stats()
+            lines.append("kvn_workers " + str(stats["workers"]))
+            lines.append("kvn_queue_size " + str(stats["queue_size"]))
+            lines.append("kvn_queue_depth " + str(stats["queue_depth"]))
+            lines.append("kvn_queue_submitted_total " + str(stats["submitted"]))
+            lines.append("kvn_queue_rejected_total " + str(stats["rejected"]))
+            lines.append("kvn_queue_completed_total " + str(stats["completed"]))
+        with self.lock:
+            lines.append("kvn_active_connections " + str(self.active_connections))
+            lines.append("kvn_connections_total " + str(self.total_connections))
+            lines.append("kvn_bytes_in_total " + str(self.bytes_in))
+            lines.append("kvn_bytes_out_total " + str(self.bytes_out))
+            lines.append("kvn_compressed_raw_bytes_total " + str(self.compressed_raw))
+            lines.append("kvn_compressed_wire_bytes_total " + str(self.compressed_wire))
+            ratio = self.compressed_raw / self.compressed_wire if self.compressed_wire else 0
+            lines.append("kvn_compression_ratio " + "%.3f" % ratio)
+            lines.append("kvn_throttled_total " + str(self.throttled))
+            for command in sorted(self.commands):
+                count, errors, histogram = self.commands[command]
+                label = '{command="' + command + '"'
+                lines.append("kvn_command_total" + label + "} " + str(count))
+                lines.append("kvn_command_errors_total" + label + "} " + str(errors))
+                lines += render_quantiles("kvn_command_seconds", label + ",", histogram)
+            for kind in sorted(self.io):
+                lines += render_quantiles("kvn_socket_" + kind + "_seconds", "{", self.io[kind])
+            lines += render_quantiles("kvn_queue_wait_seconds", "{", self.queue_wait)
+        return "\n".join(lines) + "\n"
+
+
+def render_quantiles(name, label, histogram):
+    """
+    Lines for the quantiles of a histogram.
+
+    Parameters:
+        name : str
+        label : str
+            Opening of the label set, "{" or '{command="x",'.
+        histogram : Class(Histogram)
+
+    Return: list(str)
+        Lines of the quantiles.
+    """
+    lines = []
+    for quantile in QUANTILES:
+        value = "%.6f" % histogram.percentile(quantile)
+        lines.append(name + label + 'quantile="' + str(quantile) + '"} ' + value)
+    return lines
+
+def serve_metrics(port, host="127.0.0.1"):
+    """
+    Answer every connection on a local port with the metrics dump.
+
+    Parameters:
+        port : int
+        host : str
+    """
+    try:
+        listener = socket.create_server((host, port))
+    except OSError as exps:
+        print("Metrics port unavailable : " + str(exps))
+        return
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+                with conn:
+                    conn.sendall(str.encode(METRICS.render()))
+            except OSError:
+                pass
+    threading.Thread(target=serve, args=(), daemon=True).start()
+    print("Serving metrics at " + host + ":" + str(port))
+
+
+METRICS = Metrics()
@@ -0,0 +1,99 @@
+"""
+Cache of memory maps for random access reads of user files.
+"""
+
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+MAX_MAPPINGS = 256
+
+MAPPINGS = OrderedDict()
+MAPPING_LOCK = threading.Lock()
+
+class MappedFile():
+    """
+    Mapped file module
+
+    Read only map of a whole file. A range read slices the map, so only the
+    requested bytes are copied and the kernel pages in just what is touched.
+    A map is never closed explicitly, it goes when the last reader drops it,
+    so a map replaced in the cache stays valid for reads still using it.
+
+    Attributes:
+    -----------------
+        path : str
+            Mapped file.
+
+        stamp : tuple(inode, mtime_ns, size)
+            File state the map was made for.
+
+        mapping : mmap.mmap
+            Map of the file, None for an empty file.
+
+    Methods:
+    -----------------
+        size():
+            Bytes in the file.
+
+        read(offset, length):
+            Bytes of a range.
+    """
+
+    def __init__(self, path, stamp):
+        """
+        Map the file.
+        """
+        self.path = path
+        self.stamp = stamp
+        self.mapping = None
+        if stamp[2]:
+            with open(path, "rb") as file:
+                self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def size(self):
+        """
+        Size of the mapped file.
+
+        Return: int
+            Bytes.
+        """
+        return self.stamp[2]
+
+    def read(self, offset, length):
+        """
+        Bytes of a range, cut at the end of the file.
+
+        Parameters:
+            offset : int
+            length : int
+
+        Return: bytes
+            Bytes of the range.
+        """
+        if self.mapping is None:
+            return b""
+        return self.mapping[offset:offset + length]
+
+
+def get_mapping(path):
+    """
+    Map of a file, reused while the file is unchanged.
+
+    Parameters:
+        path : str
+
+    Return: Class(MappedFile)
+        Map of the file as it is now.
+    """
+    stat = os.stat(path)
+    stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    with MAPPING_LOCK:
+        mapped = MAPPINGS.pop(path, None)
+        if mapped is None or mapped.stamp != stamp:
+            mapped = MappedFile(path, stamp)
+        MAPPINGS[path] = mapped
+        if len(MAPPINGS) > MAX_MAPPINGS:
+            MAPPINGS.popitem(last=False)
+    return mapped
@@ -0,0 +1,138 @@
+"""
+Pre-fork supervisor running several server processes on one port.
+
+Every worker is a whole Server binding the same port with SO_REUSEPORT, so the
+kernel spreads new connections over the workers and each runs its accept
+loop and handlers on its own core. The registry is opened in shared mode
+so register and delete on one worker are seen by the others, and usage
+counters are shared the same way so a quota holds across workers. Directory
+and search indexes and cached file maps stay per worker, see DirectoryIndex
+for how writes cope with an index another worker outdated.
+"""
+
+import os
+import signal
+import time
+
+from .server import Server
+from .config import session_path
+
+class Supervisor():
+    """
+    Supervisor module
+
+    Attributes:
+    -----------------
+        engine : str
+            Socket engine of the workers, a key of ENGINES.
+
+        processes : int
+            Number of worker processes.
+
+        metrics_port : int
+            Metrics port of the first worker, worker n serves metrics_port + n.
+
+        options : dict
+            Other Server arguments.
+
+        children : dict{pid:slot}
+            Running workers.
+
+        started : dict{slot:float}
+            Monotonic start time of each worker.
+
+        running : bool
+            Workers are restarted when they exit.
+
+        restart_delay : float
+            Seconds to wait before restarting a worker that died right after starting.
+
+    Methods:
+    -----------------
+        start_worker(slot):
+            Fork a worker.
+
+        run():
+            Start the workers and restart them when they exit.
+
+        stop(signum, frame):
+            Stop the workers.
+    """
+
+    def __init__(self, engine="thread", processes=None, metrics_port=9100, restart_delay=1, **options):
+        """
+        Initialize the attributes.
+        """
+        self.engine = engine
+        self.processes = processes or os.cpu_count() or 1
+        self.metrics_port = metrics_port
+        self.options = options
+        self.children = {}
+        self.started = {}
+        self.running = True
+        self.restart_delay = restart_delay
+
+    def start_worker(self, slot):
+        """
+        Fork a worker running its own server.
+
+        Parameters:
+            slot : int
+                Worker number.
+        """
+        self.started[slot] = time.monotonic()
+        pid = os.fork()
+        if pid:
+            self.children[pid] = slot
+            return
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            metrics_port = self.metrics_port + slot if self.metrics_port else None
+            server = Server(self.engine, metrics_port=metrics_port, prefork=True, **self.options)
+            if server.running:
+                server.listen()
+        except Exception as exps:
+            print("Worker " + str(slot) + " failed : " + str(exps))
+        finally:
+            os._exit(1)
+
+    def run(self):
+        """
+        Start the workers and restart any that exits until stopped.
+        """
+        if not os.path.exists(session_path("server_data")):
+            print("Error in opening session files!")
+            return
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for slot in range(self.processes):
+            self.start_worker(slot)
+        print("Started " + str(self.processes) + " workers")
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            slot = self.children.pop(pid, None)
+            if slot is None or not self.running:
+                continue
+            print("Worker " + str(slot) + " exited with status " + str(status) + ", restarting")
+            if time.monotonic() - self.started[slot] < self.restart_delay:
+                time.sleep(self.restart_delay)
+            self.start_worker(slot)
+
+    def stop(self, signum, frame):
+        """
+        Stop restarting workers and terminate them.
+
+        Parameters:
+            signum : int
+            frame : frame
+        """
+        self.running = False
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,278 @@
+"""
+On demand profiling of requests, started and stopped by the profile command.
+
+Dispatch checks active_profile() and runs unprofiled while it is None, so
+a server that is not being profiled pays one function call per request.
+"""
+
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from os.path import join
+
+from .config import session_path
+
+SAMPLE_INTERVAL = 0.005
+KINDS = ("cprofile", "sample")
+UNITS = ("seconds", "requests")
+
+ACTIVE = None
+PROFILE_LOCK = threading.Lock()
+
+class ProfileSession():
+    """
+    Profile session module
+
+    cprofile runs every profiled request under its own cProfile.Profile and
+    adds it to one pstats.Stats, written as a .pstats file. sample has a
+    thread read the stacks of the profiled threads every SAMPLE_INTERVAL and
+    writes them as collapsed stacks, "frame;frame;frame count" per line,
+    ready for flamegraph tools. With a command only requests of that command
+    are profiled or sampled, without one every request is and sample reads
+    every thread. The session ends after a number of seconds or requests,
+    or on profile stop.
+
+    Attributes:
+    -----------------
+        kind : str
+            cprofile or sample.
+
+        unit : str
+            seconds or requests.
+
+        limit : int
+            Seconds or requests to profile.
+
+        command : str
+            Command profiled, None for every command.
+
+        requests : int
+            Requests profiled so far.
+
+        stats : pstats.Stats
+            Merged profiles of cprofile.
+
+        stacks : Counter{str:int}
+            Samples per collapsed stack of sample.
+
+        running : dict{thread_id:str}
+            Threads running a profiled request.
+
+        root : str
+            Diagnostics directory the result goes to.
+
+        path : str
+            File written when the session ended, None before.
+
+        lock : threading.Lock
+            Guards the session.
+
+    Methods:
+    -----------------
+        matches(command):
+            Request of command is profiled.
+
+        run(command, function, *args):
+            Run a request under the profiler.
+
+        run_cprofile(function, args):
+            Run a request under a cProfile.Profile.
+
+        sample():
+            Sampler thread loop.
+
+        finish():
+            End the session and write the result.
+    """
+
+    def __init__(self, kind, unit, limit, command=None, root=None):
+        """
+        Initialize the attributes and start the sampler or the timer.
+        """
+        self.kind = kind
+        self.unit = unit
+        self.limit = limit
+        self.command = command
+        self.root = root or session_path(".diagnostics")
+        self.requests = 0
+        self.stats = None
+        self.stacks = Counter()
+        self.running = {}
+        self.path = None
+        self.lock = threading.Lock()
+        if kind == "sample":
+            threading.Thread(target=self.sample, args=(), daemon=True).start()
+        if unit == "seconds":
+            timer = threading.Timer(limit, self.finish)
+            timer.daemon = True
+            timer.start()
+
+    def matches(self, command):
+        """
+        Request of a command is profiled.
+
+        Parameters:
+            command : str
+
+        Return: bool
+            Profiled or not.
+        """
+        return self.command is None or self.command == command
+
+    def run(self, command, function, *args):
+        """
+        Run a request under the profiler of the session.
+
+        Parameters:
+            command : str
+                Command of the request.
+            function : callable
+            args : arguments for function
+
+        Return: result of function
+        """
+        if self.path is not None or not self.matches(command):
+            return function(*args)
+        try:
+            if self.kind == "cprofile":
+                return self.run_cprofile(function, args)
+            thread = threading.get_ident()
+            self.running[thread] = command
+            try:
+                return function(*args)
+            finally:
+                self.running.pop(thread, None)
+        finally:
+            with self.lock:
+                self.requests += 1
+                done = self.unit == "requests" and self.requests >= self.limit
+            if done:
+                self.finish()
+
+    def run_cprofile(self, function, args):
+        """
+        Run a request under a cProfile.Profile of its own and merge it.
+
+        Parameters:
+            function : callable
+            args : tuple
+
+        Return: result of function
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler holds the interpreter hook, serve the request plain.
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def sample(self):
+        """
+        Count the stacks of profiled threads until the session ends.
+        """
+        own = threading.get_ident()
+        while self.path is None:
+            frames = sys._current_frames()
+            if self.command is None:
+                threads = [thread for thread in frames if thread != own]
+            else:
+                threads = list(self.running)
+            stacks = []
+            for thread in threads:
+                frame = frames.get(thread)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(os.path.basename(code.co_filename) + ":" + code.co_name)
+                    frame = frame.f_back
+                if stack:
+                    stacks.append(";".join(reversed(stack)))
+            with self.lock:
+                if self.path is None:
+                    self.stacks.update(stacks)
+            time.sleep(SAMPLE_INTERVAL)
+
+    def finish(self):
+        """
+        End the session and write its result, once.
+
+        Return: str
+            Path of the written file.
+        """
+        global ACTIVE
+        with self.lock:
+            if self.path is not None:
+                return self.path
+            os.makedirs(self.root, exist_ok=True)
+            name = "profile-" + time.strftime("%Y%m%d-%H%M%S") + "-" + str(os.getpid())
+            if self.kind == "cprofile":
+                self.path = join(self.root, name + ".pstats")
+                if self.stats is None:
+                    cProfile.Profile().dump_stats(self.path)
+                else:
+                    self.stats.dump_stats(self.path)
+            else:
+                self.path = join(self.root, name + ".collapsed")
+                with open(self.path, "w") as file:
+                    for stack, count in self.stacks.most_common():
+                        file.write(stack + " " + str(count) + "\n")
+        with PROFILE_LOCK:
+            if ACTIVE is self:
+                ACTIVE = None
+        print("Profile written to " + self.path)
+        return self.path
+
+
+def start_profile(kind, unit, limit, command=None):
+    """
+    Start a profile session unless one is running.
+
+    Parameters:
+        kind : str
+        unit : str
+        limit : int
+        command : str
+
+    Return: Class(ProfileSession) or None
+        New session, None if one is running already.
+    """
+    global ACTIVE
+    with PROFILE_LOCK:
+        if ACTIVE is not None:
+            return None
+        ACTIVE = ProfileSession(kind, unit, limit, command)
+        return ACTIVE
+
+def stop_profile():
+    """
+    End the running profile session.
+
+    Return: str or None
+        Path written, None if no session was running.
+    """
+    session = ACTIVE
+    if session is None:
+        return None
+    return session.finish()
+
+def active_profile():
+    """
+    Running profile session.
+
+    Return: Class(ProfileSession) or None
+        Session, None while not profiling.
+    """
+    return ACTIVE
@@ -0,0 +1,381 @@
+"""
+Length prefixed framing for the wire protocol.
+
+A framed client opens with the handshake line "KVN/<version>\\n" and waits
+for the server's handshake frame before sending anything else. Clients that
+open with anything else stay in the legacy raw mode of one recv(4096) per
+command. Optional features follow the version, "KVN/1 zlib\\n", and the
+server's handshake lists the ones it accepted.
+
+Every framed message is one or more frames of a header (flags, 1 byte, and
+payload length, 4 bytes, network order) followed by the payload. FLAG_MORE
+is set on every frame of a message except the last, so a large response is
+written back to back without waiting on the client between frames. A frame
+holds at most FRAME_SIZE bytes and a message at most MAX_MESSAGE, requests
+to the server at most MAX_REQUEST, receivers drop the connection on more.
+
+A message flagged FLAG_BATCH carries newline separated commands that run in
+order, its response is a JSON list of [sequence number, response] pairs.
+Framed clients may also pipeline, responses come back in request order.
+
+A message flagged FLAG_FILE holds a byte count and is followed by that many
+raw, unframed bytes (see transfer.py).
+
+A message flagged FLAG_COMPRESSED carries one zlib stream across all of its
+frames. With the zlib feature accepted the server compresses responses of
+COMPRESS_THRESHOLD bytes or more, compressing and sending frame by frame,
+and receivers inflate frame by frame as they arrive, never past the message
+limit.
+"""
+
+import json
+import struct
+import zlib
+
+VERSION = 1
+HANDSHAKE_PREFIX = b"KVN/"
+HEADER = struct.Struct("!BI")
+FRAME_SIZE = 65536
+MAX_MESSAGE = 64 << 20
+MAX_REQUEST = 4 << 20
+
+FLAG_MORE = 1
+FLAG_BATCH = 2
+FLAG_FILE = 4
+FLAG_COMPRESSED = 8
+
+FEATURES = ("zlib",)
+COMPRESS_THRESHOLD = 1024
+COMPRESS_LEVEL = 6
+
+
+def handshake(version=VERSION, features=()):
+    """
+    Handshake line for a protocol version.
+
+    Parameters:
+        version : int
+        features : list(str)
+            Optional features asked for or accepted.
+
+    Return: bytes
+        Handshake line.
+    """
+    return HANDSHAKE_PREFIX + " ".join([str(version)] + list(features)).encode() + b"\n"
+
+def negotiate(data):
+    """
+    Version to speak for a handshake line.
+
+    Parameters:
+        data : bytes
+            First message of a connection.
+
+    Return: int
+        Highest version both sides speak, 0 if data is not a handshake.
+    """
+    if not data.startswith(HANDSHAKE_PREFIX) or not data.endswith(b"\n"):
+        return 0
+    version = data[len(HANDSHAKE_PREFIX):].split()[:1]
+    if not version or not version[0].isdigit() or int(version[0]) < 1:
+        return 0
+    return min(int(version[0]), VERSION)
+
+def features(data):
+    """
+    Supported features named in a handshake line.
+
+    Parameters:
+        data : bytes
+
+    Return: list(str)
+        Features both sides know.
+    """
+    return [feature for feature in str(data, "utf-8", "replace").split()[1:] if feature in FEATURES]
+
+def batch_request(commands):
+    """
+    Payload of a batch message.
+
+    Parameters:
+        commands : list(str)
+
+    Return: bytes
+        Newline separated commands.
+    """
+    return str.encode("\n".join(commands))
+
+def batch_response(results):
+    """
+    Payload of a batch response.
+
+    Parameters:
+        results : list([seq, str])
+
+    Return: bytes
+        JSON encoded results.
+    """
+    return str.encode(json.dumps(results))
+
+def batch_results(payload):
+    """
+    Results of a batch response.
+
+    Parameters:
+        payload : bytes
+
+    Return: list([seq, str])
+        Responses tagged by sequence number.
+    """
+    return json.loads(str(payload, "utf-8"))
+
+def frames(payload, flags=0, compress=False):
+    """
+    Split a payload into frames.
+
+    Parameters:
+        payload : bytes
+        flags : int
+            Flags of the message, FLAG_MORE is handled here.
+        compress : bool
+            Compress the payload if it reaches COMPRESS_THRESHOLD.
+
+    Return: generator(bytes)
+        Header and payload of every frame.
+    """
+    if compress and len(payload) >= COMPRESS_THRESHOLD:
+        yield from compressed_frames(payload, flags)
+        return
+    view = memoryview(payload)
+    for start in range(0, max(len(view), 1), FRAME_SIZE):
+        chunk = view[start:start + FRAME_SIZE]
+        more = FLAG_MORE if start + FRAME_SIZE < len(view) else 0
+        yield HEADER.pack(flags | more, len(chunk)) + chunk
+
+def compressed_frames(payload, flags=0):
+    """
+    Compress a payload into frames as one zlib stream, a frame goes out as
+    soon as FRAME_SIZE compressed bytes are ready.
+
+    Parameters:
+        payload : bytes
+        flags : int
+
+    Return: generator(bytes)
+        Header and payload of every frame.
+    """
+    flags |= FLAG_COMPRESSED
+    compressor = zlib.compressobj(COMPRESS_LEVEL)
+    view = memoryview(payload)
+    pending = b""
+    for start in range(0, len(view), FRAME_SIZE):
+        pending += compressor.compress(view[start:start + FRAME_SIZE])
+        while len(pending) > FRAME_SIZE:
+            yield HEADER.pack(flags | FLAG_MORE, FRAME_SIZE) + pending[:FRAME_SIZE]
+            pending = pending[FRAME_SIZE:]
+    pending += compressor.flush()
+    while len(pending) > FRAME_SIZE:
+        yield HEADER.pack(flags | FLAG_MORE, FRAME_SIZE) + pending[:FRAME_SIZE]
+        pending = pending[FRAME_SIZE:]
+    yield HEADER.pack(flags, len(pending)) + pending
+
+def send_message(conn, payload, flags=0, compress=False):
+    """
+    Send a framed message.
+
+    Parameters:
+        conn : Socket class
+        payload : bytes
+        flags : int
+        compress : bool
+
+    Return: int
+        Bytes put on the wire.
+    """
+    sent = 0
+    for frame in frames(payload, flags, compress):
+        conn.sendall(frame)
+        sent += len(frame)
+    return sent
+
+def recv_exact(conn, size):
+    """
+    Receive exactly size bytes.
+
+    Parameters:
+        conn : Socket class
+        size : int
+
+    Return: bytes
+        Received bytes.
+    """
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(min(size - len(data), FRAME_SIZE))
+        if not chunk:
+            raise ConnectionError("Connection closed mid frame")
+        data += chunk
+    return bytes(data)
+
+def check_frame(length, received, limit):
+    """
+    Refuse a frame over FRAME_SIZE or one taking its message over the limit.
+
+    Parameters:
+        length : int
+            Payload length of the frame.
+        received : int
+            Payload bytes of the message before the frame.
+        limit : int
+
+    Return: int
+        Payload bytes of the message with the frame.
+    """
+    if length > FRAME_SIZE:
+        raise ConnectionError("Frame of " + str(length) + " bytes over FRAME_SIZE")
+    if received + length > limit:
+        raise ConnectionError("Message over " + str(limit) + " bytes")
+    return received + length
+
+def recv_message(conn, limit=MAX_MESSAGE):
+    """
+    Receive a framed message.
+
+    Parameters:
+        conn : Socket class
+        limit : int
+            Most payload bytes of the message.
+
+    Return: tuple(flags, bytes)
+        Flags of the first frame without FLAG_MORE, and the whole payload.
+    """
+    flags, length = HEADER.unpack(recv_exact(conn, HEADER.size))
+    received = check_frame(length, 0, limit)
+    inflate = Inflater(flags, limit)
+    payload = [inflate(recv_exact(conn, length))]
+    more = flags & FLAG_MORE
+    while more:
+        more, length = HEADER.unpack(recv_exact(conn, HEADER.size))
+        more &= FLAG_MORE
+        received = check_frame(length, received, limit)
+        payload.append(inflate(recv_exact(conn, length)))
+    payload.append(inflate.flush())
+    return flags & ~(FLAG_MORE | FLAG_COMPRESSED), b"".join(payload)
+
+async def read_message(reader, header=None, limit=MAX_MESSAGE):
+    """
+    Read a framed message from an asyncio stream.
+
+    Parameters:
+        reader : asyncio.StreamReader
+        header : bytes
+            Header of the first frame when the caller already read it.
+        limit : int
+            Most payload bytes of the message.
+
+    Return: tuple(flags, bytes)
+        Flags of the first frame without FLAG_MORE, and the whole payload.
+    """
+    if header is None:
+        header = await reader.readexactly(HEADER.size)
+    flags, length = HEADER.unpack(header)
+    received = check_frame(length, 0, limit)
+    inflate = Inflater(flags, limit)
+    payload = [inflate(await reader.readexactly(length))]
+    more = flags & FLAG_MORE
+    while more:
+        more, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+        more &= FLAG_MORE
+        received = check_frame(length, received, limit)
+        payload.append(inflate(await reader.readexactly(length)))
+    payload.append(inflate.flush())
+    return flags & ~(FLAG_MORE | FLAG_COMPRESSED), b"".join(payload)
+
+def write_message(writer, payload, flags=0, compress=False):
+    """
+    Write a framed message to an asyncio stream, drain it afterwards.
+
+    Parameters:
+        writer : asyncio.StreamWriter
+        payload : bytes
+        flags : int
+        compress : bool
+
+    Return: int
+        Bytes put on the wire.
+    """
+    sent = 0
+    for frame in frames(payload, flags, compress):
+        writer.write(frame)
+        sent += len(frame)
+    return sent
+
+
+class Inflater():
+    """
+    Inflater module
+
+    Inflates the frames of a message as they arrive, passes them through
+    unless the message is flagged FLAG_COMPRESSED. A frame never inflates
+    past one byte over the limit, so a small zlib bomb is refused before it
+    is expanded.
+
+    Attributes:
+    -----------------
+        decompressor : zlib decompress object
+            None for uncompressed messages.
+
+        limit : int
+            Most inflated bytes of the message.
+
+        size : int
+            Inflated bytes so far.
+    """
+
+    def __init__(self, flags, limit=MAX_MESSAGE):
+        """
+        Initialize the attributes.
+        """
+        self.decompressor = zlib.decompressobj() if flags & FLAG_COMPRESSED else None
+        self.limit = limit
+        self.size = 0
+
+    def count(self, data):
+        """
+        Count inflated bytes against the limit.
+
+        Parameters:
+            data : bytes
+
+        Return: bytes
+            data, raises ConnectionError over the limit.
+        """
+        self.size += len(data)
+        if self.size > self.limit:
+            raise ConnectionError("Message inflates over " + str(self.limit) + " bytes")
+        return data
+
+    def __call__(self, data):
+        """
+        Inflate one frame.
+
+        Parameters:
+            data : bytes
+
+        Return: bytes
+            Inflated bytes.
+        """
+        if self.decompressor is None:
+            return data
+        return self.count(self.decompressor.decompress(data, self.limit - self.size + 1))
+
+    def flush(self):
+        """
+        Rest of the stream.
+
+        Return: bytes
+            Inflated bytes still buffered.
+        """
+        if self.decompressor is None:
+            return b""
+        return self.count(self.decompressor.flush())
@@ -0,0 +1,219 @@
+"""
+Per user storage usage kept up to date incrementally for quota checks.
+"""
+
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from os.path import join, dirname
+
+from .config import session_path
+from .storage import get_storage
+
+USAGES = {}
+USAGE_LOCK = threading.Lock()
+SHARED = False
+
+class StorageUsage():
+    """
+    Storage usage module
+
+    Bytes and inodes used by one user. The tree is walked once, the first
+    time a quota is checked, after that every write, append, folder, upload
+    and user deletion adjusts the counters, so a quota check is a compare
+    under a lock. A write reserves its bytes before touching the disk, so
+    concurrent writes of one user can not overshoot the quota together.
+    Changes made behind the server's back show up after drop_usage.
+
+    Shared usage is counted by several server processes at once, as under
+    prefork. The counters then live in ".usage/<user>.json" in the session
+    root and every change reads, adjusts and writes them under an flock on
+    "<path>.lock", so the workers together never let a user past the quota.
+
+    Attributes:
+    -----------------
+        root_path : str
+            Directory of the user in the storage backend.
+
+        bytes : int
+            Bytes of all files.
+
+        inodes : int
+            Files and folders.
+
+        scanned : bool
+            Counters were read from disk.
+
+        lock : threading.Lock
+            Guards the counters.
+
+        shared : bool
+            Other processes count the same user.
+
+        path : str
+            File holding the counters of shared usage.
+
+    Methods:
+    -----------------
+        scan():
+            Count the tree in storage.
+
+        counters():
+            Load and save shared counters around a change.
+
+        reserve(size, inodes, quota):
+            Count a change if it fits the quota.
+
+        release(size, inodes):
+            Uncount freed or unused space.
+
+        report():
+            Bytes and inodes used.
+    """
+
+    def __init__(self, root_path, shared=False, path=None):
+        """
+        Initialize the attributes.
+        """
+        self.root_path = root_path
+        self.bytes = 0
+        self.inodes = 0
+        self.scanned = False
+        self.lock = threading.Lock()
+        self.shared = shared
+        self.path = path or session_path(".usage", root_path + ".json")
+
+    def scan(self):
+        """
+        Count the bytes and inodes of the tree in storage, the lock must be held.
+        """
+        storage = get_storage()
+        for path, folders, files in storage.walk(self.root_path):
+            self.inodes += len(folders) + len(files)
+            for name in files:
+                try:
+                    self.bytes += storage.stat(join(path, name))[1]
+                except OSError:
+                    pass
+        self.scanned = True
+
+    @contextmanager
+    def counters(self):
+        """
+        Hold the lock file of shared usage, loading the counters before a
+        change and writing them after it, a no-op otherwise. The lock must be held.
+        """
+        if not self.shared:
+            yield
+            return
+        os.makedirs(dirname(self.path), exist_ok=True)
+        with open(self.path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.scanned = os.path.isfile(self.path)
+                if self.scanned:
+                    with open(self.path) as file:
+                        self.bytes, self.inodes = json.load(file)
+                else:
+                    self.bytes = self.inodes = 0
+                yield
+                temp_path = self.path + ".tmp"
+                with open(temp_path, "w") as file:
+                    json.dump([self.bytes, self.inodes], file)
+                os.replace(temp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def reserve(self, size, inodes, quota):
+        """
+        Count a change if it fits the quota.
+
+        Parameters:
+            size : int
+                Bytes about to be written.
+            inodes : int
+                Files and folders about to be made.
+            quota : tuple(max_bytes, max_inodes)
+                0 for no limit.
+
+        Return: bool
+            Change counted, False if it would exceed the quota.
+        """
+        max_bytes, max_inodes = quota
+        with self.lock, self.counters():
+            if not self.scanned:
+                self.scan()
+            if max_bytes and size and self.bytes + size > max_bytes:
+                return False
+            if max_inodes and inodes and self.inodes + inodes > max_inodes:
+                return False
+            self.bytes += size
+            self.inodes += inodes
+        return True
+
+    def release(self, size, inodes=0):
+        """
+        Uncount freed space or a reservation that was not used.
+
+        Parameters:
+            size : int
+            inodes : int
+        """
+        with self.lock, self.counters():
+            if self.scanned:
+                self.bytes = max(self.bytes - size, 0)
+                self.inodes = max(self.inodes - inodes, 0)
+
+    def report(self):
+        """
+        Current usage.
+
+        Return: tuple(int, int)
+            Bytes and inodes used.
+        """
+        with self.lock, self.counters():
+            if not self.scanned:
+                self.scan()
+            return self.bytes, self.inodes
+
+
+def get_usage(user):
+    """
+    Storage usage of a user, shared by every handler.
+
+    Parameters:
+        user : str
+
+    Return: Class(StorageUsage)
+        Storage usage.
+    """
+    with USAGE_LOCK:
+        if user not in USAGES:
+            USAGES[user] = StorageUsage(user, SHARED)
+        return USAGES[user]
+
+def drop_usage(user):
+    """
+    Forget the storage usage of a user.
+
+    Parameters:
+        user : str
+    """
+    with USAGE_LOCK:
+        usage = USAGES.pop(user, None)
+    path = usage.path if usage else session_path(".usage", user + ".json")
+    if os.path.isfile(path):
+        os.remove(path)
+
+def share_usage(shared=True):
+    """
+    Count usage in files shared by the processes of a prefork server.
+
+    Parameters:
+        shared : bool
+    """
+    global SHARED
+    with USAGE_LOCK:
+        SHARED = shared
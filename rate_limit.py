@@ -0,0 +1,156 @@
+"""
+Token bucket rate limits per connection and per user.
+"""
+
+import threading
+import time
+
+class TokenBucket():
+    """
+    Token bucket module
+
+    Holds up to burst tokens and refills rate tokens a second, a request
+    takes one token per command.
+
+    Attributes:
+    -----------------
+        rate : float
+            Tokens added per second.
+
+        burst : float
+            Most tokens held.
+
+        tokens : float
+            Tokens left at updated.
+
+        updated : float
+            Monotonic time of the last refill.
+
+    Methods:
+    -----------------
+        take(cost, now):
+            Take tokens or tell how long until they are there.
+    """
+
+    def __init__(self, rate, burst, now=None):
+        """
+        Initialize the attributes, starting full.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, cost=1, now=None):
+        """
+        Take cost tokens if there are enough.
+
+        Parameters:
+            cost : int
+            now : float
+                Monotonic time, read from the clock when missing.
+
+        Return: float
+            0 if the tokens were taken, else seconds until there are enough.
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.burst)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+
+class RateLimiter():
+    """
+    Rate limiter module
+
+    A request has to fit the bucket of its connection and, once logged in,
+    the bucket shared by every connection of its user, so one tenant can't
+    get around the limit by opening more connections. A rate of 0 turns
+    that limit off.
+
+    Attributes:
+    -----------------
+        connection_rate, connection_burst : float
+            Bucket of every connection.
+
+        user_rate, user_burst : float
+            Bucket of every user.
+
+        connections : dict{ip:TokenBucket}
+            Buckets of open connections.
+
+        users : dict{user:TokenBucket}
+            Buckets of users seen.
+
+        lock : threading.Lock
+            Guards the buckets.
+
+    Methods:
+    -----------------
+        check(address, user, cost):
+            Charge a request, seconds to wait if it is over a limit.
+
+        forget(address):
+            Drop the bucket of a closed connection.
+    """
+
+    def __init__(self, connection_rate=50, connection_burst=100, user_rate=200, user_burst=400):
+        """
+        Initialize the attributes.
+        """
+        self.connection_rate = connection_rate
+        self.connection_burst = connection_burst
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.connections = {}
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def check(self, address, user=None, cost=1):
+        """
+        Charge a request to the buckets of its connection and user.
+
+        Parameters:
+            address : tuple(ip, port)
+            user : str
+                None before login.
+            cost : int
+                Commands in the request.
+
+        Return: float
+            0 to serve the request, else seconds to retry after.
+        """
+        now = time.monotonic()
+        with self.lock:
+            buckets = []
+            if self.connection_rate:
+                if address not in self.connections:
+                    self.connections[address] = TokenBucket(self.connection_rate,
+                                                            self.connection_burst, now)
+                buckets.append(self.connections[address])
+            if self.user_rate and user is not None:
+                if user not in self.users:
+                    self.users[user] = TokenBucket(self.user_rate, self.user_burst, now)
+                buckets.append(self.users[user])
+            waits = [bucket.take(cost, now) for bucket in buckets]
+            if any(waits):
+                # Give back what was taken so a refused request costs nothing.
+                for bucket, wait in zip(buckets, waits):
+                    if not wait:
+                        bucket.tokens += min(cost, bucket.burst)
+                return max(waits)
+            return 0.0
+
+    def forget(self, address):
+        """
+        Drop the bucket of a closed connection.
+
+        Parameters:
+            address : tuple(ip, port)
+        """
+        with self.lock:
+            self.connections.pop(address, None)
@@ -0,0 +1,285 @@
+"""
+Process wide user registry shared by every request handler.
+"""
+
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .config import session_path
+
+REGISTRY = None
+REGISTRY_LOCK = threading.Lock()
+
+class UserRegistry():
+    """
+    User registry module
+
+    Loads the session data once and keeps it in memory. Changes are written
+    behind by a flusher thread that waits flush_delay seconds for more
+    changes, so a burst of registrations costs one atomic rewrite of the file.
+
+    A shared registry is used by several server processes at once. Changes
+    are then made under an flock on "<path>.lock" against a fresh copy of
+    the file and written through, and reads reload the file whenever its
+    stamp moved, so a register on one process is seen by the others.
+
+    Attributes:
+    -----------------
+        path : str
+            Session data file.
+
+        passwords : dict(user:password)
+            Registered user passwords.
+
+        privileges : dict(user:privileges)
+            Registered user privileges.
+
+        quotas : dict(user:[max_bytes, max_inodes])
+            Storage limits of users, 0 or a missing user for no limit.
+
+        lock : threading.RLock
+            Guards the registry.
+
+        flush_lock : threading.Lock
+            Serializes writes of the session file.
+
+        dirty : threading.Event
+            Set while changes are not on disk.
+
+        flush_delay : float
+            Seconds to gather changes before writing.
+
+        writes : int
+            Number of times the file was written.
+
+        shared : bool
+            Other processes change the file too.
+
+        stamp : tuple(inode, mtime_ns, size)
+            File state the registry was loaded from, every rewrite gets a new inode.
+
+    Methods:
+    -----------------
+        load():
+            Read the session file.
+
+        refresh():
+            Reload a shared registry changed by another process.
+
+        locked():
+            Hold the lock file of a shared registry.
+
+        add_user(user, password, privileges, quota):
+            Add a new user.
+
+        set_quota(user, max_bytes, max_inodes):
+            Change the storage limits of a user.
+
+        quota(user):
+            Storage limits of a user.
+
+        remove_user(user):
+            Remove a user.
+
+        schedule_flush():
+            Mark the registry dirty.
+
+        flusher():
+            Flusher thread loop.
+
+        flush():
+            Write the registry if dirty.
+    """
+
+    def __init__(self, path=None, flush_delay=0.2, shared=False):
+        """
+        Load the registry and start the flusher, path defaults to server_data in the session root.
+        """
+        self.path = path or session_path("server_data")
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.dirty = threading.Event()
+        self.flush_delay = flush_delay
+        self.writes = 0
+        self.shared = shared
+        self.stamp = None
+        self.passwords, self.privileges, self.quotas = self.load()
+        if not shared:
+            threading.Thread(target=self.flusher, args=(), daemon=True).start()
+            atexit.register(self.flush)
+
+    def load(self):
+        """
+        Read the session file.
+
+        Return: tuple(dict, dict, dict)
+            Passwords, privileges and quotas.
+        """
+        with open(self.path) as file:
+            stat = os.fstat(file.fileno())
+            data = json.load(file)
+        self.stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        return data["passwords"][0], data["privileges"][0], data.get("quotas", [{}])[0]
+
+    def refresh(self):
+        """
+        Reload a shared registry if another process rewrote the file.
+        """
+        if not self.shared:
+            return
+        stat = os.stat(self.path)
+        with self.lock:
+            if (stat.st_ino, stat.st_mtime_ns, stat.st_size) != self.stamp:
+                # Readers do not take the lock, so no user may vanish mid reload
+                for current, loaded in zip((self.passwords, self.privileges, self.quotas), self.load()):
+                    current.update(loaded)
+                    for user in current.keys() - loaded.keys():
+                        current.pop(user, None)
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold the lock file of a shared registry around a change, a no-op otherwise.
+        """
+        if not self.shared:
+            yield
+            return
+        with open(self.path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def add_user(self, user, password, privileges, quota=None):
+        """
+        Add a new user.
+
+        Parameters:
+            user : str
+            password : str
+            privileges : str
+            quota : list(int)
+                max_bytes and max_inodes, None for no limit.
+
+        Return: bool
+            False if the username is taken.
+        """
+        with self.locked(), self.lock:
+            if user in self.passwords:
+                return False
+            self.passwords[user] = password
+            self.privileges[user] = privileges
+            if quota:
+                self.quotas[user] = list(quota)
+            self.schedule_flush()
+        return True
+
+    def set_quota(self, user, max_bytes, max_inodes):
+        """
+        Change the storage limits of a user.
+
+        Parameters:
+            user : str
+            max_bytes : int
+            max_inodes : int
+                0 for no limit.
+
+        Return: bool
+            False if there is no such user.
+        """
+        with self.locked(), self.lock:
+            if user not in self.passwords:
+                return False
+            self.quotas[user] = [max_bytes, max_inodes]
+            self.schedule_flush()
+        return True
+
+    def quota(self, user):
+        """
+        Storage limits of a user.
+
+        Parameters:
+            user : str
+
+        Return: tuple(int, int)
+            max_bytes and max_inodes, 0 for no limit.
+        """
+        self.refresh()
+        max_bytes, max_inodes = self.quotas.get(user, (0, 0))
+        return max_bytes, max_inodes
+
+    def remove_user(self, user):
+        """
+        Remove a user.
+
+        Parameters:
+            user : str
+        """
+        with self.locked(), self.lock:
+            self.passwords.pop(user, None)
+            self.privileges.pop(user, None)
+            self.quotas.pop(user, None)
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        """
+        Have the flusher write the registry, a shared registry is written at once.
+        """
+        self.dirty.set()
+        if self.shared:
+            self.flush()
+
+    def flusher(self):
+        """
+        Write the registry shortly after it changes.
+        """
+        while True:
+            self.dirty.wait()
+            time.sleep(self.flush_delay)
+            self.flush()
+
+    def flush(self):
+        """
+        Write the registry to a temporary file and rename it over the session file.
+        """
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty.is_set():
+                    return
+                self.dirty.clear()
+                data = json.dumps({"passwords":[self.passwords], "privileges":[self.privileges],
+                                   "quotas":[self.quotas]})
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+            stat = os.stat(self.path)
+            self.stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self.writes += 1
+
+
+def get_registry(shared=False):
+    """
+    Registry shared by the process, loaded on first use.
+
+    Parameters:
+        shared : bool
+            Other server processes use the same file, only read on first use.
+
+    Return: Class(UserRegistry)
+        Shared registry.
+    """
+    global REGISTRY
+    with REGISTRY_LOCK:
+        if REGISTRY is None:
+            REGISTRY = UserRegistry(shared=shared)
+        return REGISTRY
@@ -1,6 +1,12 @@
 """client to connect to server"""
+import hashlib
+import os
 import socket
 
+from .protocol import handshake, negotiate, features, send_message, recv_message, FEATURES
+from .protocol import batch_request, batch_results, FLAG_BATCH, FLAG_FILE
+from .transfer import receive_download, send_upload
+
 ip = input("Enter host ip (Press enter to keep it default) : ")
 
 if ip == "":
@@ -10,17 +16,62 @@ else:
     conn = socket.socket()
     conn.connect((ip, 8080))
 
+conn.send(handshake(features=FEATURES))
+reply = recv_message(conn)[1]
+if not negotiate(reply):
+    print("Server does not speak the framed protocol!")
+    exit()
+if "zlib" in features(reply):
+    print("Large responses arrive zlib compressed.")
+
 def respond(inp):
     if inp == "":
         return
-    if INP == "quit":
-        conn.send(str.encode(INP))
-        response = conn.recv(4096)
-        print("Server -> " + str(response, "utf-8"))
-        exit()
-    conn.send(str.encode(INP))
-    response = conn.recv(4096)
+    if inp.startswith("batch "):
+        commands = [command.strip() for command in inp[len("batch "):].split(";")]
+        send_message(conn, batch_request(commands), FLAG_BATCH)
+        flags, response = recv_message(conn)
+        if not flags & FLAG_BATCH:
+            print("Server -> " + str(response, "utf-8"))
+            return
+        for seq, output in batch_results(response):
+            print("Server [" + str(seq) + "] -> " + output)
+        return
+    if inp.startswith("upload "):
+        upload(inp[len("upload "):])
+        return
+    send_message(conn, str.encode(inp))
+    flags, response = recv_message(conn)
+    if flags & FLAG_FILE:
+        name = os.path.basename(inp.split(" ")[1])
+        with open(name, "wb") as file:
+            receive_download(conn, file, int(response))
+        print("Server -> Downloaded " + name + " (" + str(response, "utf-8") + " bytes)")
+        return
     print("Server -> " + str(response, "utf-8"))
+    if inp == "quit":
+        exit()
+
+def upload(path):
+    if not os.path.isfile(path):
+        print("No such local file " + path)
+        return
+    size = os.path.getsize(path)
+    send_message(conn, str.encode("upload " + os.path.basename(path) + " " + str(size)))
+    flags, response = recv_message(conn)
+    if not flags & FLAG_FILE:
+        print("Server -> " + str(response, "utf-8"))
+        return
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        send_upload(conn, file, int(response), size)
+        file.seek(0)
+        for chunk in iter(lambda: file.read(65536), b""):
+            digest.update(chunk)
+    response = str(recv_message(conn)[1], "utf-8")
+    print("Server -> " + response)
+    if response.split(" ")[-1] != digest.hexdigest():
+        print("Checksum mismatch, upload again!")
 
 print("Connected to server!\n")
 while True:
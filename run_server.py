@@ -1,7 +1,18 @@
 """run server"""
+import sys
+
 from .server import Server
+from .prefork import Supervisor
+from .config import load_config, configure, server_options
+
+SETTINGS = load_config(sys.argv[1:])
+configure(SETTINGS)
+OPTIONS = server_options(SETTINGS)
 
-SER = Server()
+if SETTINGS["processes"] > 1:
+    Supervisor(OPTIONS.pop("engine"), SETTINGS["processes"], **OPTIONS).run()
+else:
+    SER = Server(**OPTIONS)
 
-if SER.running:
-    SER.listen()
+    if SER.running:
+        SER.listen()
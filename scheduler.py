@@ -0,0 +1,173 @@
+"""
+Fixed size worker pool with a bounded queue in front of the request handlers.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from .metrics import METRICS
+
+class RequestScheduler():
+    """
+    Request scheduler module
+
+    Requests queue per key, the user of a session or the address before
+    login, and workers take them round robin over the keys. When the
+    workers keep up this is plain FIFO, when they don't every tenant gets
+    its turn instead of one busy client filling the queue ahead of the rest.
+
+    Attributes:
+    -----------------
+        workers : int
+            Number of worker threads.
+
+        queue_size : int
+            Maximum number of requests waiting for a worker.
+
+        jobs : OrderedDict{key:deque}
+            Queued (queued_at, future, function, args) per key, keys in turn order.
+
+        depth : int
+            Requests queued over all keys.
+
+        lock : threading.Condition
+            Guards the queues and counters, workers wait on it.
+
+        submitted, rejected, started, completed : int
+            Request counters.
+
+        total_wait, max_wait : float
+            Time in seconds requests spent in the queue.
+
+    Methods:
+    -----------------
+        submit(function, *args, key):
+            Queue a call, None when the queue is full.
+
+        next_job():
+            Call whose turn it is.
+
+        work():
+            Worker thread loop.
+
+        queue_depth():
+            Requests waiting right now.
+
+        stats():
+            Snapshot of the scheduler counters.
+    """
+
+    def __init__(self, workers=8, queue_size=64):
+        """
+        Initialize the attributes and start the workers.
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self.jobs = OrderedDict()
+        self.depth = 0
+        self.lock = threading.Condition()
+        self.submitted = 0
+        self.rejected = 0
+        self.started = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        for _ in range(workers):
+            threading.Thread(target=self.work, args=(), daemon=True).start()
+
+    def submit(self, function, *args, key=None):
+        """
+        Queue function(*args) for a worker.
+
+        Parameters:
+            function : callable
+            args : arguments for function
+            key : hashable
+                Tenant the call is fair queued under.
+
+        Return: Future or None
+            Future of the result, None if the queue is full.
+        """
+        future = Future()
+        with self.lock:
+            if self.depth >= self.queue_size:
+                self.rejected += 1
+                return None
+            if key not in self.jobs:
+                self.jobs[key] = deque()
+            self.jobs[key].append((time.monotonic(), future, function, args))
+            self.depth += 1
+            self.submitted += 1
+            self.lock.notify()
+        return future
+
+    def next_job(self):
+        """
+        Take the oldest call of the key whose turn it is, waiting for one.
+
+        Return: tuple(queued_at, future, function, args)
+            Queued call.
+        """
+        with self.lock:
+            while not self.depth:
+                self.lock.wait()
+            key, calls = next(iter(self.jobs.items()))
+            job = calls.popleft()
+            if calls:
+                self.jobs.move_to_end(key)
+            else:
+                del self.jobs[key]
+            self.depth -= 1
+            return job
+
+    def work(self):
+        """
+        Run queued calls forever.
+        """
+        while True:
+            queued_at, future, function, args = self.next_job()
+            wait = time.monotonic() - queued_at
+            METRICS.record_queue_wait(wait)
+            with self.lock:
+                self.started += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except Exception as exps:
+                future.set_exception(exps)
+            with self.lock:
+                self.completed += 1
+
+    def queue_depth(self):
+        """
+        Requests waiting for a worker.
+
+        Return: int
+            Queue depth.
+        """
+        return self.depth
+
+    def stats(self):
+        """
+        Scheduler counters.
+
+        Return: dict
+            Workers, queue depth, counters and wait times in seconds.
+        """
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "queue_depth": self.queue_depth(),
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "started": self.started,
+                "completed": self.completed,
+                "avg_wait": self.total_wait / max(self.started, 1),
+                "max_wait": self.max_wait,
+            }
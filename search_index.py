@@ -0,0 +1,442 @@
+"""
+Per user inverted index behind the search command.
+"""
+
+import atexit
+import codecs
+import json
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+from os.path import join, relpath, dirname, basename
+
+from .config import session_path
+from .storage import get_storage
+
+BLOCK_SIZE = 1 << 20
+MAX_OFFSETS = 16
+MAX_RESULTS = 100
+FLUSH_DELAY = 1.0
+SEARCH_WAIT = 5.0
+MAX_INDEXED_SIZE = 8 << 20
+SNIFF_SIZE = 4096
+SKIPPED_SUFFIXES = (".part", ".link", ".copy")
+
+# ASCII word characters and whole UTF-8 sequences, on bytes so offsets are byte offsets.
+TOKEN = re.compile(rb"(?:[A-Za-z0-9_]|[\xc0-\xff][\x80-\xbf]+)+")
+
+INDEXES = {}
+INDEX_LOCK = threading.Lock()
+FLUSHER = None
+INDEXER = None
+JOBS = queue.Queue()
+
+class SearchIndex():
+    """
+    Search index module
+
+    Maps every term of a user's files to the files holding it and the byte
+    offsets of its first MAX_OFFSETS occurrences, ready for read_range.
+    write_file, appends and uploads update single files, an append only
+    scans the bytes past what was indexed. Loads and updates are queued to
+    one indexer thread so requests and the event loop never scan files, a
+    search waits for the queued work of its index first. Files above
+    MAX_INDEXED_SIZE, or whose first bytes hold a NUL or aren't UTF-8, are
+    stamped but not indexed. The index is saved to
+    ".search/<user>.json" in the session root shortly after it changes, and on
+    load only files whose stamp moved are scanned again. The indexer thread
+    is the only one changing an index, saves run on it too so searches go
+    on while it is serialized. Prefork workers share the file, each save
+    goes through its own temporary file, and since load checks every stamp
+    against the disk, the file saved last by any worker is caught up with
+    the writes of the others. A file that can't be read is rescanned.
+
+    Attributes:
+    -----------------
+        user : str
+            Owner of the files.
+
+        root_path : str
+            Directory of the user in the storage backend.
+
+        storage : Class(Storage)
+            Backend holding the files.
+
+        path : str
+            File the index is saved to.
+
+        files : dict{path:[mtime_ns, size, indexed]}
+            Stamp of every scanned file, paths relative to root_path,
+            indexed False for binary and large files.
+
+        postings : dict{term:dict{path:list(int)}}
+            Files and byte offsets of every term.
+
+        terms : dict{path:set(term)}
+            Terms of every file, so a file is forgotten without a pass over all terms.
+
+        dirty : bool
+            Changed since it was saved.
+
+        pending : int
+            Jobs queued to the indexer and not done yet.
+
+        lock : threading.Lock
+            Guards the index.
+
+        idle : threading.Condition
+            Guards pending apart from the index, so queueing a job never
+            waits for a scan, notified when pending drops to 0.
+
+    Methods:
+    -----------------
+        load():
+            Read the saved index and catch up with the disk.
+
+        update(path, appended):
+            Queue a written file to the indexer.
+
+        apply(path, appended):
+            Index a written file, on the indexer thread.
+
+        remove(path):
+            Queue a removed file to the indexer.
+
+        discard(path):
+            Forget a file, on the indexer thread.
+
+        search(query):
+            Files and offsets holding every word of a query.
+
+        save():
+            Write the index if dirty, on the indexer thread.
+    """
+
+    def __init__(self, user, root=None):
+        """
+        Initialize the attributes.
+        """
+        self.user = user
+        self.root_path = user
+        self.storage = get_storage()
+        self.path = join(root or session_path(".search"), user + ".json")
+        self.files = {}
+        self.postings = {}
+        self.terms = {}
+        self.dirty = False
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.idle = threading.Condition()
+
+    def load(self):
+        """
+        Read the saved index, then scan files that are new or changed and forget removed ones.
+        """
+        with self.lock:
+            if os.path.isfile(self.path):
+                try:
+                    with open(self.path) as file:
+                        data = json.load(file)
+                    self.files = data["files"]
+                    self.postings = data["postings"]
+                except (OSError, ValueError, KeyError, TypeError) as error:
+                    print("Search index of " + self.user + " unreadable, rescanning: " + str(error))
+                    self.files, self.postings = {}, {}
+                for term, files in self.postings.items():
+                    for path in files:
+                        self.terms.setdefault(path, set()).add(term)
+            present = set()
+            for folder, _, names in self.storage.walk(self.root_path):
+                for name in names:
+                    path = relpath(join(folder, name), self.root_path)
+                    if name.endswith(SKIPPED_SUFFIXES):
+                        continue
+                    present.add(path)
+                    _, size, mtime_ns = self.storage.stat(join(folder, name))
+                    if self.files.get(path, [])[:2] != [mtime_ns, size]:
+                        self.index(path, 0)
+            for path in set(self.files) - present:
+                self.forget(path)
+
+    def forget(self, path):
+        """
+        Drop the postings of a file, the lock must be held.
+
+        Parameters:
+            path : str
+        """
+        if self.files.pop(path, None) is None:
+            return
+        for term in self.terms.pop(path, ()):
+            files = self.postings[term]
+            files.pop(path, None)
+            if not files:
+                del self.postings[term]
+        self.dirty = True
+
+    def index(self, path, start):
+        """
+        Scan a file from a byte offset into the postings, the lock must be held.
+
+        Parameters:
+            path : str
+            start : int
+                0 to index the whole file, the indexed size to index an append.
+        """
+        if not start:
+            self.forget(path)
+        total_path = join(self.root_path, path)
+        _, size, mtime_ns = self.storage.stat(total_path)
+        if size > MAX_INDEXED_SIZE or not is_text(self.storage.read_range(total_path, start, SNIFF_SIZE)[0]):
+            self.forget(path)
+            self.files[path] = [mtime_ns, size, False]
+            self.dirty = True
+            return
+        terms = self.terms.setdefault(path, set())
+        offset = start
+        leftover = b""
+        while True:
+            block = self.storage.read_range(total_path, offset, BLOCK_SIZE)[0]
+            data = leftover + block
+            base = offset - len(leftover)
+            leftover = b""
+            for match in TOKEN.finditer(data):
+                if block and match.end() == len(data):
+                    leftover = data[match.start():]
+                    break
+                term = str(match.group().lower(), "utf-8", "replace")
+                terms.add(term)
+                offsets = self.postings.setdefault(term, {}).setdefault(path, [])
+                if len(offsets) < MAX_OFFSETS:
+                    offsets.append(base + match.start())
+            offset += len(block)
+            if not block:
+                break
+        self.files[path] = [mtime_ns, size, True]
+        self.dirty = True
+
+    def update(self, path, appended=False):
+        """
+        Queue a file to the indexer after a write.
+
+        Parameters:
+            path : str
+                Path relative to the user directory.
+            appended : bool
+                Only bytes were added at the end.
+        """
+        queue_job(self, self.apply, os.path.normpath(path), appended)
+
+    def apply(self, path, appended=False):
+        """
+        Index a file after a write, a file skipped before stays skipped on append.
+
+        Parameters:
+            path : str
+            appended : bool
+        """
+        with self.lock:
+            stamp = self.files.get(path)
+            if appended and stamp and stamp[2:] == [False]:
+                _, size, mtime_ns = self.storage.stat(join(self.root_path, path))
+                self.files[path] = [mtime_ns, size, False]
+                self.dirty = True
+                return
+            start = stamp[1] if appended and stamp else 0
+            try:
+                self.index(path, start)
+            except FileNotFoundError:
+                self.forget(path)
+
+    def remove(self, path):
+        """
+        Queue a removed file to the indexer.
+
+        Parameters:
+            path : str
+        """
+        queue_job(self, self.discard, os.path.normpath(path))
+
+    def discard(self, path):
+        """
+        Forget a removed file, on the indexer thread.
+
+        Parameters:
+            path : str
+        """
+        with self.lock:
+            self.forget(path)
+
+    def search(self, query):
+        """
+        Files holding every word of a query.
+
+        Parameters:
+            query : str
+
+        Return: list(tuple(path, list(int)))
+            Up to MAX_RESULTS files, sorted, with the offsets of the first word.
+        """
+        terms = [str(term.lower(), "utf-8", "replace") for term in TOKEN.findall(query.encode("utf-8"))]
+        if not terms:
+            return []
+        with self.idle:
+            self.idle.wait_for(lambda: not self.pending, SEARCH_WAIT)
+        with self.lock:
+            matches = self.postings.get(terms[0], {})
+            paths = set(matches)
+            for term in terms[1:]:
+                paths &= set(self.postings.get(term, {}))
+            return [(path, list(matches[path])) for path in sorted(paths)[:MAX_RESULTS]]
+
+    def save(self):
+        """
+        Write the index to a temporary file and rename it in place, if dirty.
+        Called on the indexer thread, or with the lock held, so the index
+        can't change while it is serialized.
+        """
+        if not self.dirty:
+            return
+        self.dirty = False
+        data = json.dumps({"files": self.files, "postings": self.postings})
+        os.makedirs(dirname(self.path), exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=dirname(self.path), prefix=basename(self.path) + ".")
+        try:
+            with os.fdopen(handle, "w") as file:
+                file.write(data)
+            os.replace(temp_path, self.path)
+        except OSError:
+            os.remove(temp_path)
+            raise
+
+
+def get_search_index(user):
+    """
+    Search index of a user, loaded on first use and shared by every handler.
+
+    Parameters:
+        user : str
+
+    Return: Class(SearchIndex)
+        Search index.
+    """
+    with INDEX_LOCK:
+        index = INDEXES.get(user)
+        if index is not None:
+            return index
+        index = INDEXES[user] = SearchIndex(user)
+        # Counted before the lock is released so no search can miss the load.
+        index.pending += 1
+    queue_job(index, index.load, counted=True)
+    return index
+
+def drop_search_index(user):
+    """
+    Forget the search index of a deleted user, on disk too.
+
+    Parameters:
+        user : str
+    """
+    with INDEX_LOCK:
+        index = INDEXES.pop(user, None)
+    path = index.path if index else session_path(".search", user + ".json")
+    if os.path.isfile(path):
+        os.remove(path)
+
+def is_text(sample):
+    """
+    First bytes of a file look like text.
+
+    Parameters:
+        sample : bytes
+
+    Return: bool
+        No NUL and valid UTF-8, a sequence cut at the end is allowed.
+    """
+    if b"\0" in sample:
+        return False
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def queue_job(index, job, *args, counted=False, waited=True):
+    """
+    Queue a job of an index to the indexer thread, starting it once.
+
+    Parameters:
+        index : Class(SearchIndex)
+        job : callable
+            Method of the index run with args.
+        counted : bool
+            pending was raised by the caller.
+        waited : bool
+            Searches wait for the job, False for saves.
+    """
+    global INDEXER
+    if waited and not counted:
+        with index.idle:
+            index.pending += 1
+    JOBS.put((index, job, args, waited))
+    with INDEX_LOCK:
+        if INDEXER is None:
+            INDEXER = threading.Thread(target=run_indexer, args=(), daemon=True)
+            INDEXER.start()
+
+def run_indexer():
+    """
+    Indexer thread loop.
+    """
+    while True:
+        index, job, args, waited = JOBS.get()
+        try:
+            job(*args)
+        except Exception as error:
+            print("Indexing job " + job.__name__ + " of " + index.user + " failed: " + str(error))
+        finally:
+            if waited:
+                with index.idle:
+                    index.pending -= 1
+                    index.idle.notify_all()
+        if waited:
+            schedule_save()
+
+def save_all():
+    """
+    Queue a save of every dirty index to the indexer.
+    """
+    with INDEX_LOCK:
+        indexes = list(INDEXES.values())
+    for index in indexes:
+        if index.dirty:
+            queue_job(index, index.save, waited=False)
+
+def save_at_exit():
+    """
+    Save every dirty index before the process exits, under its lock as the indexer may be busy.
+    """
+    with INDEX_LOCK:
+        indexes = list(INDEXES.values())
+    for index in indexes:
+        with index.lock:
+            index.save()
+
+def schedule_save():
+    """
+    Start the thread saving dirty indexes every FLUSH_DELAY seconds.
+    """
+    global FLUSHER
+    with INDEX_LOCK:
+        if FLUSHER is not None:
+            return
+        def flusher():
+            while True:
+                time.sleep(FLUSH_DELAY)
+                save_all()
+        FLUSHER = threading.Thread(target=flusher, args=(), daemon=True)
+        FLUSHER.start()
+    atexit.register(save_at_exit)
@@ -3,6 +3,15 @@ Main server class, socket attacher to attach socket.
 """
 
 from .soc import SocketAttach
+from .async_soc import AsyncSocketAttach
+from .registry import get_registry
+from .quota import share_usage
+from .metrics import serve_metrics
+from .blob_store import enable_blob_store
+from .rate_limit import RateLimiter
+from .storage import enable_storage, BACKENDS
+
+ENGINES = {"thread": SocketAttach, "asyncio": AsyncSocketAttach}
 
 class Server():
     """
@@ -11,11 +20,35 @@ class Server():
     Attributes:
     -----------------
         soc : Class(SocketAttach)
-            Class to handle all socket connections.
+            Class to handle all socket connections, one of ENGINES.
 
         running : bool
             Is server running.
 
+        metrics_port : int
+            Local port serving the metrics dump, None to disable.
+
+        prefork : bool
+            Run as one of several processes sharing the port and the registry.
+
+        dedup : bool
+            Keep file bodies in the content addressed blob store.
+
+        connection_rate, connection_burst : float
+            Requests per second and burst of every connection, rate 0 for no limit.
+
+        user_rate, user_burst : float
+            Requests per second and burst of every user over all connections, rate 0 for no limit.
+
+        storage : str
+            Storage backend of the files, a key of BACKENDS.
+
+        storage_path : str
+            Database file of the sqlite backend, storage.db in the session root when empty.
+
+        socket_options : dict
+            host, port, backlog, recv_size, send_buffer, recv_buffer and tcp_nodelay of the engine.
+
     Methods:
     -----------------
         listen():
@@ -25,15 +58,40 @@ class Server():
             Detach a socket.
 
     """
-    def __init__(self):
-        self.soc = SocketAttach()
+    def __init__(self, engine="thread", workers=8, queue_size=64, max_connections=1024,
+                 idle_timeout=300, read_timeout=30, metrics_port=9100, prefork=False,
+                 dedup=False, connection_rate=50, connection_burst=100, user_rate=200,
+                 user_burst=400, storage="fs", storage_path="", **socket_options):
+        if storage not in BACKENDS:
+            raise ValueError("Unknown storage backend " + storage)
+        rate_limiter = None
+        if connection_rate or user_rate:
+            rate_limiter = RateLimiter(connection_rate, connection_burst, user_rate, user_burst)
+        self.soc = ENGINES[engine](workers, queue_size, max_connections, idle_timeout,
+                                   read_timeout, reuse_port=prefork, rate_limiter=rate_limiter,
+                                   **socket_options)
+        self.metrics_port = metrics_port
+        self.prefork = prefork
+        self.dedup = dedup
+        self.storage = storage
+        self.storage_path = storage_path
         self.running = True
+        if dedup and storage != "fs":
+            print("Deduplication needs the fs storage backend, it stays off.")
+            self.dedup = False
 
     def listen(self):
         """
         Start listening to clients.
         """
         if self.soc.session_available:
+            get_registry(shared=self.prefork)
+            share_usage(self.prefork)
+            enable_storage(self.storage, self.storage_path)
+            if self.dedup:
+                enable_blob_store()
+            if self.metrics_port:
+                serve_metrics(self.metrics_port)
             self.soc.run_session()
             self.running = False
         else:
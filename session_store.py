@@ -0,0 +1,154 @@
+"""
+Server side sessions so a reconnecting client resumes instead of logging in again.
+"""
+
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+SESSION_TTL = 1800
+MAX_SESSIONS = 65536
+
+class SessionStore():
+    """
+    Session store module
+
+    Maps session tokens to the request handler holding the session, so the
+    user, present directory and read cursors outlive the connection. A
+    session expires ttl seconds after its last request, expired sessions
+    are dropped on the next login or resume. Sessions live in the process
+    that issued them.
+
+    Attributes:
+    -----------------
+        ttl : float
+            Seconds a session lives after its last request.
+
+        max_sessions : int
+            Sessions kept at most, the least recently used go first.
+
+        sessions : OrderedDict{token:[RequestHandler, float]}
+            Handler and expiry of every session, oldest expiry first.
+
+        lock : threading.Lock
+            Guards the sessions.
+
+    Methods:
+    -----------------
+        create(handler):
+            Open a session.
+
+        attach(token, handler):
+            Hand a session over to a new handler.
+
+        touch(token):
+            Extend a session.
+
+        drop(token):
+            Close a session.
+
+        drop_user(user):
+            Close every session of a user.
+
+        evict():
+            Drop expired sessions.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        """
+        Initialize the attributes.
+        """
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def create(self, handler):
+        """
+        Open a session for a logged in handler.
+
+        Parameters:
+            handler : Class(RequestHandler)
+
+        Return: str
+            Session token.
+        """
+        token = secrets.token_hex(16)
+        with self.lock:
+            self.evict()
+            self.sessions[token] = [handler, time.monotonic() + self.ttl]
+            if len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return token
+
+    def attach(self, token, handler):
+        """
+        Hand a session over to a new handler.
+
+        Parameters:
+            token : str
+            handler : Class(RequestHandler)
+
+        Return: Class(RequestHandler) or None
+            Handler that held the session, None if the token is unknown or expired.
+        """
+        with self.lock:
+            self.evict()
+            session = self.sessions.get(token)
+            if session is None:
+                return None
+            previous = session[0]
+            session[0] = handler
+            session[1] = time.monotonic() + self.ttl
+            self.sessions.move_to_end(token)
+        return previous
+
+    def touch(self, token):
+        """
+        Extend a session after a request.
+
+        Parameters:
+            token : str
+        """
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is not None:
+                session[1] = time.monotonic() + self.ttl
+                self.sessions.move_to_end(token)
+
+    def drop(self, token):
+        """
+        Close a session.
+
+        Parameters:
+            token : str
+        """
+        with self.lock:
+            self.sessions.pop(token, None)
+
+    def drop_user(self, user):
+        """
+        Close every session of a user.
+
+        Parameters:
+            user : str
+        """
+        with self.lock:
+            for token in [token for token, session in self.sessions.items()
+                          if session[0].username == user]:
+                del self.sessions[token]
+
+    def evict(self):
+        """
+        Drop expired sessions, the lock must be held.
+        """
+        now = time.monotonic()
+        while self.sessions:
+            token, session = next(iter(self.sessions.items()))
+            if session[1] > now:
+                break
+            del self.sessions[token]
+
+
+SESSIONS = SessionStore()
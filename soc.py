@@ -4,10 +4,20 @@ Socket to listen to port and attach a request handler to every connection.
 
 
 import socket
+import selectors
 import threading
+import time
 import os
 
 from .api import RequestHandler
+from .scheduler import RequestScheduler
+from .protocol import handshake, negotiate, features, send_message, recv_message, batch_response
+from .protocol import FLAG_BATCH, COMPRESS_THRESHOLD, MAX_REQUEST
+from .templates import SERVER_FULL, SERVER_BUSY, TRANSFER_FRAMED_ONLY, rate_limited
+from .profiler import active_profile
+from .config import session_path
+from .transfer import Transfer
+from .metrics import METRICS
 
 class SocketAttach():
     """
@@ -18,6 +28,18 @@ class SocketAttach():
         binding_ip_port : tuple(ip, port)
             Ip and port for socket
 
+        backlog : int
+            Connections the kernel queues before accept.
+
+        recv_size : int
+            Bytes read per recv in raw mode.
+
+        send_buffer, recv_buffer : int
+            SO_SNDBUF and SO_RCVBUF of the sockets, 0 for the kernel default.
+
+        tcp_nodelay : bool
+            Send small responses at once instead of waiting to coalesce them.
+
         session_available : bool
             Session data available
 
@@ -36,6 +58,48 @@ class SocketAttach():
         connection_api : dict{ip:RequestHandler}
             Attach a request handler to ip
 
+        activity : dict{ip:float}
+            Monotonic time of the last request of ip.
+
+        lock : threading.Lock
+            Guards the connection tables.
+
+        max_connections : int
+            Connections served at once, more are turned away.
+
+        idle_timeout : float
+            Seconds a connection may stay silent before it is closed.
+
+        read_timeout : float
+            Seconds a started request may stall before it is closed.
+
+        protocols : dict{ip:int}
+            Protocol version of ip, 0 for raw mode, None before the first message.
+
+        compression : dict{ip:bool}
+            ip accepted zlib compressed responses.
+
+        scheduler : Class(RequestScheduler)
+            Worker pool running the requests, fair queued per tenant.
+
+        transfers : Class(RequestScheduler)
+            Worker pool of the same size running uploads and downloads, so
+            long transfers never hold the request workers. Started by
+            run_session, the connection stays busy until its transfer ends.
+
+        deferred : set(ip)
+            Connections whose request found the queue full, left unread in
+            the socket and not watched until the queue has room again.
+
+        rate_limiter : Class(RateLimiter)
+            Token buckets per connection and per user, None for no limits.
+
+        wakeup_read, wakeup_write : Socket class
+            Socket pair waking manage_connections when a connection frees up.
+
+        reuse_port : bool
+            Bind with SO_REUSEPORT so several processes share the port.
+
     Methods:
     -----------------
         check_session_files():
@@ -55,19 +119,74 @@ class SocketAttach():
 
         respond():
             Respond to client response.
+
+        transfer():
+            Run an upload or download.
+
+        release():
+            Hand a served connection back to manage_connections.
+
+        read_request():
+            Read a request, answering the handshake.
+
+        tenant():
+            Key a connection is fair queued under.
+
+        throttle():
+            Charge a request to the rate limits.
+
+        dispatch():
+            Run a request or a batch on the request handler, under the profiler if one runs.
+
+        handle():
+            Run a request or a batch on the request handler.
+
+        send_response():
+            Send a response in the protocol of the connection.
+
+        wakeup():
+            Wake manage_connections.
+
+        reap_idle():
+            Close connections idle for too long.
+
+        evict():
+            Close a connection and forget it.
     """
 
-    def __init__(self):
+    def __init__(self, workers=8, queue_size=64, max_connections=1024,
+                 idle_timeout=300, read_timeout=30, reuse_port=False, rate_limiter=None,
+                 host="", port=8080, backlog=128, recv_size=4096, send_buffer=0, recv_buffer=0,
+                 tcp_nodelay=False):
         """
         Initialize the attributes.
         """
-        self.binding_ip_port = ("", 8080)
+        self.binding_ip_port = (host, port)
+        self.backlog = backlog
+        self.recv_size = recv_size
+        self.send_buffer = send_buffer
+        self.recv_buffer = recv_buffer
+        self.tcp_nodelay = tcp_nodelay
+        self.reuse_port = reuse_port
         self.session_available = self.check_session_files()
         self.socket_object = self.attach_socket()
         self.connections = []
         self.ips = []
         self.threads = {}
         self.connection_api = {}
+        self.activity = {}
+        self.lock = threading.Lock()
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.protocols = {}
+        self.compression = {}
+        self.scheduler = RequestScheduler(workers, queue_size)
+        self.transfers = None
+        self.deferred = set()
+        METRICS.watch_scheduler(self.scheduler)
+        self.rate_limiter = rate_limiter
+        self.wakeup_read, self.wakeup_write = socket.socketpair()
 
     def check_session_files(self):
         """
@@ -76,7 +195,7 @@ class SocketAttach():
         Return: bool
             Session available or not.
         """
-        if os.path.exists("server_session") and os.path.exists("server_session/server_data"):
+        if os.path.exists(session_path()) and os.path.exists(session_path("server_data")):
             return True
         return False
 
@@ -84,20 +203,28 @@ class SocketAttach():
         """
         Start accepting connections.
         """
+        self.transfers = RequestScheduler(self.scheduler.workers, self.scheduler.queue_size)
         threading.Thread(target=self.connection_accept_async, args=(), daemon=True).start()
         self.manage_connections()
 
     def attach_socket(self):
         """
-        Bind a socket to port 8080.
+        Bind a socket to the configured address, buffers set before listen so accepted sockets inherit them.
 
         Return: Class(Socket)
             Socket object
         """
         socket_object = socket.socket()
+        socket_object.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            socket_object.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if self.send_buffer:
+            socket_object.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        if self.recv_buffer:
+            socket_object.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer)
         socket_object.bind(self.binding_ip_port)
-        socket_object.listen(5)
-        print("Successfully opened server at port 8080")
+        socket_object.listen(self.backlog)
+        print("Successfully opened server at port " + str(self.binding_ip_port[1]))
         return socket_object
     def connection_accept_async(self):
         """
@@ -106,38 +233,314 @@ class SocketAttach():
         while True:
             try:
                 conn, address = self.socket_object.accept()
-                self.socket_object.setblocking(1)
-                self.connections.append(conn)
-                self.ips.append(address)
-                self.threads[address] = False
-                self.connection_api[address] = RequestHandler()
+                if len(self.connections) >= self.max_connections:
+                    conn.send(str.encode(SERVER_FULL))
+                    conn.close()
+                    continue
+                conn.settimeout(self.read_timeout)
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.tcp_nodelay))
+                with self.lock:
+                    self.connections.append(conn)
+                    self.ips.append(address)
+                    self.threads[address] = False
+                    self.protocols[address] = None
+                    self.activity[address] = time.monotonic()
+                    self.connection_api[address] = RequestHandler()
+                METRICS.connection_opened()
+                self.wakeup()
                 print("Connection established from ip :" + address[0])
             except:
                 print("Error in accepting connections")
                 
     def manage_connections(self):
         """
-        Handle threads and its locks.
+        Hand readable connections to the scheduler.
+
+        The selector watches the idle connections, no fd limit unlike
+        select.select, and is brought in line with the connection table on
+        every pass so only this thread touches it.
         """
+        selector = selectors.DefaultSelector()
+        selector.register(self.wakeup_read, selectors.EVENT_READ)
+        registered = set()
         while True:
-            for conn, address in zip(self.connections, self.ips):
-                try:
-                    if not self.threads[address]:
-                        threading.Thread(target=self.respond, args=(conn, address), daemon=True).start()
-                except:
-                    pass
+            idle = {}
+            full = self.scheduler.queue_depth() >= self.scheduler.queue_size
+            with self.lock:
+                for conn, address in zip(self.connections, self.ips):
+                    if not self.threads[address] and not (full and address in self.deferred):
+                        idle[conn] = address
+            # Unregister first, a closed connection's fd may be reused by a new one.
+            for conn in registered - set(idle):
+                registered.discard(conn)
+                selector.unregister(conn)
+            for conn in idle:
+                if conn not in registered:
+                    try:
+                        selector.register(conn, selectors.EVENT_READ)
+                        registered.add(conn)
+                    except (OSError, ValueError):
+                        # Closed by a worker since the table was read, gone next pass.
+                        pass
+            try:
+                readable = [key.fileobj for key, _ in selector.select(min(self.idle_timeout, 5))]
+            except OSError:
+                continue
+            self.reap_idle(idle)
+            for conn in readable:
+                if conn is self.wakeup_read:
+                    self.wakeup_read.recv(4096)
+                    continue
+                address = idle[conn]
+                if address not in self.threads:
+                    continue
+                if address in self.deferred and self.scheduler.queue_depth() >= self.scheduler.queue_size:
+                    # Still no room, it was counted as rejected when first deferred.
+                    continue
+                self.threads[address] = True
+                self.activity[address] = time.monotonic()
+                future = self.scheduler.submit(self.respond, conn, address, key=self.tenant(address))
+                if future is None:
+                    # Reading the request to answer busy would block this thread,
+                    # leave it in the socket until a worker frees a slot.
+                    self.threads[address] = False
+                    self.deferred.add(address)
+                else:
+                    self.deferred.discard(address)
 
     def respond(self, conn, addr):
         """
         Respond to the client.
         """
         try:
-            self.threads[addr] = True
-            client_res = str(conn.recv(4096), "utf-8")
-            response = self.connection_api[addr].respond(client_res)
-            encoded_str = str.encode(response)
-            conn.send(encoded_str)
-            self.threads[addr] = False
+            flags, client_res = self.read_request(conn, addr)
+            if client_res is not None:
+                response = self.throttle(addr, flags, client_res)
+                if response is None:
+                    response = self.dispatch(addr, flags, client_res)
+                else:
+                    flags = 0
+                if isinstance(response, Transfer) and self.protocols[addr]:
+                    if self.transfers.submit(self.transfer, conn, addr, response,
+                                             key=self.tenant(addr)) is not None:
+                        return
+                    # Not run, so nothing was reserved or written yet.
+                    response, flags = str.encode(SERVER_BUSY), 0
+                self.send_response(conn, addr, response, flags)
+            self.release(addr)
         except Exception as exps:
-            print(exps)
+            if not isinstance(exps, ConnectionError):
+                print(exps)
+            self.evict(conn, addr)
+
+    def transfer(self, conn, addr, transfer):
+        """
+        Run an upload or download on the transfer pool.
+
+        Parameters:
+            transfer : Class(Transfer)
+        """
+        started = time.perf_counter()
+        try:
+            transfer.run(conn)
+            record_transfer(transfer, time.perf_counter() - started)
+            self.release(addr)
+        except Exception as exps:
+            if not isinstance(exps, ConnectionError):
+                print(exps)
+            self.evict(conn, addr)
+
+    def release(self, addr):
+        """
+        Mark a served connection idle and wake manage_connections to watch it again.
+        """
+        self.activity[addr] = time.monotonic()
+        self.threads[addr] = False
+        self.wakeup()
+
+    def read_request(self, conn, addr):
+        """
+        Read a request, settling the protocol on the first message.
+
+        Return: tuple(flags, str or None)
+            Message flags and request, None if the message was a handshake.
+        """
+        started = time.perf_counter()
+        if self.protocols[addr]:
+            flags, client_res = recv_message(conn, MAX_REQUEST)
+            METRICS.record_io("read", time.perf_counter() - started, len(client_res))
+            return flags, str(client_res, "utf-8")
+        client_res = conn.recv(self.recv_size)
+        if not client_res:
+            raise ConnectionError("Client disconnected")
+        METRICS.record_io("read", time.perf_counter() - started, len(client_res))
+        if self.protocols[addr] is None:
+            self.protocols[addr] = negotiate(client_res)
+            if self.protocols[addr]:
+                accepted = features(client_res)
+                self.compression[addr] = "zlib" in accepted
+                send_message(conn, handshake(self.protocols[addr], accepted))
+                return 0, None
+        return 0, str(client_res, "utf-8")
 
+    def tenant(self, addr):
+        """
+        Key the requests of a connection are fair queued under.
+
+        Return: str or tuple(ip, port)
+            User once logged in, else the address.
+        """
+        handler = self.connection_api.get(addr)
+        if handler is not None and handler.login_flag:
+            return handler.username
+        return addr
+
+    def throttle(self, addr, flags, client_res):
+        """
+        Charge a request to the rate limits of its connection and user.
+
+        Parameters:
+            flags : int
+            client_res : str
+                A batch costs one token per command.
+
+        Return: bytes or None
+            Retry after response, None to serve the request.
+        """
+        if self.rate_limiter is None:
+            return None
+        cost = client_res.count("\n") + 1 if flags & FLAG_BATCH else 1
+        tenant = self.tenant(addr)
+        wait = self.rate_limiter.check(addr, None if tenant == addr else tenant, cost)
+        if not wait:
+            return None
+        METRICS.record_throttled()
+        return str.encode(rate_limited(wait))
+
+    def dispatch(self, addr, flags, client_res):
+        """
+        Run a request on the request handler of addr, profiled while a profile session runs.
+
+        Parameters:
+            flags : int
+                FLAG_BATCH for newline separated commands.
+            client_res : str
+
+        Return: bytes or Class(Transfer)
+            Encoded response, or a transfer to run.
+        """
+        session = active_profile()
+        if session is not None:
+            command = "batch" if flags & FLAG_BATCH else client_res.split(" ", 1)[0].strip()
+            return session.run(command, self.handle, addr, flags, client_res)
+        return self.handle(addr, flags, client_res)
+
+    def handle(self, addr, flags, client_res):
+        """
+        Run a request on the request handler of addr, unprofiled.
+
+        Parameters:
+            flags : int
+            client_res : str
+
+        Return: bytes or Class(Transfer)
+            Encoded response, or a transfer to run.
+        """
+        if flags & FLAG_BATCH:
+            statements = client_res.split("\n")
+            return batch_response(self.connection_api[addr].respond_batch(statements))
+        response = self.connection_api[addr].respond(client_res)
+        if isinstance(response, Transfer):
+            return response
+        return str.encode(response)
+
+    def send_response(self, conn, addr, response, flags=0):
+        """
+        Send a response framed or raw, transfers of framed connections run on the transfer pool instead.
+
+        Parameters:
+            response : bytes or Class(Transfer)
+            flags : int
+        """
+        started = time.perf_counter()
+        if isinstance(response, Transfer):
+            response = str.encode(TRANSFER_FRAMED_ONLY)
+        if self.protocols[addr]:
+            compress = self.compression.get(addr, False)
+            sent = send_message(conn, response, flags, compress)
+            record_compression(response, sent, compress)
+        else:
+            sent = conn.send(response)
+        METRICS.record_io("write", time.perf_counter() - started, sent)
+
+    def wakeup(self):
+        """
+        Wake manage_connections to pick up a new or freed connection.
+        """
+        self.wakeup_write.send(b"\0")
+
+    def reap_idle(self, idle):
+        """
+        Close connections that sent nothing for idle_timeout seconds.
+
+        Parameters:
+            idle : dict{conn:ip}
+                Connections not being served.
+        """
+        deadline = time.monotonic() - self.idle_timeout
+        for conn, address in idle.items():
+            if self.activity.get(address, deadline) < deadline:
+                self.evict(conn, address)
+
+    def evict(self, conn, addr):
+        """
+        Close a connection and drop its handler and bookkeeping.
+        """
+        with self.lock:
+            if addr not in self.threads:
+                return
+            index = self.ips.index(addr)
+            del self.connections[index]
+            del self.ips[index]
+            del self.threads[addr]
+            del self.protocols[addr]
+            self.compression.pop(addr, None)
+            del self.activity[addr]
+            del self.connection_api[addr]
+            self.deferred.discard(addr)
+        if self.rate_limiter is not None:
+            self.rate_limiter.forget(addr)
+        METRICS.connection_closed()
+        try:
+            conn.close()
+        except OSError:
+            pass
+        print("Connection closed from ip :" + addr[0])
+
+
+def record_transfer(transfer, seconds):
+    """
+    Record the body bytes of a finished transfer.
+
+    Parameters:
+        transfer : Class(Transfer)
+        seconds : float
+    """
+    if transfer.received:
+        METRICS.record_io("read", seconds, transfer.received)
+    if transfer.sent:
+        METRICS.record_io("write", seconds, transfer.sent)
+
+def record_compression(response, sent, compress):
+    """
+    Record the ratio of a response that went out compressed.
+
+    Parameters:
+        response : bytes
+        sent : int
+            Bytes put on the wire.
+        compress : bool
+            Connection accepted compression.
+    """
+    if compress and len(response) >= COMPRESS_THRESHOLD:
+        METRICS.record_compression(len(response), sent)
@@ -0,0 +1,649 @@
+"""
+Storage backends holding the files and folders of every user.
+
+Paths are relative to the session root, "test/testfolder1/a.txt". The
+filesystem backend keeps the tree on disk under the session root as it
+always was, so every feature works on it. The memory backend keeps it in
+process for tests and scratch tenants, the SQLite backend packs it into one
+database file so millions of small files cost no inodes and no opens.
+Downloads, uploads and deduplication need real files and stay on the
+filesystem backend.
+"""
+
+import os
+import shutil
+import sqlite3
+import stat
+import threading
+import time
+from abc import ABC, abstractmethod
+from os.path import join, normpath, dirname, basename
+
+from .config import session_path
+from .chunk_index import get_index, note_append
+from .mmap_cache import get_mapping
+from .blob_store import get_blob_store
+
+STORAGE = None
+STORAGE_LOCK = threading.Lock()
+
+def clean(path):
+    """
+    Normal form of a storage path.
+
+    Parameters:
+        path : str
+
+    Return: str
+        Path without "." parts or trailing separators, "" for the root.
+    """
+    path = normpath(path)
+    return "" if path == "." else path
+
+
+class Storage(ABC):
+    """
+    Storage module
+
+    Interface of the backends, a backend has to implement the abstract
+    methods. walk and read_page are built on the other methods, a backend
+    overrides them when it can do better.
+
+    Methods:
+    -----------------
+        listdir(path):
+            Entries of a folder.
+
+        stat(path):
+            Type, size and mtime of an entry.
+
+        exists(path):
+            Entry is there.
+
+        read_range(path, offset, length):
+            Bytes of a file range.
+
+        read_page(path, page, chars):
+            Page of characters of a file.
+
+        write(path, data):
+            Create or overwrite a file.
+
+        append(path, data):
+            Add to the end of a file.
+
+        mkdir(path):
+            Create a folder.
+
+        rmtree(path):
+            Remove a folder and everything in it.
+
+        walk(path):
+            Folders below a folder, like os.walk.
+
+        local_path(path):
+            Path on disk, None when the backend has no files.
+    """
+
+    @abstractmethod
+    def listdir(self, path):
+        """
+        Entries of a folder in listing order.
+
+        Parameters:
+            path : str
+
+        Return: list(tuple(name, directory))
+            Names and whether they are folders.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def stat(self, path):
+        """
+        Metadata of an entry.
+
+        Parameters:
+            path : str
+
+        Return: tuple(directory, size, mtime_ns)
+            Raises FileNotFoundError if missing.
+        """
+        raise NotImplementedError
+
+    def exists(self, path):
+        """
+        Entry is there.
+
+        Parameters:
+            path : str
+
+        Return: bool
+        """
+        try:
+            self.stat(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    @abstractmethod
+    def read_range(self, path, offset, length):
+        """
+        Bytes of a file range, cut at the end of the file.
+
+        Parameters:
+            path : str
+            offset : int
+            length : int
+
+        Return: tuple(bytes, int)
+            Bytes of the range and size of the file.
+        """
+        raise NotImplementedError
+
+    def read_page(self, path, page, chars):
+        """
+        Page of characters of a file, decoding the whole file.
+
+        Parameters:
+            path : str
+            page : int
+                Wraps around past the last page.
+            chars : int
+                Characters per page.
+
+        Return: tuple(int, str, int)
+            Page read, its characters and the page count.
+        """
+        size = self.stat(path)[1]
+        text = str(self.read_range(path, 0, size)[0], "utf-8", "replace")
+        pages = max(1, -(-len(text) // chars))
+        page = page % pages
+        return page, text[page*chars:(page + 1)*chars], pages
+
+    @abstractmethod
+    def write(self, path, data):
+        """
+        Create or overwrite a file.
+
+        Parameters:
+            path : str
+            data : bytes
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def append(self, path, data):
+        """
+        Add to the end of a file.
+
+        Parameters:
+            path : str
+            data : bytes
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def mkdir(self, path):
+        """
+        Create a folder, its parent must be there.
+
+        Parameters:
+            path : str
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def rmtree(self, path):
+        """
+        Remove a folder and everything below it.
+
+        Parameters:
+            path : str
+        """
+        raise NotImplementedError
+
+    def walk(self, path):
+        """
+        Folders below a folder, top down.
+
+        Parameters:
+            path : str
+
+        Return: generator(tuple(folder, list, list))
+            Folder path, names of its folders and names of its files.
+        """
+        folders, files = [], []
+        for name, directory in self.listdir(path):
+            (folders if directory else files).append(name)
+        yield path, folders, files
+        for name in folders:
+            yield from self.walk(join(path, name))
+
+    def local_path(self, path):
+        """
+        Path of an entry on disk.
+
+        Parameters:
+            path : str
+
+        Return: str or None
+            Disk path, None when the backend keeps no files.
+        """
+        return None
+
+
+class FileSystemStorage(Storage):
+    """
+    File system storage module
+
+    The tree on disk under the session root. Pages go through the chunk
+    index, ranges through the cached memory maps, and writes intern into
+    the blob store in dedup mode.
+    """
+
+    def listdir(self, path):
+        """
+        Entries of a folder from one scandir.
+        """
+        with os.scandir(session_path(path)) as entries:
+            return [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in entries]
+
+    def stat(self, path):
+        """
+        Metadata of an entry from one stat.
+        """
+        result = os.stat(session_path(path))
+        return stat.S_ISDIR(result.st_mode), result.st_size, result.st_mtime_ns
+
+    def read_range(self, path, offset, length):
+        """
+        Bytes of a file range sliced from its cached memory map.
+        """
+        mapped = get_mapping(session_path(path))
+        return mapped.read(offset, length), mapped.size()
+
+    def read_page(self, path, page, chars):
+        """
+        Page of characters read by seeking through the chunk index.
+        """
+        chunks = get_index(session_path(path), chars)
+        page = page % chunks.pages()
+        return page, chunks.read(page), chunks.pages()
+
+    def write(self, path, data):
+        """
+        Create or overwrite a file, linking it to its blob in dedup mode.
+        """
+        total_path = session_path(path)
+        with open(total_path, "wb") as file:
+            file.write(data)
+        if get_blob_store():
+            get_blob_store().intern(total_path)
+
+    def append(self, path, data):
+        """
+        Add to the end of a file, detaching it from a shared blob first.
+        """
+        total_path = session_path(path)
+        if get_blob_store():
+            get_blob_store().detach(total_path)
+        with open(total_path, "ab") as file:
+            file.write(data)
+        note_append(total_path)
+
+    def mkdir(self, path):
+        """
+        Create a folder.
+        """
+        os.mkdir(session_path(path))
+
+    def rmtree(self, path):
+        """
+        Remove a folder and everything below it.
+        """
+        shutil.rmtree(session_path(path))
+
+    def local_path(self, path):
+        """
+        Path of an entry on disk.
+        """
+        return session_path(path)
+
+
+class MemoryEntry():
+    """
+    Memory entry module
+
+    Attributes:
+    -----------------
+        children : dict{name:bool}
+            Names in the folder and whether they are folders, None for a file.
+
+        data : bytearray
+            Body of a file, None for a folder.
+
+        mtime_ns : int
+            Time of the last change.
+    """
+
+    def __init__(self, directory):
+        """
+        Initialize the attributes.
+        """
+        self.children = {} if directory else None
+        self.data = None if directory else bytearray()
+        self.mtime_ns = time.time_ns()
+
+
+class MemoryStorage(Storage):
+    """
+    Memory storage module
+
+    The whole tree in one dict of entries, gone when the process exits.
+
+    Attributes:
+    -----------------
+        entries : dict{path:MemoryEntry}
+            Every folder and file, the root is "".
+
+        lock : threading.Lock
+            Guards the entries.
+    """
+
+    def __init__(self):
+        """
+        Initialize the attributes with an empty root.
+        """
+        self.entries = {"": MemoryEntry(True)}
+        self.lock = threading.Lock()
+
+    def entry(self, path, directory=None):
+        """
+        Entry of a path, the lock must be held.
+
+        Parameters:
+            path : str
+            directory : bool
+                Kind the entry must be, None for either.
+
+        Return: Class(MemoryEntry)
+            Raises FileNotFoundError if missing or of the other kind.
+        """
+        entry = self.entries.get(clean(path))
+        if entry is None or directory is not None and directory != (entry.children is not None):
+            raise FileNotFoundError(path)
+        return entry
+
+    def listdir(self, path):
+        """
+        Entries of a folder.
+        """
+        with self.lock:
+            return list(self.entry(path, True).children.items())
+
+    def stat(self, path):
+        """
+        Metadata of an entry.
+        """
+        with self.lock:
+            entry = self.entry(path)
+            if entry.children is not None:
+                return True, 0, entry.mtime_ns
+            return False, len(entry.data), entry.mtime_ns
+
+    def read_range(self, path, offset, length):
+        """
+        Bytes of a file range.
+        """
+        with self.lock:
+            data = self.entry(path, False).data
+            return bytes(data[offset:offset + length]), len(data)
+
+    def add(self, path, directory):
+        """
+        Add an entry to its parent folder, the lock must be held.
+
+        Parameters:
+            path : str
+            directory : bool
+
+        Return: Class(MemoryEntry)
+            New entry.
+        """
+        path = clean(path)
+        parent = self.entry(dirname(path), True)
+        entry = self.entries[path] = MemoryEntry(directory)
+        parent.children[basename(path)] = directory
+        parent.mtime_ns = entry.mtime_ns
+        return entry
+
+    def write(self, path, data):
+        """
+        Create or overwrite a file.
+        """
+        with self.lock:
+            entry = self.entries.get(clean(path)) or self.add(path, False)
+            if entry.children is not None:
+                raise IsADirectoryError(path)
+            entry.data = bytearray(data)
+            entry.mtime_ns = time.time_ns()
+
+    def append(self, path, data):
+        """
+        Add to the end of a file.
+        """
+        with self.lock:
+            entry = self.entry(path, False)
+            entry.data += data
+            entry.mtime_ns = time.time_ns()
+
+    def mkdir(self, path):
+        """
+        Create a folder.
+        """
+        with self.lock:
+            if clean(path) in self.entries:
+                raise FileExistsError(path)
+            self.add(path, True)
+
+    def rmtree(self, path):
+        """
+        Remove a folder and everything below it.
+        """
+        path = clean(path)
+        with self.lock:
+            folders = [path]
+            while folders:
+                folder = folders.pop()
+                for name, directory in self.entry(folder, True).children.items():
+                    if directory:
+                        folders.append(join(folder, name))
+                    else:
+                        del self.entries[join(folder, name)]
+                del self.entries[folder]
+            parent = self.entries.get(dirname(path))
+            if parent is not None:
+                parent.children.pop(basename(path), None)
+
+
+class SQLiteStorage(Storage):
+    """
+    SQLite storage module
+
+    One row per folder or file in one database, bodies inline as blobs.
+    Every thread keeps its own connection, the database runs in WAL mode
+    so reads don't wait for writes, and every change is its own
+    transaction.
+
+    Attributes:
+    -----------------
+        path : str
+            Database file.
+
+        local : threading.local
+            Connection of each thread.
+    """
+
+    def __init__(self, path=None):
+        """
+        Open the database, creating the table on first use.
+        """
+        self.path = path or session_path("storage.db")
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY,"
+                         " parent TEXT NOT NULL, name TEXT NOT NULL, directory INTEGER NOT NULL,"
+                         " data BLOB, mtime_ns INTEGER NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent)")
+
+    def connection(self):
+        """
+        Connection of the calling thread, opened on first use.
+
+        Return: sqlite3.Connection
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def row(self, path, directory=None):
+        """
+        Kind, size and mtime of a path.
+
+        Parameters:
+            path : str
+            directory : bool
+                Kind the entry must be, None for either.
+
+        Return: tuple(directory, size, mtime_ns)
+            Raises FileNotFoundError if missing or of the other kind.
+        """
+        path = clean(path)
+        if not path:
+            return True, 0, 0
+        row = self.connection().execute(
+            "SELECT directory, length(data), mtime_ns FROM entries WHERE path = ?", (path,)).fetchone()
+        if row is None or directory is not None and directory != bool(row[0]):
+            raise FileNotFoundError(path)
+        return bool(row[0]), row[1] or 0, row[2]
+
+    def listdir(self, path):
+        """
+        Entries of a folder in creation order.
+        """
+        self.row(path, True)
+        rows = self.connection().execute(
+            "SELECT name, directory FROM entries WHERE parent = ? ORDER BY rowid", (clean(path),))
+        return [(name, bool(directory)) for name, directory in rows]
+
+    def stat(self, path):
+        """
+        Metadata of an entry.
+        """
+        return self.row(path)
+
+    def read_range(self, path, offset, length):
+        """
+        Bytes of a file range, only the range leaves the database.
+        """
+        row = self.connection().execute(
+            "SELECT substr(data, ?, ?), length(data) FROM entries WHERE path = ? AND directory = 0",
+            (offset + 1, length, clean(path))).fetchone()
+        if row is None:
+            raise FileNotFoundError(path)
+        return bytes(row[0] or b""), row[1]
+
+    def insert(self, conn, path, directory, data):
+        """
+        Insert an entry under an existing folder.
+
+        Parameters:
+            conn : sqlite3.Connection
+            path : str
+            directory : bool
+            data : bytes
+        """
+        path = clean(path)
+        self.row(dirname(path), True)
+        conn.execute("INSERT INTO entries (path, parent, name, directory, data, mtime_ns)"
+                     " VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET"
+                     " data = excluded.data, mtime_ns = excluded.mtime_ns WHERE directory = 0",
+                     (path, dirname(path), basename(path), int(directory), data, time.time_ns()))
+
+    def write(self, path, data):
+        """
+        Create or overwrite a file.
+        """
+        if self.exists(path) and self.row(path)[0]:
+            raise IsADirectoryError(path)
+        with self.connection() as conn:
+            self.insert(conn, path, False, bytes(data))
+
+    def append(self, path, data):
+        """
+        Add to the end of a file in place.
+        """
+        with self.connection() as conn:
+            cursor = conn.execute("UPDATE entries SET data = CAST(data || ? AS BLOB), mtime_ns = ?"
+                                  " WHERE path = ? AND directory = 0",
+                                  (bytes(data), time.time_ns(), clean(path)))
+            if not cursor.rowcount:
+                raise FileNotFoundError(path)
+
+    def mkdir(self, path):
+        """
+        Create a folder.
+        """
+        if self.exists(path):
+            raise FileExistsError(path)
+        with self.connection() as conn:
+            self.insert(conn, path, True, None)
+
+    def rmtree(self, path):
+        """
+        Remove a folder and every row below it.
+        """
+        path = clean(path)
+        self.row(path, True)
+        # Rows below path sort between "path/" and "path0", "0" follows "/".
+        with self.connection() as conn:
+            conn.execute("DELETE FROM entries WHERE path = ? OR (path >= ? AND path < ?)",
+                         (path, path + "/", path + "0"))
+
+
+BACKENDS = {"fs": FileSystemStorage, "memory": MemoryStorage, "sqlite": SQLiteStorage}
+
+def enable_storage(kind="fs", path=""):
+    """
+    Choose the storage backend of the process.
+
+    Parameters:
+        kind : str
+            A key of BACKENDS.
+        path : str
+            Database file of the sqlite backend, storage.db in the session root when empty.
+
+    Return: Class(Storage)
+        Storage backend.
+    """
+    global STORAGE
+    with STORAGE_LOCK:
+        STORAGE = SQLiteStorage(path) if kind == "sqlite" else BACKENDS[kind]()
+        return STORAGE
+
+def get_storage():
+    """
+    Storage backend of the process, the filesystem unless another was enabled.
+
+    Return: Class(Storage)
+        Storage backend.
+    """
+    global STORAGE
+    with STORAGE_LOCK:
+        if STORAGE is None:
+            STORAGE = FileSystemStorage()
+        return STORAGE
@@ -1,6 +1,8 @@
 """
 All templates for request handlers.
 """
+import time
+
 # --------LOGIN-------------
 LOGIN_TRUE = "\nYou have logged in successfully."
 LOGIN_REQUIRED = "\nYou must be logged in to proceed."
@@ -8,9 +10,26 @@ LOGIN_WRONG_PASSWORD = "\nyo, Wrong password buddy!"
 LOGIN_ALREADY = "\nYo, slow down buddy, you already logged in there!"
 LOGIN_NO_USERNAME = "Yo, Check your username. Its not registered yet."
 
+# --------SERVER-----------
+SERVER_BUSY = "\nYo, server is busy right now. Try again in a moment."
+SERVER_FULL = "\nYo, server is full right now. Try again later."
+RATE_LIMITED = "\nYo, slow down. Retry after "
+
+def rate_limited(seconds):
+    """
+    Rate limited template, the client may send again after seconds.
+    """
+    return RATE_LIMITED + "%.3f" % seconds + " seconds."
+
 # --------ADMIN------------
 ADMIN_REQUIRED = "\nYou must be admin to execute this command."
 
+def server_stats(metrics):
+    """
+    Server metrics template.
+    """
+    return "\n-----   Server metrics   -----\n" + metrics
+
 # -------REGISTER-----------
 REGISTER_USERNAME_UNVAIL = "\nUsername not available.\nChoose Different Username."
 REGISTER_INVALID = "\nInvalid Username / Password Entered."
@@ -19,17 +38,93 @@ REGISTER_SUCCESS = "\nRegistration Successfully done.\nYou are good to do login.
 # ------QUIT-----------------
 LOG_OUT_MSG = "\nYep, You logged out there."
 
+# -----QUOTA----------------------
+QUOTA_EXCEEDED = "\nYo, that would take you over your storage quota. Free some space first."
+QUOTA_INVALID = "\nYo, quota bytes and inodes must be whole numbers."
+
+def quota_success(user, max_bytes, max_inodes):
+    """
+    Quota changed template.
+    """
+    return "\nYep, quota of " + user + " is now " + str(max_bytes) + " bytes, " + str(max_inodes) + " inodes"
+
+def usage_report(used_bytes, used_inodes, max_bytes, max_inodes):
+    """
+    Storage usage template, 0 limits print as unlimited.
+    """
+    return ("\nUsed " + str(used_bytes) + " of " + (str(max_bytes) if max_bytes else "unlimited") + " bytes, "
+            + str(used_inodes) + " of " + (str(max_inodes) if max_inodes else "unlimited") + " inodes")
+
+# -----STORAGE--------------------
+DEDUP_OFF = "\nYo, deduplication is off on this server."
+
+def storage_report(blobs, stored, saved):
+    """
+    Deduplication report template.
+    """
+    return ("\nBlobs : " + str(blobs) + "\nStored : " + str(stored) + " bytes"
+            + "\nSaved by deduplication : " + str(saved) + " bytes")
+
+# -----PROFILE--------------------
+PROFILE_INVALID = "\nYo, use profile start <cprofile|sample> <seconds|requests> <count> [command], or profile stop."
+PROFILE_RUNNING = "\nYo, a profile is running already. Stop it first."
+PROFILE_IDLE = "\nYo, no profile is running."
+
+def profile_started(kind, unit, limit, command):
+    """
+    Profile started template.
+    """
+    return ("\nYep, " + kind + " profiling " + (command or "every command") + " for "
+            + str(limit) + " " + unit + ".")
+
+def profile_written(path):
+    """
+    Profile written template.
+    """
+    return "\nYep, profile written to " + path
+
+# -----SESSION--------------------
+RESUME_INVALID = "\nYo, that session token is unknown or expired. Login again."
+
+def session_token(token):
+    """
+    Session token template.
+    """
+    return "\nSession token : " + token
+
+def resume_success(user):
+    """
+    Resume session template.
+    """
+    return "\nWelcome back " + user + ", your session is resumed."
+
 # ------COMMANDS-------------
 COMMANDS = "\n-----   Commands are as follows   -----"
 COMMANDS += "\nCommands                                    | Description"
 COMMANDS += "\nregister <username> <password> <privileges> | Register a new user."
+COMMANDS += "\nregister <u> <p> <privileges> <bytes> <inodes> | Register a user with a quota (Only for admin)."
+COMMANDS += "\nquota <username> <bytes> <inodes>           | Set the quota of a user, 0 for no limit (Only for admin)."
+COMMANDS += "\nusage                                       | Print your storage usage and quota."
+COMMANDS += "\nstorage                                     | Print space saved by deduplication (Only for admin)."
 COMMANDS += "\nlogin <username> <password>                 | Login."
+COMMANDS += "\nresume <token>                              | Resume the session of a login token."
 COMMANDS += "\ndelete <username> <password>                | Delete the user with <username> (Only for admin)."
 COMMANDS += "\nlist                                        | Print all file and folders."
+COMMANDS += "\nlist -l                                     | Print files and folders with type, size and mtime."
+COMMANDS += "\ntree [depth]                                | Print the folder tree below the current folder, with metadata."
 COMMANDS += "\nchange_folder <name>                        | Change current folder to <name>."
 COMMANDS += "\nread_file <name>                            | Read file with <name>."
+COMMANDS += "\nread_range <name> <offset> <length>         | Read <length> bytes of file <name> from byte <offset>."
+COMMANDS += "\nsearch <term>                               | Find your files holding <term>, with byte offsets for read_range."
+COMMANDS += "\nwindow <size>                               | Show <size> characters per read_file."
 COMMANDS += "\nwrite_file <name> <input>                   | Write <input> to file <name>."
 COMMANDS += "\ncreate_folder <name>                        | Create a new folder with <name>."
+COMMANDS += "\ndownload <name>                             | Download the whole file <name>."
+COMMANDS += "\nupload <name> <size>                        | Upload <size> bytes to file <name>, resumable."
+COMMANDS += "\nprofile start <kind> <unit> <count> [cmd]   | Profile (cprofile or sample) for <count> seconds or requests (Only for admin)."
+COMMANDS += "\nprofile stop                                | Stop profiling and write the result (Only for admin)."
+COMMANDS += "\nstats                                       | Print server metrics (Only for admin)."
+COMMANDS += "\nbatch <command>; <command>; ...            | Run commands in one round trip (client side)."
 
 
 # -----DELETE---------------------
@@ -63,14 +158,51 @@ def list_folder(total_list):
     """
     return "\n" + "\n".join(total_list)
 
+TREE_INVALID = "\nYo, depth must be a whole number from 1 up."
+
+def tree_listing(entries):
+    """
+    Tree listing template, one line per entry with type, size and mtime.
+    """
+    lines = []
+    for path, directory, size, mtime_ns in entries:
+        mtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mtime_ns // 1000000000))
+        lines.append(("d " if directory else "f ") + str(size).rjust(12) + "  " + mtime + "  " + path + ("/" if directory else ""))
+    return "\n" + "\n".join(lines)
+
 # ------READ FILE--------------
 READ_WRONG_PATH = "\nYo, check your path again. Its Wrong."
 
-def read_file(start, data):
+def read_file(start, data, window=100):
     """
     Read file template.
     """
-    return "\n" + "--------------------------FILE READER------------------------------\n-----------Currently showing characters " + start + " to " + str(int(start) + 100) + "------------------- \n" + data
+    return "\n" + "--------------------------FILE READER------------------------------\n-----------Currently showing characters " + start + " to " + str(int(start) + window) + "------------------- \n" + data
+
+MAX_WINDOW = 1 << 20
+READ_RANGE_INVALID = "\nYo, offset and length must be whole numbers, length 1 to " + str(MAX_WINDOW) + "."
+WINDOW_INVALID = "\nYo, window must be a whole number from 1 to " + str(MAX_WINDOW) + "."
+
+def read_range(offset, length, size, data):
+    """
+    Read range template.
+    """
+    return "\n-----------Bytes " + str(offset) + " to " + str(offset + length) + " of " + str(size) + "------------------- \n" + data
+
+SEARCH_EMPTY = "\nYo, nothing matched your search."
+
+def search_results(results):
+    """
+    Search results template.
+    """
+    lines = [path + " @ " + ",".join(str(offset) for offset in offsets) for path, offsets in results]
+    return "\n-----------" + str(len(results)) + " files matched------------------- \n" + "\n".join(lines)
+
+def window_success(size):
+    """
+    Window changed template.
+    """
+    return "\nYep, read_file now shows " + str(size) + " characters at a time."
 
 # ------WRITE FLE--------------
 WRITE_NEW_PATH = "\nWritten in new file."
@@ -79,3 +211,15 @@ WRITE_EXISTING = "\nCompleted."
 # ------CREATE FOLDER----------
 DIRECTORY_SUCCESS = "\nCompleted making a new directory!"
 DIRECTORY_PRESENT = "\nDirectory exists already!"
+
+# ------DOWNLOAD / UPLOAD------
+TRANSFER_FRAMED_ONLY = "\nYo, downloads and uploads need the framed protocol. Update your client."
+TRANSFER_IN_BATCH = "\nYo, downloads and uploads can't run inside a batch."
+UPLOAD_INVALID = "\nYo, check your upload name and size again."
+TRANSFER_LOCAL_ONLY = "\nYo, downloads and uploads need the filesystem storage backend."
+
+def upload_success(size, checksum):
+    """
+    Upload complete template.
+    """
+    return "\nUpload complete, " + str(size) + " bytes, sha256 " + checksum
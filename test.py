@@ -2,15 +2,68 @@ import unittest
 import sys
 import random
 import string
+import json
+import os
+import shutil
+import tempfile
+import socket
+import threading
+import time
+import pstats
+import zlib
+import re
+import io
+import asyncio
+import signal
+import subprocess
 
-from api import RequestHandler
-from templates import *
+from .api import RequestHandler
+from .registry import UserRegistry
+from .chunk_index import get_index, note_append, STRIDE
+from .metrics import Histogram, Metrics, serve_metrics
+from .client import token_of, retry_after, ClientPool, AsyncClientPool
+from .rate_limit import TokenBucket, RateLimiter
+from .scheduler import RequestScheduler
+from .profiler import ProfileSession
+from .config import load_config, server_options, session_path, DEFAULTS
+from .storage import Storage, MemoryStorage, SQLiteStorage
+from .quota import get_usage, StorageUsage
+from .blob_store import BlobStore
+from .transfer import receive_download
+from .bench import free_port
+from .search_index import SearchIndex, get_search_index
+from .soc import SocketAttach
+from .async_soc import AsyncSocketAttach
+from .protocol import handshake, batch_request, batch_results
+from .protocol import send_message, recv_message, HEADER, FLAG_MORE, FLAG_BATCH, FLAG_FILE, FLAG_COMPRESSED
+from .protocol import FRAME_SIZE, MAX_REQUEST
+from .templates import *
 
 def random_folder(string_length=6):
     """Generate a random string of fixed length """
     letters = string.ascii_lowercase
     return ''.join(random.choice(letters) for i in range(string_length))
 
+def start_engine(engine, **options):
+    """Serve a socket engine on a free loopback port, return it and the port """
+    attach = engine(host="127.0.0.1", port=0, **options)
+    threading.Thread(target=attach.run_session, args=(), daemon=True).start()
+    return attach, attach.socket_object.getsockname()[1]
+
+def framed_connection(port):
+    """Open a connection and settle the framed protocol """
+    conn = socket.create_connection(("127.0.0.1", port), timeout=5)
+    conn.sendall(handshake())
+    recv_message(conn)
+    return conn
+
+def wait_until(condition, timeout=5):
+    """Poll a condition until it holds or the timeout passes """
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
 
 class ReqClassTestingStepOne(unittest.TestCase):
     """Handles the test for command and quit response"""
@@ -39,6 +92,184 @@ class ReqClassTestingStepOne(unittest.TestCase):
 
         self.assertListEqual(results, expected_results)
 
+    def test_commands_batch(self):
+        """
+        This test will check a batch runs in order with sequence numbers,
+        commands missing their arguments answered instead of failing the batch.
+        """
+        expected_results = [[0, COMMANDS], [1, "Check your input again"], [2, "Check your input again"],
+                            [3, "Check your input again"], [4, LOG_OUT_MSG], [5, "Invalid command"]]
+
+        req_handle = RequestHandler()
+
+        results = req_handle.respond_batch(["commands", "change_folder", "delete test", "read_file",
+                                            "quit", "bogus"])
+
+        self.assertListEqual(results, expected_results)
+
+
+    def test_compressed_frames(self):
+        """
+        This test will check a multi frame message survives compression and shrinks.
+        """
+        payload = ("\n".join("folder" + str(number) for number in range(40000))).encode()
+        left, right = socket.socketpair()
+        left.settimeout(5)
+        right.settimeout(5)
+        results = []
+        sender = threading.Thread(target=lambda: results.append(send_message(left, payload, FLAG_BATCH, True)))
+        sender.start()
+        flags, received = recv_message(right)
+        sender.join()
+        left.close()
+        right.close()
+
+        self.assertGreater(len(payload), FRAME_SIZE)
+        self.assertEqual((flags, received), (FLAG_BATCH, payload))
+        self.assertLess(results[0], len(payload) // 3)
+
+    def test_frame_limits(self):
+        """
+        This test will check oversized frames and messages are refused.
+        Test1 : Frame over FRAME_SIZE.
+        Test2 : Message over the limit across FLAG_MORE frames.
+        Test3 : Compressed message inflating over the limit.
+        """
+        results = []
+        bomb = zlib.compress(bytes(MAX_REQUEST * 4))
+        for message, limit in [(HEADER.pack(0, FRAME_SIZE + 1) + bytes(FRAME_SIZE + 1), MAX_REQUEST),
+                               (HEADER.pack(FLAG_MORE, FRAME_SIZE) + bytes(FRAME_SIZE) +
+                                HEADER.pack(0, 11) + bytes(11), FRAME_SIZE + 10),
+                               (HEADER.pack(FLAG_COMPRESSED, len(bomb)) + bomb, MAX_REQUEST)]:
+            left, right = socket.socketpair()
+            right.settimeout(5)
+            left.sendall(message)
+            try:
+                recv_message(right, limit)
+                results.append(None)
+            except ConnectionError as error:
+                results.append(str(error))
+            left.close()
+            right.close()
+
+        self.assertListEqual(results, ["Frame of 65537 bytes over FRAME_SIZE",
+                                       "Message over 65546 bytes",
+                                       "Message inflates over " + str(MAX_REQUEST) + " bytes"])
+
+    def test_rate_limits(self):
+        """
+        This test will check token buckets and the limiter.
+        Test1 : Burst passes, the next request waits one token.
+        Test2 : Tokens refill with time.
+        Test3 : A user limit spans connections, a refused request costs nothing.
+        """
+        bucket = TokenBucket(10, 3, now=0)
+        results = [bucket.take(1, 0) for _ in range(4)]
+        results.append(bucket.take(1, 0.1))
+        limiter = RateLimiter(0, 0, 1, 2)
+        results += [limiter.check(("a", 1), "test"), limiter.check(("b", 2), "test", 2),
+                    limiter.check(("b", 2), "test"), limiter.check(("c", 3))]
+
+        self.assertEqual(results[:5], [0, 0, 0, 0.1, 0])
+        self.assertEqual(results[5], 0)
+        self.assertGreater(results[6], 0.9)
+        self.assertListEqual(results[7:], [0, 0])
+        self.assertAlmostEqual(retry_after(rate_limited(0.25)), 0.25)
+        self.assertIsNone(retry_after(SERVER_BUSY))
+
+    def test_fair_scheduler(self):
+        """
+        This test will check queued calls run round robin over keys.
+        Test1 : Calls run round robin.
+        Test2 : Queue counters are in the metrics dump.
+        """
+        scheduler = RequestScheduler(1, 16)
+        gate = threading.Event()
+        order = []
+        scheduler.submit(gate.wait)
+        futures = [scheduler.submit(order.append, key + str(n), key=key)
+                   for key, n in [("a", 1), ("a", 2), ("a", 3), ("b", 1), ("c", 1), ("b", 2)]]
+        gate.set()
+        for future in futures:
+            future.result(5)
+
+        metrics = Metrics()
+        metrics.watch_scheduler(scheduler)
+        lines = metrics.render().split("\n")
+
+        self.assertListEqual(order, ["a1", "b1", "c1", "a2", "b2", "a3"])
+        self.assertIn("kvn_queue_depth 0", lines)
+        self.assertIn("kvn_queue_submitted_total 7", lines)
+
+    def test_profile_session(self):
+        """
+        This test will check profile sessions end after their requests and write their files.
+        Test1 : cprofile of one command writes pstats holding the profiled call.
+        Test2 : sample of one command writes collapsed stacks of the running call.
+        """
+        folder = tempfile.mkdtemp()
+        def busy(seconds):
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                pass
+            return seconds
+        session = ProfileSession("cprofile", "requests", 2, "list", folder)
+        results = [session.run("list", busy, 0.01), session.run("stats", busy, 0), session.path,
+                   session.run("list", busy, 0.01)]
+        names = [function[2] for function in pstats.Stats(session.path).stats]
+        sampler = ProfileSession("sample", "requests", 1, "list", folder)
+        sampler.run("list", busy, 0.1)
+        with open(sampler.path) as file:
+            stacks = file.read()
+        shutil.rmtree(folder)
+
+        self.assertListEqual(results, [0.01, 0, None, 0.01])
+        self.assertIn("busy", names)
+        self.assertIn("test.py:busy", stacks)
+
+    def test_config_sources(self):
+        """
+        This test will check settings from file, environment and command line in order.
+        Test1 : Command line beats environment beats file.
+        Test2 : Legacy positionals and boolean flags.
+        Test3 : Boolean flag takes a true or false word after it.
+        Test4 : Unknown settings and bad values are refused.
+        """
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as file:
+            json.dump({"port": 9000, "backlog": 512, "workers": 4}, file)
+        settings = load_config(["--config", file.name, "--workers=16", "asyncio", "2", "dedup",
+                                "--tcp-nodelay"], {"KVN_BACKLOG": "1024", "KVN_PORT": "9001"})
+        flags = load_config(["--dedup", "false", "--tcp-nodelay", "off", "asyncio", "--no-dedup"], {})
+        errors = []
+        for argv in (["--bogus", "1"], ["--port", "x"], ["--workers", "0"], ["--engine", "bogus"],
+                     ["--storage", "disk"]):
+            try:
+                load_config(argv, {})
+            except ValueError as exps:
+                errors.append(str(exps))
+        os.remove(file.name)
+
+        self.assertEqual([settings[name] for name in ("port", "backlog", "workers", "engine",
+                                                      "processes", "dedup", "tcp_nodelay")],
+                         [9001, 1024, 16, "asyncio", 2, True, True])
+        self.assertEqual(settings["page_size"], DEFAULTS["page_size"])
+        self.assertNotIn("session_root", server_options(settings))
+        self.assertEqual([flags[name] for name in ("dedup", "tcp_nodelay", "engine")],
+                         [False, False, "asyncio"])
+        self.assertEqual(len(errors), 5)
+
+    def test_latency_percentiles(self):
+        """
+        This test will check histogram percentiles stay within a bucket.
+        """
+        histogram = Histogram()
+        for millisecond in range(1, 101):
+            histogram.observe(millisecond / 1000)
+
+        for fraction, expected in [(0.5, 0.050), (0.95, 0.095), (0.99, 0.099)]:
+            self.assertGreaterEqual(histogram.percentile(fraction), expected)
+            self.assertLessEqual(histogram.percentile(fraction), expected * 1.1)
+
 
 class ReqClassTestingStepTwo(unittest.TestCase):
     """Handles the tests for login and listing the files"""
@@ -52,7 +283,6 @@ class ReqClassTestingStepTwo(unittest.TestCase):
         """
         req_handle = RequestHandler()
         req_handle.user_passwords = {"test":"123"}
-        expected_results = [LOGIN_WRONG_PASSWORD, LOGIN_NO_USERNAME, LOGIN_TRUE]
         results = []
         tests = [
             ["test", "1234"],
@@ -63,9 +293,139 @@ class ReqClassTestingStepTwo(unittest.TestCase):
         for test in tests:
             results.append(req_handle.login(
                 test[0], test[1]))
+        expected_results = [LOGIN_WRONG_PASSWORD, LOGIN_NO_USERNAME,
+                            LOGIN_TRUE + session_token(req_handle.token)]
 
         self.assertListEqual(results, expected_results)
 
+    def test_server_resume(self):
+        """
+        This test will check resume.
+        Test1 : Unknown token
+        Test2 : Resume keeps the folder and read cursors
+        Test3 : Token is gone after quit
+        """
+        req_handle = RequestHandler()
+        req_handle.user_passwords = {"test":"123"}
+        req_handle.login("test", "123")
+        req_handle.change_folder("testfolder1")
+        req_handle.read_record = {"test_read.txt":3}
+        token = req_handle.token
+        resumed = RequestHandler()
+        results = [resumed.resume("nosuchtoken"), resumed.resume(token)]
+        state = [resumed.username, resumed.present_directory, resumed.read_record]
+        resumed.quit()
+        results.append(RequestHandler().resume(token))
+
+        self.assertListEqual(results, [RESUME_INVALID, resume_success("test"), RESUME_INVALID])
+        self.assertListEqual(state, ["test", "testfolder1", {"test_read.txt":3}])
+
+    def test_client_login_token(self):
+        """
+        This test will check the client reads the token of a login response.
+        """
+        req_handle = RequestHandler()
+        req_handle.user_passwords = {"test":"123"}
+        refused = token_of(req_handle.login("test", "1234"))
+        token = token_of(req_handle.login("test", "123"))
+
+        self.assertIsNone(refused)
+        self.assertEqual(token, req_handle.token)
+
+    def test_client_pools(self):
+        """
+        This test will check the blocking and asyncio client pools over loopback.
+        Test1 : Checked out connection logs in on first use.
+        Test2 : Pipelined replies come back in order.
+        Test3 : Connection dropped by the server reconnects and resumes its session, folder included.
+        """
+        attach, port = start_engine(SocketAttach)
+        expected = [ch_dir_success("testfolder1"), read_file("0", "DontChangeThisContent")]
+        def drop_connections():
+            with attach.lock:
+                served = list(zip(attach.connections, attach.ips))
+            for conn, address in served:
+                attach.evict(conn, address)
+        results = []
+        pool = ClientPool(port=port, retries=2, backoff=0.01)
+        with pool.connection("test", "123") as conn:
+            results.append(conn.request("list") == list_folder(["testfolder1"]) and conn.token is not None)
+            token = conn.token
+        results.append(pool.pipeline("test", "123", ["change_folder testfolder1", "read_file test_read.txt"]))
+        drop_connections()
+        results.append(pool.request("test", "123", "read_file test_read.txt"))
+        with pool.connection("test", "123") as conn:
+            results.append(conn.token == token)
+        pool.close()
+        async def run_async_pool():
+            pool = AsyncClientPool(port=port, retries=2, backoff=0.01)
+            async with pool.connection("test", "123") as conn:
+                results.append(await conn.request("list") == list_folder(["testfolder1"]) and
+                               conn.token is not None)
+                token = conn.token
+            results.append(await pool.pipeline("test", "123", ["change_folder testfolder1",
+                                                               "read_file test_read.txt"]))
+            drop_connections()
+            results.append(await pool.request("test", "123", "read_file test_read.txt"))
+            async with pool.connection("test", "123") as conn:
+                results.append(conn.token == token)
+            pool.close()
+        asyncio.run(run_async_pool())
+
+        self.assertListEqual(results, [True, expected, expected[1], True] * 2)
+
+    def test_asyncio_engine(self):
+        """
+        This test will check the asyncio engine over loopback.
+        Test1 : Framed login.
+        Test2 : Framed command in the folder changed to.
+        Test3 : Batch runs in order.
+        Test4 : Raw mode login.
+        """
+        attach, port = start_engine(AsyncSocketAttach)
+        conn = framed_connection(port)
+        results = []
+        for command in ("login test 123", "change_folder testfolder1", "read_range test_read.txt 0 4"):
+            send_message(conn, str.encode(command))
+            results.append(str(recv_message(conn)[1], "utf-8"))
+        send_message(conn, batch_request(["read_range test_read.txt 4 6", "bogus"]), FLAG_BATCH)
+        results.append(batch_results(recv_message(conn)[1]))
+        conn.close()
+        raw = socket.create_connection(("127.0.0.1", port), timeout=5)
+        raw.sendall(b"login test 123")
+        results.append(str(raw.recv(4096), "utf-8"))
+        raw.close()
+
+        self.assertTrue(results[0].startswith(LOGIN_TRUE))
+        self.assertListEqual(results[1:4], [ch_dir_success("testfolder1"), read_range(0, 4, 21, "Dont"),
+                                            [[0, read_range(4, 6, 21, "Change")], [1, "Invalid command"]]])
+        self.assertTrue(results[4].startswith(LOGIN_TRUE))
+
+    def test_connection_lifecycle(self):
+        """
+        This test will check both engines cap, evict and reap connections over loopback.
+        Test1 : Connection over max_connections is turned away with server full.
+        Test2 : Closed connection is evicted.
+        Test3 : Idle connection is closed after idle_timeout.
+        """
+        results = []
+        for engine in (SocketAttach, AsyncSocketAttach):
+            attach, port = start_engine(engine, max_connections=1, idle_timeout=0.5)
+            first = framed_connection(port)
+            second = socket.create_connection(("127.0.0.1", port), timeout=5)
+            results.append(str(second.recv(4096), "utf-8"))
+            second.close()
+            first.close()
+            results.append(wait_until(lambda: not attach.connection_api))
+            idle = framed_connection(port)
+            started = time.monotonic()
+            results.append(idle.recv(4096))
+            results.append(0.4 < time.monotonic() - started < 4)
+            results.append(wait_until(lambda: not attach.connection_api))
+            idle.close()
+
+        self.assertListEqual(results, [SERVER_FULL, True, b"", True, True] * 2)
+
     def test_server_list(self):
         """
         This test will check list command.
@@ -82,8 +442,133 @@ class ReqClassTestingStepTwo(unittest.TestCase):
 
         self.assertListEqual(results, expected_results)
 
-        
- class ReqClassTestingStepThree(unittest.TestCase):
+    def test_registry_write_behind(self):
+        """
+        This test will check a burst of registrations costs one write.
+        """
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "server_data")
+        shutil.copy("server_session/server_data", path)
+        registry = UserRegistry(path, flush_delay=60)
+        users = ["test" + random_folder() for _ in range(20)]
+        for user in users:
+            registry.add_user(user, "123", "user")
+        registry.flush()
+        with open(path) as file:
+            data = json.load(file)
+        shutil.rmtree(folder)
+
+        self.assertEqual(registry.writes, 1)
+        self.assertTrue(all(user in data["passwords"][0] for user in users))
+
+    def test_registry_shared(self):
+        """
+        This test will check a shared registry sees users added and removed by another process.
+        """
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "server_data")
+        shutil.copy("server_session/server_data", path)
+        first = UserRegistry(path, shared=True)
+        second = UserRegistry(path, shared=True)
+        user = "test" + random_folder()
+        first.add_user(user, "123", "user")
+        second.refresh()
+        added = user in second.passwords
+        taken = second.add_user(user, "456", "user")
+        second.remove_user(user)
+        first.refresh()
+        shutil.rmtree(folder)
+
+        self.assertTrue(added)
+        self.assertFalse(taken)
+        self.assertNotIn(user, first.passwords)
+
+
+    def test_prefork_supervisor(self):
+        """
+        This test will check a pre-forked server shares its registry and stops cleanly.
+        Test1 : User registered on one connection logs in on others.
+        Test2 : Both workers served connections.
+        Test3 : SIGTERM stops the supervisor and its workers.
+        """
+        port, metrics_port = free_port(), free_port(2)
+        env = dict(os.environ)
+        package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = package_parent + os.pathsep + env.get("PYTHONPATH", "")
+        code = ("from " + __package__ + ".prefork import Supervisor\n"
+                "Supervisor('thread', 2, metrics_port=" + str(metrics_port) + ", host='127.0.0.1', port=" +
+                str(port) + ").run()")
+        supervisor = subprocess.Popen([sys.executable, "-c", code], env=env, stdout=subprocess.DEVNULL)
+        def metrics_of(slot):
+            try:
+                with socket.create_connection(("127.0.0.1", metrics_port + slot), timeout=5) as conn:
+                    return str(conn.makefile("rb").read(), "utf-8")
+            except OSError:
+                return None
+        def request(conn, command):
+            send_message(conn, str.encode(command))
+            return str(recv_message(conn)[1], "utf-8")
+        try:
+            ready = wait_until(lambda: bool(metrics_of(0) and metrics_of(1)), timeout=10)
+            user = "fork" + random_folder()
+            conn = framed_connection(port)
+            results = [ready, request(conn, "register " + user + " 123 user")]
+            conn.close()
+            logins = []
+            for _ in range(16):
+                conn = framed_connection(port)
+                logins.append(request(conn, "login " + user + " 123").startswith(LOGIN_TRUE))
+                conn.close()
+            results.append(all(logins))
+            served = [re.search(r"^kvn_connections_total (\d+)$", metrics_of(slot), re.M).group(1)
+                      for slot in (0, 1)]
+            results.append(all(int(count) > 0 for count in served))
+            conn = framed_connection(port)
+            request(conn, "login admin adm")
+            results.append(request(conn, "delete " + user + " adm"))
+            conn.close()
+        finally:
+            supervisor.send_signal(signal.SIGTERM)
+            results.append(supervisor.wait(10))
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=5).close()
+            results.append(True)
+        except ConnectionRefusedError:
+            results.append(False)
+
+        self.assertListEqual(results, [True, REGISTER_SUCCESS, True, True, delete_success(user), 0, False])
+
+    def test_server_stats(self):
+        """
+        This test will check the stats command and the metrics port.
+        Test1 : Non admin is refused.
+        Test2 : Admin gets one metric per line.
+        Test3 : Metrics port serves the same metrics.
+        """
+        req_handle = RequestHandler()
+        req_handle.login("test", "123")
+        refused = req_handle.stats()
+        req_handle.quit()
+        req_handle.login("admin", "adm")
+        stats = req_handle.stats().strip().split("\n")[1:]
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        serve_metrics(port)
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as conn:
+            served = b""
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                served += chunk
+        served = str(served, "utf-8").split("\n")
+
+        self.assertEqual(refused, ADMIN_REQUIRED)
+        self.assertTrue(stats and all(line.startswith("kvn_") and " " in line for line in stats))
+        self.assertTrue({line.split(" ")[0] for line in stats} <= {line.split(" ")[0] for line in served})
+
+class ReqClassTestingStepThree(unittest.TestCase):
     """Handles the tests to check response for change folder and create folder"""
 
     def test_server_change_folder(self):
@@ -117,11 +602,99 @@ class ReqClassTestingStepTwo(unittest.TestCase):
         req_handle.login("test", "123")
         results.append(req_handle.create_folder("testfolder1"))
         req_handle.change_folder("testfolder1")
-        results.append(req_handle.create_folder("test" + random_folder())
+        results.append(req_handle.create_folder("test" + random_folder()))
 
         self.assertListEqual(results, expected_results)
 
 
+    def test_server_folder_index(self):
+        """
+        This test will check the directory index follows new folders and files.
+        Test1 : New folder is listed and can be entered.
+        Test2 : New file is listed in it.
+        Test3 : Leaving the user directory is refused.
+        Test4 : File written behind the index, as by another prefork worker, is appended to.
+        """
+        folder = "test" + random_folder()
+        req_handle = RequestHandler()
+        req_handle.user_passwords = {"test":"123"}
+        req_handle.login("test", "123")
+        req_handle.create_folder(folder)
+        results = [folder in req_handle.list().split("\n"), req_handle.change_folder(folder)]
+        req_handle.write_file("new.txt", "content")
+        results.append(req_handle.list())
+        results.append(req_handle.change_folder("../.."))
+        with open(req_handle.get_total_path("other.txt"), "w") as file:
+            file.write("first")
+        results.append(req_handle.write_file("other.txt", "second"))
+        with open(req_handle.get_total_path("other.txt")) as file:
+            results.append(file.read())
+        req_handle.change_folder("..")
+        shutil.rmtree(req_handle.get_total_path(folder))
+        req_handle.directories().remove(req_handle.present_directory, folder)
+        for name in ("new.txt", "other.txt"):
+            get_search_index("test").remove(os.path.join(folder, name))
+
+        self.assertListEqual(results, [True, ch_dir_success(folder), "\nnew.txt", INCORRECT_DIRECTORY,
+                                       WRITE_EXISTING, "first\nsecond"])
+
+    def test_server_user_confinement(self):
+        """
+        This test will check paths leaving the user directory reach nothing.
+        Test1 : Read and read_range of another user's file are refused.
+        Test2 : Write to another user's file is refused and leaves it alone.
+        Test3 : Folder outside the user directory is refused.
+        """
+        other = "other" + random_folder()
+        os.makedirs(session_path(other))
+        with open(session_path(other, "secret.txt"), "w") as file:
+            file.write("secret")
+        req_handle = RequestHandler()
+        req_handle.user_passwords = {"test":"123"}
+        req_handle.login("test", "123")
+        path = "../" + other + "/secret.txt"
+        results = [req_handle.read_file(path), req_handle.read_range(path, "0", "6"),
+                   req_handle.write_file(path, "x"), req_handle.create_folder("../" + other + "2")]
+        with open(session_path(other, "secret.txt")) as file:
+            results.append(file.read())
+        results.append(os.path.exists(session_path(other + "2")))
+        shutil.rmtree(session_path(other))
+
+        self.assertListEqual(results, [READ_WRONG_PATH, READ_WRONG_PATH, READ_WRONG_PATH,
+                                       INCORRECT_DIRECTORY, "secret", False])
+
+    def test_server_tree(self):
+        """
+        This test will check tree listings and their cached metadata.
+        Test1 : Depth 1 lists the folder alone.
+        Test2 : Whole tree with sizes.
+        Test3 : Append refreshes the cached size.
+        """
+        folder = "test" + random_folder()
+        req_handle = RequestHandler()
+        req_handle.user_passwords = {"test":"123"}
+        req_handle.login("test", "123")
+        req_handle.create_folder(folder)
+        req_handle.change_folder(folder)
+        req_handle.write_file("new.txt", "content")
+        req_handle.change_folder("..")
+        first = req_handle.directories().tree("", 1)
+        results = [[entry[:2] for entry in first], req_handle.directories().tree(folder)]
+        req_handle.change_folder(folder)
+        req_handle.write_file("new.txt", "more")
+        results.append(req_handle.directories().tree(folder)[0][2])
+        listing = req_handle.execute("list -l")
+        req_handle.change_folder("..")
+        shutil.rmtree(req_handle.get_total_path(folder))
+        req_handle.directories().remove(req_handle.present_directory, folder)
+        get_search_index("test").remove(os.path.join(folder, "new.txt"))
+
+        self.assertCountEqual(results[0], [("testfolder1", True), (folder, True)])
+        self.assertEqual([entry[:3] for entry in results[1]], [("new.txt", False, 7)])
+        self.assertEqual(results[2], 12)
+        self.assertTrue(listing.startswith("\nf           12  ") and listing.endswith("  new.txt"))
+
+
 class ReqClassTestingStepFour(unittest.TestCase):
     """Handles the final part of the tests inculting tests for read and write the files"""
 
@@ -142,6 +715,169 @@ class ReqClassTestingStepFour(unittest.TestCase):
 
         self.assertListEqual(results, expected_results)
 
+    def test_server_download(self):
+        """
+        This test will check downloads over loopback on both engines.
+        Test1 : Size frame flagged as a file.
+        Test2 : Body sent with sendfile matches the file byte for byte.
+        Test3 : Missing file is answered with wrong path.
+        """
+        results = []
+        for engine in (SocketAttach, AsyncSocketAttach):
+            _, port = start_engine(engine)
+            conn = framed_connection(port)
+            for command in ("login test 123", "change_folder testfolder1"):
+                send_message(conn, str.encode(command))
+                recv_message(conn)
+            send_message(conn, b"download test_read.txt")
+            flags, size = recv_message(conn)
+            results.append((flags, size))
+            body = io.BytesIO()
+            receive_download(conn, body, int(size))
+            results.append(body.getvalue())
+            send_message(conn, b"download " + str.encode(random_folder()) + b".txt")
+            results.append(recv_message(conn))
+            conn.close()
+
+        self.assertListEqual(results, [(FLAG_FILE, b"21"), b"DontChangeThisContent",
+                                       (0, str.encode(READ_WRONG_PATH))] * 2)
+
+    def test_server_read_range(self):
+        """
+        This test will check read range and window.
+        Test1 : Range in the middle of the file.
+        Test2 : Range past the end of the file.
+        Test3 : Invalid length.
+        Test4 : read_file pages by the window.
+        """
+        req_handle = RequestHandler()
+        req_handle.user_passwords = {"test":"123"}
+        req_handle.login("test", "123")
+        req_handle.change_folder("testfolder1")
+        results = [req_handle.read_range("test_read.txt", "4", "6"),
+                   req_handle.read_range("test_read.txt", "15", "100"),
+                   req_handle.read_range("test_read.txt", "0", "0")]
+        req_handle.window("10")
+        results += [req_handle.read_file("test_read.txt"), req_handle.read_file("test_read.txt")]
+
+        self.assertListEqual(results, [read_range(4, 6, 21, "Change"),
+                                       read_range(15, 6, 21, "ontent"),
+                                       READ_RANGE_INVALID,
+                                       read_file("0", "DontChange", 10),
+                                       read_file("10", "ThisConten", 10)])
+
+    def test_server_search(self):
+        """
+        This test will check search after writes and a reload from disk.
+        Test1 : Term of an existing file, offset usable by read_range.
+        Test2 : Term of an appended line, found in the appended bytes only.
+        Test3 : Every word must match.
+        Test4 : Saved index reloads with the same postings.
+        Test5 : Binary file is not indexed.
+        Test6 : Unreadable saved index falls back to a rescan.
+        """
+        req_handle = RequestHandler()
+        req_handle.user_passwords = {"test":"123"}
+        req_handle.login("test", "123")
+        req_handle.change_folder("testfolder1")
+        req_handle.write_file("test_search.txt", "alpha Beta")
+        req_handle.write_file("test_search.txt", "gamma alpha")
+        path = os.path.join("testfolder1", "test_search.txt")
+        results = [req_handle.search("DontChangeThisContent"),
+                   req_handle.search("gamma"),
+                   req_handle.search("beta gamma"),
+                   req_handle.search("beta missing")]
+        index = get_search_index("test")
+        folder = tempfile.mkdtemp()
+        saved_path, index.path = index.path, os.path.join(folder, "test.json")
+        with index.lock:
+            index.dirty = True
+            index.save()
+        index.path = saved_path
+        reloaded = SearchIndex("test", folder)
+        reloaded.load()
+        same = reloaded.postings == index.postings
+        with open(reloaded.path, "w") as file:
+            file.write("{\"files\": ")
+        rescanned = SearchIndex("test", folder)
+        rescanned.load()
+        same = same and rescanned.postings == index.postings and os.listdir(folder) == ["test.json"]
+        with open(req_handle.get_total_path("test_search.bin"), "wb") as file:
+            file.write(b"binaryterm\0\xff")
+        index.update(os.path.join("testfolder1", "test_search.bin"))
+        results.append(req_handle.search("binaryterm"))
+        os.remove(req_handle.get_total_path("test_search.txt"))
+        os.remove(req_handle.get_total_path("test_search.bin"))
+        index.remove(path)
+        index.remove(os.path.join("testfolder1", "test_search.bin"))
+        shutil.rmtree(folder)
+
+        self.assertListEqual(results, [search_results([(os.path.join("testfolder1", "test_read.txt"), [0])]),
+                                       search_results([(path, [11])]),
+                                       search_results([(path, [6])]),
+                                       SEARCH_EMPTY,
+                                       SEARCH_EMPTY])
+        self.assertTrue(same)
+
+    def test_storage_backends(self):
+        """
+        This test will check the memory and SQLite backends behave the same.
+        Test1 : Folders, files and appends are listed and read back.
+        Test2 : Pages and ranges of a multi byte file.
+        Test3 : rmtree removes a whole user and nothing else.
+        Test4 : The interface can't be used without a backend.
+        """
+        folder = tempfile.mkdtemp()
+        results = []
+        for storage in (MemoryStorage(), SQLiteStorage(os.path.join(folder, "storage.db"))):
+            for path in ("test", "test/docs", "test_2"):
+                storage.mkdir(path)
+            storage.write("test/docs/a.txt", "\u00e9t\u00e9 ok".encode("utf-8"))
+            storage.append("test/docs/a.txt", b"\nmore")
+            storage.write("test_2/b.txt", b"other")
+            result = [storage.listdir("test"), storage.listdir("test/docs"),
+                      storage.stat("test/docs/a.txt")[:2],
+                      storage.read_range("test/docs/a.txt", 2, 4),
+                      storage.read_page("test/docs/a.txt", 3, 4),
+                      [(path, files) for path, _, files in storage.walk("test")]]
+            storage.rmtree("test")
+            result += [storage.exists("test/docs/a.txt"), storage.listdir(""),
+                       storage.read_range("test_2/b.txt", 0, 10)]
+            results.append(result)
+        shutil.rmtree(folder)
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], [[("docs", True)], [("a.txt", False)], (False, 13),
+                                      (b"t\xc3\xa9 ", 13), (0, "\u00e9t\u00e9 ", 3),
+                                      [("test", []), ("test/docs", ["a.txt"])],
+                                      False, [("test_2", True)], (b"other", 5)])
+        self.assertRaises(TypeError, Storage)
+
+    def test_chunk_index_pages(self):
+        """
+        This test will check seek based pages match slices of the file.
+        Test1 : Pages of a multi byte file past the first checkpoint.
+        Test2 : Pages after an append.
+        """
+        contents = "\u00e9t\u00e9 " * 1000 + "plain" * 500
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", delete=False) as file:
+            file.write(contents)
+        chunks = get_index(file.name, 7)
+        pages = [0, 1, STRIDE - 1, STRIDE, STRIDE + 3, chunks.pages() - 1]
+        results = [chunks.read(page) for page in pages]
+        expected_results = [contents[page*7:(page + 1)*7] for page in pages]
+        with open(file.name, "a", encoding="utf-8") as append:
+            append.write("\n\u00fcber")
+        note_append(file.name)
+        contents += "\n\u00fcber"
+        chunks = get_index(file.name, 7)
+        results.append(chunks.read(chunks.pages() - 1))
+        expected_results.append(contents[(chunks.pages() - 1)*7:])
+        os.remove(file.name)
+
+        self.assertListEqual(results, expected_results)
+        self.assertEqual(chunks.pages(), len(contents)//7 + 1)
+
     def test_server_write_file(self):
         """
         This test will check write file.
@@ -158,3 +894,145 @@ class ReqClassTestingStepFour(unittest.TestCase):
         results.append(req_handle.write_file("test_write.txt", "content"))
 
         self.assertListEqual(results, expected_results)
+
+    def test_server_quota(self):
+        """
+        This test will check quotas.
+        Test1 : Append within the byte quota.
+        Test2 : Append over the byte quota.
+        Test3 : New file over the inode quota.
+        """
+        req_handle = RequestHandler()
+        req_handle.user_passwords = {"test":"123"}
+        req_handle.login("test", "123")
+        req_handle.change_folder("testfolder1")
+        used_bytes, used_inodes = get_usage("test").report()
+        req_handle.registry.quotas["test"] = [used_bytes + 10, used_inodes]
+        try:
+            results = [req_handle.write_file("test_write.txt", "fits"),
+                       req_handle.write_file("test_write.txt", "does not fit"),
+                       req_handle.write_file(random_folder() + ".txt", "x")]
+        finally:
+            req_handle.registry.quotas.pop("test")
+
+        self.assertListEqual(results, [WRITE_EXISTING, QUOTA_EXCEEDED, QUOTA_EXCEEDED])
+        self.assertEqual(get_usage("test").report(), (used_bytes + 5, used_inodes))
+
+    def test_server_upload_quota(self):
+        """
+        This test will check uploads count against the quota only once they run.
+        Test1 : Upload dropped by a batch reserves nothing.
+        Test2 : Upload created but not run reserves nothing.
+        Test3 : Upload run over a socket counts its bytes and file.
+        """
+        req_handle = RequestHandler()
+        req_handle.user_passwords = {"test":"123"}
+        req_handle.login("test", "123")
+        req_handle.change_folder("testfolder1")
+        name = random_folder() + ".bin"
+        usage = get_usage("test").report()
+        results = [req_handle.respond_batch(["upload " + name + " 5"]), get_usage("test").report()]
+        upload = req_handle.upload(name, "5")
+        results += [get_usage("test").report(), name + ".part" in req_handle.list_files()]
+        server, client = socket.socketpair()
+        worker = threading.Thread(target=upload.run, args=(server,))
+        worker.start()
+        results.append(recv_message(client))
+        client.sendall(b"hello")
+        results.append(recv_message(client)[1].startswith(b"\nUpload complete, 5 bytes"))
+        worker.join(5)
+        results.append(get_usage("test").report())
+        server.close()
+        client.close()
+        os.remove(req_handle.get_total_path(name))
+        req_handle.directories().remove(req_handle.present_directory, name)
+        get_search_index("test").remove(os.path.join("testfolder1", name))
+        get_usage("test").release(5, 1)
+
+        self.assertListEqual(results, [[[0, TRANSFER_IN_BATCH]], usage, usage, False, (FLAG_FILE, b"0"),
+                                       True, (usage[0] + 5, usage[1] + 1)])
+
+    def test_transfer_pool(self):
+        """
+        This test will check a stalled upload holds no request worker on either engine.
+        Test1 : Upload is ready for its body.
+        Test2 : Another tenant is answered while the upload stalls.
+        Test3 : Upload completes once its body arrives.
+        """
+        req_handle = RequestHandler()
+        req_handle.user_passwords = {"test":"123"}
+        req_handle.login("test", "123")
+        req_handle.change_folder("testfolder1")
+        results = []
+        for engine in (SocketAttach, AsyncSocketAttach):
+            _, port = start_engine(engine, workers=1)
+            name = random_folder() + ".bin"
+            uploader = framed_connection(port)
+            for command in ("login test 123", "change_folder testfolder1", "upload " + name + " 10"):
+                send_message(uploader, str.encode(command))
+                reply = recv_message(uploader)
+            results.append(reply)
+            uploader.sendall(b"hello")
+            other = framed_connection(port)
+            send_message(other, b"login admin adm")
+            results.append(str(recv_message(other)[1], "utf-8").startswith(LOGIN_TRUE))
+            uploader.sendall(b"world")
+            results.append(recv_message(uploader)[1].startswith(b"\nUpload complete, 10 bytes"))
+            uploader.close()
+            other.close()
+            os.remove(req_handle.get_total_path(name))
+            req_handle.directories().remove(req_handle.present_directory, name)
+            get_search_index("test").remove(os.path.join("testfolder1", name))
+            get_usage("test").release(10, 1)
+
+        self.assertListEqual(results, [(FLAG_FILE, b"0"), True, True] * 2)
+
+    def test_shared_usage(self):
+        """
+        This test will check shared usage enforces one quota across server processes.
+        Test1 : Reserve by one process counts for the other.
+        Test2 : Reserve over the quota left by the other is refused.
+        Test3 : Release by one process frees space for the other.
+        """
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "test.json")
+        first = StorageUsage("test", shared=True, path=path)
+        second = StorageUsage("test", shared=True, path=path)
+        used_bytes, used_inodes = first.report()
+        quota = (used_bytes + 10, 0)
+        results = [first.reserve(6, 0, quota), second.report(), second.reserve(6, 0, quota)]
+        second.release(6)
+        results.append(first.reserve(4, 0, quota))
+        results.append(second.report())
+        shutil.rmtree(folder)
+
+        self.assertListEqual(results, [True, (used_bytes + 6, used_inodes), False, True,
+                                       (used_bytes + 4, used_inodes)])
+
+    def test_blob_store_dedup(self):
+        """
+        This test will check identical files share one blob until one of them changes.
+        """
+        folder = tempfile.mkdtemp()
+        store = BlobStore(os.path.join(folder, ".blobs"))
+        paths = [os.path.join(folder, name) for name in ("a.txt", "b.txt")]
+        for path in paths:
+            with open(path, "w") as file:
+                file.write("DontChangeThisContent")
+        saved = [store.intern(path) for path in paths]
+        shared = os.path.samefile(paths[0], paths[1])
+        report = store.report()
+        store.detach(paths[0])
+        with open(paths[0], "a") as file:
+            file.write("\nchanged")
+        with open(paths[1]) as file:
+            untouched = file.read()
+        os.remove(paths[1])
+        removed = store.collect()
+        shutil.rmtree(folder)
+
+        self.assertListEqual(saved, [0, 21])
+        self.assertTrue(shared)
+        self.assertEqual(report, (1, 21, 21))
+        self.assertEqual(untouched, "DontChangeThisContent")
+        self.assertEqual(removed, 1)
@@ -0,0 +1,340 @@
+"""
+Bulk file transfers that bypass the request/response templates.
+
+A download answers with a FLAG_FILE frame holding the file size, followed by
+exactly that many raw bytes sent from the page cache with sendfile.
+
+An upload answers with a FLAG_FILE frame holding the offset to resume from,
+the client then sends the rest of the body raw and gets a final frame with
+the sha256 of the whole file. Its quota is reserved when the transfer starts,
+a plain frame with the error answers an upload that doesn't fit. The body lands in "<name>.part" and is renamed
+over "<name>" once complete, so an interrupted upload resumes where it broke.
+"""
+
+import asyncio
+import hashlib
+import os
+from abc import ABC, abstractmethod
+
+from .protocol import send_message, write_message, FLAG_FILE, FRAME_SIZE
+from .templates import upload_success
+
+SENDFILE_CHUNK = 1 << 20
+
+class Transfer(ABC):
+    """
+    Transfer module
+
+    Returned by RequestHandler in place of a template, the socket engine
+    runs it on the connection. A transfer implements both abstract methods.
+
+    Attributes:
+    -----------------
+        received, sent : int
+            Body bytes moved by the transfer.
+
+    Methods:
+    -----------------
+        run(conn):
+            Run the transfer on a blocking socket.
+
+        run_async(reader, writer, timeout):
+            Run the transfer on an asyncio stream.
+    """
+
+    received = 0
+    sent = 0
+
+    @abstractmethod
+    def run(self, conn):
+        """
+        Run the transfer on a blocking socket.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def run_async(self, reader, writer, timeout=None):
+        """
+        Run the transfer on an asyncio stream, no step stalling over timeout seconds.
+        """
+        raise NotImplementedError
+
+
+class Download(Transfer):
+    """
+    Download module
+
+    Attributes:
+    -----------------
+        path : str
+            File to send.
+
+        size : int
+            Bytes to send, fixed when the command ran.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize the attributes.
+        """
+        self.path = path
+        self.size = os.path.getsize(path)
+
+    def run(self, conn):
+        """
+        Send the file with sendfile.
+
+        Parameters:
+            conn : Socket class
+        """
+        send_message(conn, str.encode(str(self.size)), FLAG_FILE)
+        with open(self.path, "rb") as file:
+            self.sent = conn.sendfile(file, 0, self.size)
+        if self.sent != self.size:
+            raise ConnectionError("File shrank during download")
+
+    async def run_async(self, reader, writer, timeout=None):
+        """
+        Send the file with the event loop's sendfile, SENDFILE_CHUNK bytes per call
+        so a stalled client times out like a blocking socket would.
+
+        Parameters:
+            reader : asyncio.StreamReader
+            writer : asyncio.StreamWriter
+            timeout : float
+                Seconds a chunk may take, None to wait forever.
+        """
+        write_message(writer, str.encode(str(self.size)), FLAG_FILE)
+        await asyncio.wait_for(writer.drain(), timeout)
+        loop = asyncio.get_running_loop()
+        with open(self.path, "rb") as file:
+            while self.sent < self.size:
+                count = min(self.size - self.sent, SENDFILE_CHUNK)
+                sent = await asyncio.wait_for(loop.sendfile(writer.transport, file, self.sent, count),
+                                              timeout)
+                if not sent:
+                    break
+                self.sent += sent
+        if self.sent != self.size:
+            raise ConnectionError("File shrank during download")
+
+
+class Upload(Transfer):
+    """
+    Upload module
+
+    Attributes:
+    -----------------
+        path : str
+            File to write.
+
+        size : int
+            Total bytes of the file.
+
+        part : str
+            File holding the body until it is complete.
+
+        offset : int
+            Bytes already received by an earlier attempt.
+
+        done : callable
+            Called with the size of the replaced file, or None, and the sha256
+            hex digest once the file is in place.
+
+        abort : callable
+            Called with the bytes that never arrived when the upload breaks off.
+
+        start : callable
+            Called with the bytes and files the upload adds when the transfer
+            starts, returns an error response ending it or None.
+
+    Methods:
+    -----------------
+        begin():
+            Run the start callback.
+
+        open():
+            Open the part file and hash what it holds.
+
+        finish(digest):
+            Move the complete file in place.
+
+        receive(conn):
+            Receive the body on a blocking socket.
+
+        receive_async(reader, writer, timeout):
+            Receive the body on an asyncio stream.
+    """
+
+    def __init__(self, path, size, done=None, abort=None, start=None):
+        """
+        Initialize the attributes.
+        """
+        self.path = path
+        self.size = size
+        self.done = done
+        self.abort = abort
+        self.start = start
+        self.part = path + ".part"
+        self.offset = os.path.getsize(self.part) if os.path.isfile(self.part) else 0
+        if self.offset > size:
+            self.offset = 0
+
+    def begin(self):
+        """
+        Run the start callback.
+
+        Return: bytes or None
+            Error response ending the upload before it starts, None to go on.
+        """
+        if self.start is None:
+            return None
+        error = self.start(self.size - self.offset, 0 if self.offset else 1)
+        return None if error is None else str.encode(error)
+
+    def open(self):
+        """
+        Open the part file for appending, hashing the bytes it already holds.
+
+        Return: tuple(file, hash)
+            Part file and sha256 of its contents.
+        """
+        digest = hashlib.sha256()
+        if self.offset:
+            with open(self.part, "rb") as file:
+                for chunk in iter(lambda: file.read(FRAME_SIZE), b""):
+                    digest.update(chunk)
+            return open(self.part, "ab"), digest
+        return open(self.part, "wb"), digest
+
+    def finish(self, digest):
+        """
+        Rename the part file over the target.
+
+        Parameters:
+            digest : hash
+
+        Return: bytes
+            Upload success response.
+        """
+        replaced = os.path.getsize(self.path) if os.path.isfile(self.path) else None
+        os.replace(self.part, self.path)
+        if self.done:
+            self.done(replaced, digest.hexdigest())
+        return str.encode(upload_success(self.size, digest.hexdigest()))
+
+    def run(self, conn):
+        """
+        Receive the body, reporting the missing bytes if it breaks off.
+
+        Parameters:
+            conn : Socket class
+        """
+        error = self.begin()
+        if error is not None:
+            send_message(conn, error)
+            return
+        try:
+            self.receive(conn)
+        except BaseException:
+            if self.abort:
+                self.abort(self.size - self.offset - self.received)
+            raise
+
+    async def run_async(self, reader, writer, timeout=None):
+        """
+        Receive the body, reporting the missing bytes if it breaks off.
+
+        Parameters:
+            reader : asyncio.StreamReader
+            writer : asyncio.StreamWriter
+            timeout : float
+                Seconds a read or write may stall, None to wait forever.
+        """
+        error = self.begin()
+        if error is not None:
+            write_message(writer, error)
+            await asyncio.wait_for(writer.drain(), timeout)
+            return
+        try:
+            await self.receive_async(reader, writer, timeout)
+        except BaseException:
+            if self.abort:
+                self.abort(self.size - self.offset - self.received)
+            raise
+
+    def receive(self, conn):
+        """
+        Receive the body in fixed size chunks straight to disk.
+
+        Parameters:
+            conn : Socket class
+        """
+        file, digest = self.open()
+        send_message(conn, str.encode(str(self.offset)), FLAG_FILE)
+        remaining = self.size - self.offset
+        with file:
+            while remaining:
+                chunk = conn.recv(min(remaining, FRAME_SIZE))
+                if not chunk:
+                    raise ConnectionError("Connection closed mid upload")
+                file.write(chunk)
+                digest.update(chunk)
+                remaining -= len(chunk)
+                self.received += len(chunk)
+        send_message(conn, self.finish(digest))
+
+    async def receive_async(self, reader, writer, timeout=None):
+        """
+        Receive the body in fixed size chunks straight to disk.
+
+        Parameters:
+            reader : asyncio.StreamReader
+            writer : asyncio.StreamWriter
+            timeout : float
+        """
+        file, digest = self.open()
+        write_message(writer, str.encode(str(self.offset)), FLAG_FILE)
+        await asyncio.wait_for(writer.drain(), timeout)
+        remaining = self.size - self.offset
+        with file:
+            while remaining:
+                chunk = await asyncio.wait_for(reader.read(min(remaining, FRAME_SIZE)), timeout)
+                if not chunk:
+                    raise ConnectionError("Connection closed mid upload")
+                file.write(chunk)
+                digest.update(chunk)
+                remaining -= len(chunk)
+                self.received += len(chunk)
+        write_message(writer, self.finish(digest))
+        await asyncio.wait_for(writer.drain(), timeout)
+
+
+def receive_download(conn, file, size):
+    """
+    Write size bytes from the socket to a file as they arrive.
+
+    Parameters:
+        conn : Socket class
+        file : binary file object
+        size : int
+    """
+    while size:
+        chunk = conn.recv(min(size, FRAME_SIZE))
+        if not chunk:
+            raise ConnectionError("Connection closed mid download")
+        file.write(chunk)
+        size -= len(chunk)
+
+def send_upload(conn, file, offset, size):
+    """
+    Send a local file from offset with sendfile.
+
+    Parameters:
+        conn : Socket class
+        file : binary file object
+        offset : int
+        size : int
+    """
+    if size > offset:
+        conn.sendfile(file, offset, size - offset)